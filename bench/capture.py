@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the latency of capturing an image with PicroscopyLibrary, broken down
+into the stages timed by the library and camera (allocating a filename, the
+sensor, decoding, drawing the scale bar, encoding, writing the file and
+generating its thumbnail). The fast path (the camera's JPEG is written
+untouched) is compared with capturing with a scale bar and capturing as PNG,
+at each of the camera's usual resolutions. The Pi's camera is replaced with a
+fake which returns a synthetic JPEG, so this can be run anywhere. Run from the
+root of the source tree::
+
+    $ python3 bench/capture.py [--resolution 2592x1944] [--repeat 10]
+"""
+
+import os
+import io
+import sys
+import types
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from PIL import Image, ImageDraw
+
+from picroscopy.exif import insert_exif
+
+
+class FakePiCamera(object):
+    # Stands in for picamera.PiCamera; captures always return the same JPEG,
+    # which is generated once (with some EXIF tags like the real camera's)
+    # so that its cost isn't included in the measurements
+    jpeg = None
+
+    def __init__(self):
+        self.resolution = (2592, 1944)
+        self.exif_tags = {}
+
+    def capture(self, output, format=None, **options):
+        output.write(self.jpeg)
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def capture_continuous(self, output, format=None, **options):
+        while True:
+            output.write(self.jpeg)
+            yield output
+
+    def close(self):
+        pass
+
+
+def make_jpeg(resolution):
+    # Gradients and lines give the encoder something to chew on; a flat image
+    # would decode unrealistically quickly
+    w, h = resolution
+    im = Image.new('RGB', resolution)
+    draw = ImageDraw.Draw(im)
+    for x in range(0, w, 4):
+        draw.line((x, 0, w - x, h), fill=(x % 256, (x * 3) % 256, (x * 7) % 256))
+    data = io.BytesIO()
+    im.save(data, format='JPEG', quality=95)
+    return insert_exif(data.getvalue(), make_exif([
+        (0x010f, b'RaspberryPi\x00'),
+        (0x0110, b'RP_OV5647\x00'),
+        ]))
+
+
+def make_exif(tags):
+    # Build a little-endian TIFF structure holding a single IFD of ASCII
+    # tags, as older versions of PIL can't write EXIF themselves
+    offset = 8 + 2 + len(tags) * 12 + 4
+    entries = []
+    values = []
+    for tag, value in tags:
+        entries.append(struct.pack('<HHLL', tag, 2, len(value), offset))
+        values.append(value)
+        offset += len(value)
+    return b''.join(
+        [b'II*\x00', struct.pack('<LH', 8, len(tags))] + entries +
+        [struct.pack('<L', 0)] + values)
+
+
+def size(s):
+    w, h = s.split('x', 1)
+    return (int(w), int(h))
+
+
+def install_fake_picamera():
+    module = types.ModuleType('picamera')
+    module.PiCamera = FakePiCamera
+    module.PiCameraError = Exception
+    sys.modules['picamera'] = module
+
+
+# The resolutions the camera is usually run at: full sensor, 1080p, binned
+# 2x2, and VGA
+RESOLUTIONS = [(2592, 1944), (1920, 1080), (1296, 972), (640, 480)]
+
+# An arbitrary calibration: roughly what a 10x objective gives at full
+# resolution
+SCALE = 3.5
+
+CONFIGURATIONS = [
+    ('fast path', 'jpeg', False),
+    ('scale bar', 'jpeg', True),
+    ('png',       'png',  False),
+    ]
+
+STAGES = [
+    'allocate', 'sensor', 'exif_extract', 'decode', 'scale_bar', 'encode',
+    'exif_insert', 'store', 'thumbnail',
+    ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--resolution', type=size, action='append')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(args)
+    install_fake_picamera()
+    from picroscopy.library import PicroscopyLibrary
+    from picroscopy.metrics import Metrics
+    print('Mean time per stage (ms) of %d captures' % args.repeat)
+    print('%-10s %-10s %s %8s' % (
+        'size', 'config', ' '.join('%8.8s' % s for s in STAGES), 'total'))
+    for resolution in args.resolution or RESOLUTIONS:
+        FakePiCamera.jpeg = make_jpeg(resolution)
+        for label, format, scale_bar in CONFIGURATIONS:
+            # A fresh library (in temporary directories) for each run so that
+            # each starts with an empty index
+            metrics = Metrics()
+            library = PicroscopyLibrary(metrics=metrics)
+            try:
+                library.camera.resolution = resolution
+                library.camera.lenses['10x'] = SCALE
+                library.camera.lens = '10x'
+                library.camera.scale_bar = scale_bar
+                library.format = format
+                for i in range(args.repeat):
+                    library.capture()
+            finally:
+                library.close()
+            means = {
+                labels['stage']: total / count
+                for labels, count, total in metrics.summary(
+                    'picroscopy_capture_stage_seconds')
+                }
+            print('%-10s %-10s %s %8.1f' % (
+                '%dx%d' % resolution, label,
+                ' '.join(
+                    '%8.1f' % (means[s] * 1000) if s in means else '%8s' % '-'
+                    for s in STAGES),
+                sum(means.values()) * 1000))
+
+
+if __name__ == '__main__':
+    main()
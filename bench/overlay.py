@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the cost of drawing a scale bar on a captured image in each of the
+available styles, comparing drawing the bar from scratch with ImageDraw for
+every capture against pasting the cached overlay, followed by the latency of
+a complete capture (with the fake camera from capture.py) with a scale bar.
+Run from the root of the source tree::
+
+    $ python3 bench/overlay.py [--resolution 2592x1944] [--repeat 20]
+"""
+
+import os
+import io
+import sys
+import shutil
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from PIL import Image
+
+from capture import FakePiCamera, make_jpeg, size, install_fake_picamera
+
+
+# An arbitrary calibration: roughly what a 10x objective gives at full
+# resolution
+SCALE = 3.5
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--resolution', type=size, default=(2592, 1944))
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(args)
+    install_fake_picamera()
+    from picroscopy.camera import PicroscopyCamera
+    from picroscopy.overlay import ScaleBarRenderer, STYLES
+    FakePiCamera.jpeg = make_jpeg(args.resolution)
+    img = Image.open(io.BytesIO(FakePiCamera.jpeg))
+    img.load()
+    print('Scale bar on %dx%d image, best of %d runs' % (
+        args.resolution + (args.repeat,)))
+    print('%-12s %10s %10s' % ('style', 'ImageDraw', 'cached'))
+    for style in STYLES:
+        results = []
+        # A renderer without a cache draws the overlay with ImageDraw on
+        # every call, as the camera used to for each capture
+        for renderer in (ScaleBarRenderer(cache_size=0), ScaleBarRenderer()):
+            results.append(min(timeit.repeat(
+                lambda: renderer.apply(img, SCALE, 9, style),
+                number=1, repeat=args.repeat)))
+        print('%-12s %8.2fms %8.2fms' % (
+            (style,) + tuple(r * 1000 for r in results)))
+    camera = PicroscopyCamera(scale_bar=True)
+    camera.lenses['10x'] = SCALE
+    camera.lens = '10x'
+    temp = tempfile.mkdtemp()
+    try:
+        output = os.path.join(temp, 'image.jpg')
+        for label, scale_bar in (('no bar', False), ('scale bar', True)):
+            camera.scale_bar = scale_bar
+            best = min(timeit.repeat(
+                lambda: camera.capture(output, 'jpeg', quality=95),
+                number=1, repeat=args.repeat))
+            print('Capture with %-10s %8.1fms' % (label, best * 1000))
+    finally:
+        shutil.rmtree(temp)
+
+
+if __name__ == '__main__':
+    main()
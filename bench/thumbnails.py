@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares thumbnail generation using JPEG draft mode (reduced scale decoding)
+with decoding the source image at full resolution. A synthetic JPEG at the
+camera's full resolution is used as the source. Run from the root of the
+source tree::
+
+    $ python3 bench/thumbnails.py [--size 320x320] [--repeat 10]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from PIL import Image, ImageDraw
+
+from picroscopy.thumbs import generate_thumbnail, _fit
+
+
+def size(s):
+    w, h = s.split('x', 1)
+    return (int(w), int(h))
+
+
+def make_source(path, resolution):
+    # Gradients and lines give the encoder something to chew on; a flat image
+    # would decode unrealistically quickly
+    w, h = resolution
+    im = Image.new('RGB', resolution)
+    draw = ImageDraw.Draw(im)
+    for x in range(0, w, 4):
+        draw.line((x, 0, w - x, h), fill=(x % 256, (x * 3) % 256, (x * 7) % 256))
+    im.save(path, format='JPEG', quality=95)
+
+
+def full_thumbnail(source, target, size):
+    # The behaviour prior to using draft mode: decode everything, then scale
+    im = Image.open(source)
+    im.load()
+    im.thumbnail(size, Image.LANCZOS)
+    im.save(target, format='JPEG', optimize=True, progressive=True)
+
+
+def decoded_bytes(source, size, draft):
+    im = Image.open(source)
+    if draft:
+        im.draft('RGB', _fit(im.size, size))
+    im.load()
+    return im.size, im.size[0] * im.size[1] * len(im.getbands())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--size', type=size, default=(320, 320))
+    parser.add_argument('--resolution', type=size, default=(2592, 1944))
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(args)
+    temp = tempfile.mkdtemp()
+    try:
+        source = os.path.join(temp, 'source.jpg')
+        target = os.path.join(temp, 'thumb.jpg')
+        make_source(source, args.resolution)
+        print('Thumbnail of %dx%d JPEG at %dx%d, best of %d runs' % (
+            args.resolution + args.size + (args.repeat,)))
+        for label, func, draft in (
+                ('full decode', full_thumbnail, False),
+                ('draft mode', generate_thumbnail, True),
+                ):
+            best = min(timeit.repeat(
+                lambda: func(source, target, args.size),
+                number=1, repeat=args.repeat))
+            decoded, mem = decoded_bytes(source, args.size, draft)
+            print('%-12s %8.1fms  decoded at %4dx%-4d %8.1fMB' % (
+                label, best * 1000, decoded[0], decoded[1], mem / 1048576))
+    finally:
+        shutil.rmtree(temp)
+
+
+if __name__ == '__main__':
+    main()
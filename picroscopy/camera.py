@@ -21,28 +21,154 @@ This module defines the interface to the Pi's camera. Primarily this is derived
 from the `picamera`_ package, but the base class, :class:`picamera.PiCamera`,
 is extended to draw scale bars on taken images and calibrate said scales.
 
+The camera is not safe to use from several threads at once, so the library
+owns it via a :class:`CameraQueue` which performs all captures and changes of
+settings, in order, on a single background thread.
+
 .. _picamera: http://pypi.python.org/pypi/picamera/
 """
 
 import os
 import io
-import tempfile
-import bisect
-import logging
-import subprocess
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError
 
-from PIL import Image, ImageDraw
+from PIL import Image
 from picamera import PiCamera
 
+from picroscopy.exif import (
+    extract_exif,
+    insert_exif,
+    insert_png_exif,
+    exif_tiffinfo,
+    )
+from picroscopy.overlay import ScaleBarRenderer, STYLES
+from picroscopy.metrics import Metrics, Stopwatch
+
+class CameraTimeout(Exception):
+    """
+    Raised when a command queued for the camera doesn't complete in time
+    (typically because a long exposure is in progress).
+    """
+
+
+class CameraQueue(object):
+    """
+    Owns *camera*, executing commands against it on a background thread in
+    the order they are submitted. Each command is a callable which is passed
+    the camera as its first argument. Callers wait up to *timeout* seconds
+    for a command to complete by default.
+
+    Reading the camera's settings directly is fine, but anything which
+    changes the camera's state must be done via the queue.
+    """
+
+    def __init__(self, camera, timeout=30.0):
+        super().__init__()
+        self.camera = camera
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue ``func(camera, *args, **kwargs)`` for execution, returning a
+        :class:`~concurrent.futures.Future` for its result.
+        """
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Called from a command which is already executing; queueing it
+            # would deadlock, and it's safe to execute it immediately
+            future.set_running_or_notify_cancel()
+            self._execute(future, func, args, kwargs)
+        else:
+            if not self._thread.is_alive():
+                raise RuntimeError('Camera queue is closed')
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """
+        Execute ``func(camera, *args, **kwargs)`` via the queue, waiting for
+        its result. Raises :exc:`CameraTimeout` if the command doesn't
+        complete within :attr:`timeout` seconds; if it hadn't started by then,
+        it is cancelled.
+        """
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise CameraTimeout(
+                'The camera did not respond within %g seconds' % self.timeout)
+
+    def capture(self, output, format=None, **options):
+        return self.call(
+            lambda camera: camera.capture(output, format, **options))
+
+    def configure(self, settings):
+        """
+        Set each of the ``(name, value)`` pairs in *settings* as attributes of
+        the camera, in order.
+        """
+        def apply(camera):
+            for name, value in settings:
+                setattr(camera, name, value)
+        self.call(apply)
+
+    def set_resolution(self, resolution):
+        """
+        Change the camera's resolution, restarting the preview if necessary.
+        """
+        def apply(camera):
+            if camera.resolution != resolution:
+                # The resolution can't be changed while recording, so the
+                # live view stream (if any) is restarted too
+                streaming = camera.streaming
+                if streaming:
+                    camera.stop_streaming()
+                camera.stop_preview()
+                try:
+                    camera.resolution = resolution
+                finally:
+                    camera.start_preview()
+                    if streaming:
+                        camera.start_streaming(*streaming)
+        self.call(apply)
+
+    def close(self):
+        """
+        Execute all commands queued so far, then stop the background thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                self._execute(future, func, args, kwargs)
+
+    def _execute(self, future, func, args, kwargs):
+        try:
+            result = func(self.camera, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
 class PicroscopyCamera(PiCamera):
 
-    scale_styles = [
-        'white_bar',
-        'black_bar',
-        'checked_bar',
-        'white_axis',
-        'black_axis',
-        ]
+    scale_styles = STYLES
+    streaming_port = 2
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -51,104 +177,123 @@ class PicroscopyCamera(PiCamera):
         self.scale_bar = kwargs.get('scale_bar', False)
         self.scale_position = kwargs.get('scale_position', 9)
         self.scale_style = kwargs.get('scale_style', 'white_bar')
+        self._overlay = ScaleBarRenderer()
+        self.metrics = kwargs.get('metrics') or Metrics()
+        self.streaming = None
 
-    def capture(self, output, format=None, **options):
+    def capture(self, output, format=None, stopwatch=None, **options):
         # No matter what format is requested, capture the image as JPEG at
-        # quality 95. This is to ensure we get the EXIF data. We then pull out
-        # the EXIF data with exiftool, perform any image manipulation and
-        # conversion we want with PIL, save it (losing the EXIF data as PIL
-        # doesn't preserve it) and then get exiftool to restore it back again
+        # quality 95. This is to ensure we get the EXIF data. The image is
+        # then processed into the requested format by process(). Each stage
+        # is timed by stopwatch (which the caller may pass in to time stages
+        # of its own along with these)
+        if stopwatch is None:
+            stopwatch = self.stopwatch()
+        image_stream = io.BytesIO()
+        with stopwatch.stage('sensor'):
+            super().capture(image_stream, 'jpeg', quality=95)
+        return self.process(
+            image_stream.getvalue(), output, format, stopwatch, **options)
+
+    def stopwatch(self):
+        return Stopwatch(self.metrics, 'picroscopy_capture_stage_seconds')
+
+    def capture_frame(self):
+        # Capture a JPEG as capture() does, returning its data to be passed to
+        # render() or process() later. The library captures each image with a
+        # separate call, rendering it outside the camera's queue, so that
+        # other commands can be executed between images
         image_stream = io.BytesIO()
         super().capture(image_stream, 'jpeg', quality=95)
-        image_stream.seek(0)
-        _, exif = tempfile.mkstemp(suffix='.exif')
-        try:
-            self._export_exif(image_stream, exif)
-            image_stream.seek(0)
-            img = Image.open(image_stream)
-            if self.scale_bar:
-                self._draw_scale_bar(img)
-            if format is not None:
-                img.save(output, format.upper(), **options)
-            else:
-                img.save(output, **options)
-            self._import_exif(output, exif)
-        finally:
-            os.unlink(exif)
-
-    def _export_exif(self, image, exif):
-        # XXX Yes, this introduces a race condition, but when using -o exiftool
-        # refuses to overwrite an existing output file (even if
-        # -overwrite_output is specified, despite what the docs say...)
-        os.unlink(exif)
-        p = subprocess.Popen(
-            ['exiftool', '-o', exif, '-all:all', '-'],
-            stdin=subprocess.PIPE,
-            stdout=None,
-            stderr=None,
-            bufsize=-1)
-        p.communicate(image.read())
-        assert p.returncode == 0
-        image.seek(0)
-
-    def _import_exif(self, image, exif):
-        p = subprocess.Popen(
-            ['exiftool', '-tagsFromFile', exif, '-overwrite_original', image])
-        p.communicate()
-        assert p.returncode == 0
-
-    def _draw_scale_bar(self, image):
-        # The image is divided into thirds like so, with the corresponding
-        # values of scale_position:
-        #
-        #   +---------+---------+---------+
-        #   |   ###   |   ###   |   ###   |
-        #   |    1    |    2    |    3    |
-        #   |         |         |         |
-        #   +---------+---------+---------+
-        #   |         |         |         |
-        #   |   #4#   |   #5#   |   #6#   |
-        #   |         |         |         |
-        #   +---------+---------+---------+
-        #   |         |         |         |
-        #   |    7    |    8    |    9    |
-        #   |   ###   |   ###   |   ###   |
-        #   +---------+---------+---------+
-        #
-        # The width of a cell is divided by 14 (hence the width of the
-        # image by 42 as 14*3=42) and this unit forms the basis of the
-        # scale bar. The scale bar is made as close to 10 units wide as
-        # possible (for a reasonable value of the scale) and is 1 unit
-        # high.
-        scales = [
-            1, 2, 3, 4, 5,
-            10, 15, 20, 25,
-            30, 40, 50, 75,
-            100, 150, 200, 250,
-            300, 400, 500, 750,
-            ]
-        draw = ImageDraw.Draw(image)
-        w, h = img.size
-        unit = w / 42
-        scale_w = (1 / self.scale) * unit * 10
-        label = scales[bisect.bisect_left(scales, scale_w) - 1]
-        scale_w = label * self.scale
-        xcell = (self.scale_position - 1) % 3
-        ycell = (self.scale_position - 1) // 3
-        left = ((xcell * 14) + 2) * unit
-        right = left + (unit * 10)
-        bottom = (
-            unit * 2               if ycell == 0 else
-            (h // 2) - (unit // 2) if ycell == 1 else
-            h - unit * 2          #if ycell == 2
-            )
-        top = bottom - unit
-        if self.scale_style == 'white_bar':
-            draw.rectangle((left, top, right, bottom), outline='#000000', fill='#ffffff')
-        elif self.scale_style == 'black_bar':
-            draw.rectangle((left, top, right, bottom), otuline='#ffffff', fill='#000000')
+        return image_stream.getvalue()
+
+    def start_streaming(self, output, resolution=(640, 480), quality=50):
+        # Record MJPEG at the (reduced) resolution to output from a splitter
+        # port of the video port, leaving the still port free for captures.
+        # The encoder runs on the camera's own thread, writing to output until
+        # stop_streaming is called
+        self.start_recording(
+            output, 'mjpeg', resize=resolution, quality=quality,
+            splitter_port=self.streaming_port)
+        self.streaming = (output, resolution, quality)
+
+    def stop_streaming(self):
+        if self.streaming:
+            self.streaming = None
+            self.stop_recording(splitter_port=self.streaming_port)
+
+    def process(self, data, output, format=None, stopwatch=None, **options):
+        # Render the captured JPEG data in the requested format (see render)
+        # and write the result to the output, returning the image. This
+        # doesn't touch the camera itself so it's safe to call from any thread
+        if stopwatch is None:
+            stopwatch = self.stopwatch()
+        if format is None:
+            format = self._guess_format(output)
+        data, img = self.render(data, format, stopwatch, **options)
+        with stopwatch.stage('write'):
+            self._write(output, data)
+        return img
+
+    def render(self, data, format, stopwatch=None, **options):
+        # Lift the EXIF block out of the captured JPEG data, perform any image
+        # manipulation and conversion we want with PIL (losing the EXIF data
+        # as PIL doesn't preserve it), and splice the block back into the
+        # re-encoded data. Returns the encoded data along with the decoded
+        # image so that the caller can derive other things (like thumbnails)
+        # from it without decoding the data again. Like process, this is safe
+        # to call from any thread
+        if stopwatch is None:
+            stopwatch = self.stopwatch()
+        format = format.upper()
+        # A scale bar can only be drawn when the scale is known (i.e. a
+        # calibrated lens is selected)
+        scale_bar = self.scale_bar and self.scale is not None
+        if format == 'JPEG' and not scale_bar and not options:
+            # The camera's JPEG (EXIF and all) is exactly what's wanted, so
+            # return it untouched, avoiding a decode/encode cycle and the loss
+            # of quality that entails. The image is returned undecoded (PIL
+            # only decodes it if the caller needs its pixels) and, as data is
+            # a bytes object, BytesIO reads it in place rather than copying it
+            return data, Image.open(io.BytesIO(data))
+        with stopwatch.stage('exif_extract'):
+            exif = extract_exif(data)
+        with stopwatch.stage('decode'):
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        if scale_bar:
+            with stopwatch.stage('scale_bar'):
+                self._overlay.apply(
+                    img, self.scale, self.scale_position, self.scale_style)
+        if format == 'TIFF' and exif:
+            options.setdefault('tiffinfo', exif_tiffinfo(exif))
+        with stopwatch.stage('encode'):
+            data = io.BytesIO()
+            img.save(data, format, **options)
+            data = data.getvalue()
+        if exif:
+            with stopwatch.stage('exif_insert'):
+                if format == 'JPEG':
+                    data = insert_exif(data, exif)
+                elif format == 'PNG':
+                    data = insert_png_exif(data, exif)
+        return data, img
+
+    def _write(self, output, data):
+        if isinstance(output, str):
+            with io.open(output, 'wb') as f:
+                f.write(data)
         else:
-            raise NotImplementedError
+            output.write(data)
+
+    def _guess_format(self, output):
+        # Emulate PIL's behaviour of deriving the format from the output
+        # filename when none is explicitly given
+        Image.init()
+        try:
+            return Image.EXTENSION[os.path.splitext(output)[1].lower()]
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Unable to determine format for %r' % output)
 
     def _get_lens(self):
         return self._lens
@@ -156,6 +301,7 @@ class PicroscopyCamera(PiCamera):
         if value is not None and value not in self.lenses:
             raise ValueError('Unknown lens %s' % value)
         self._lens = value
+    lens = property(_get_lens, _set_lens)
 
     @property
     def scale(self):
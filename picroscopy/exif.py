@@ -19,8 +19,22 @@
 """
 Some rudimentary EXIF handling, specifically handling those tags that are used
 by raspistill.
+
+In addition to the tag tables, this module includes a minimal in-process
+reader and writer for the EXIF block itself. The camera's JPEG output carries
+its EXIF data in an APP1 segment; :func:`extract_exif` lifts this block out of
+the captured bytes and :func:`insert_exif` splices it into re-encoded output,
+avoiding the need to shell out to exiftool for every capture. For reading the
+metadata of stored images, :func:`read_exif` locates the block within a JPEG,
+PNG, or TIFF file and :func:`exiftool_tags` converts the parsed result into the
+same dict shape as ``exiftool -j`` produces.
 """
 
+import math
+import struct
+import zlib
+from collections import OrderedDict
+
 CAMERA_MAKE   = 271
 CAMERA_MODEL  = 272
 SOFTWARE      = 305
@@ -116,3 +130,654 @@ def format_exif(data):
         for (key, value) in data.items()
         if key in TAG_NAMES
         }
+
+
+# JPEG markers relevant to locating the EXIF block. Segments are scanned from
+# SOI up to SOS; everything after SOS is entropy coded image data which we
+# never need to look at
+JPEG_SOI  = 0xD8
+JPEG_EOI  = 0xD9
+JPEG_SOS  = 0xDA
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+
+# Markers which consist of the marker alone with no length field
+JPEG_STANDALONE = set([0x01] + list(range(0xD0, JPEG_EOI + 1)))
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Tags which point to sub-IFDs within the TIFF structure of the EXIF block
+EXIF_IFD_POINTER    = 34665
+GPS_IFD_POINTER     = 34853
+INTEROP_IFD_POINTER = 40965
+
+IFD_POINTERS = {
+    EXIF_IFD_POINTER:    'EXIF',
+    GPS_IFD_POINTER:     'GPS',
+    INTEROP_IFD_POINTER: 'Interop',
+    }
+
+# TIFF field types mapped to their struct format character and size
+TIFF_TYPES = {
+    1:  ('B', 1), # BYTE
+    2:  ('s', 1), # ASCII
+    3:  ('H', 2), # SHORT
+    4:  ('L', 4), # LONG
+    5:  ('L', 8), # RATIONAL
+    6:  ('b', 1), # SBYTE
+    7:  ('s', 1), # UNDEFINED
+    8:  ('h', 2), # SSHORT
+    9:  ('l', 4), # SLONG
+    10: ('l', 8), # SRATIONAL
+    11: ('f', 4), # FLOAT
+    12: ('d', 8), # DOUBLE
+    }
+TIFF_ASCII     = 2
+TIFF_UNDEFINED = 7
+TIFF_RATIONALS = (5, 10)
+
+
+def jpeg_segments(data):
+    """
+    Generates (marker, start, end) tuples for each segment in the JPEG *data*.
+
+    The *start* and *end* values are offsets into *data* such that
+    ``data[start:end]`` is the complete segment including its marker. The
+    generator terminates after yielding the SOS segment (the remainder of the
+    data is entropy coded). Raises :exc:`ValueError` if *data* is not a JPEG
+    or its segments are malformed.
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Data is not a JPEG image')
+    yield JPEG_SOI, 0, 2
+    offset = 2
+    while offset < len(data):
+        if data[offset] != 0xFF or offset + 2 > len(data):
+            raise ValueError('Invalid JPEG marker at offset %d' % offset)
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte; skip it
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE:
+            yield marker, offset, offset + 2
+            offset += 2
+            if marker == JPEG_EOI:
+                return
+            continue
+        if offset + 4 > len(data):
+            raise ValueError('Truncated JPEG segment at offset %d' % offset)
+        length, = struct.unpack('>H', data[offset + 2:offset + 4])
+        if length < 2 or offset + 2 + length > len(data):
+            raise ValueError('Invalid JPEG segment at offset %d' % offset)
+        yield marker, offset, offset + 2 + length
+        if marker == JPEG_SOS:
+            return
+        offset += 2 + length
+    raise ValueError('Unexpected end of JPEG data')
+
+
+def extract_exif(data):
+    """
+    Returns the EXIF block from the JPEG *data*, or ``None`` if there is none.
+
+    The block is returned exactly as stored in the APP1 segment, i.e. it begins
+    with the ``Exif\\x00\\x00`` header followed by the TIFF structure.
+    """
+    for marker, start, end in jpeg_segments(data):
+        if marker == JPEG_APP1 and data[start + 4:start + 10] == EXIF_HEADER:
+            return bytes(data[start + 4:end])
+    return None
+
+
+def insert_exif(data, exif):
+    """
+    Returns a copy of the JPEG *data* with the *exif* block spliced in.
+
+    Any existing EXIF block in *data* is dropped. The new APP1 segment is
+    placed immediately after SOI and any JFIF APP0 segment. If *exif* is empty
+    or ``None``, the data is returned with its EXIF block (if any) removed.
+    """
+    if exif and not exif.startswith(EXIF_HEADER):
+        exif = EXIF_HEADER + exif
+    if exif and len(exif) > 0xFFFF - 2:
+        raise ValueError('EXIF block is too large for a JPEG APP1 segment')
+    head = []
+    insert_at = None
+    for marker, start, end in jpeg_segments(data):
+        if marker == JPEG_APP1 and data[start + 4:start + 10] == EXIF_HEADER:
+            continue
+        if insert_at is None and marker not in (JPEG_SOI, JPEG_APP0):
+            insert_at = len(head)
+        head.append(data[start:end])
+        if marker == JPEG_SOS:
+            tail = data[end:]
+            break
+    else:
+        tail = b''
+    if exif:
+        if insert_at is None:
+            insert_at = len(head)
+        head.insert(
+            insert_at,
+            struct.pack('>BBH', 0xFF, JPEG_APP1, len(exif) + 2) + exif)
+    head.append(tail)
+    return b''.join(head)
+
+
+def insert_png_exif(data, exif):
+    """
+    Returns a copy of the PNG *data* with the *exif* block added as an
+    ``eXIf`` chunk (placed before the first ``IDAT`` chunk as the specification
+    requires).
+    """
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('Data is not a PNG image')
+    if not exif:
+        return data
+    if exif.startswith(EXIF_HEADER):
+        exif = exif[len(EXIF_HEADER):]
+    chunk = (
+        struct.pack('>I', len(exif)) + b'eXIf' + exif +
+        struct.pack('>I', zlib.crc32(b'eXIf' + exif) & 0xFFFFFFFF)
+        )
+    offset = 8
+    while offset < len(data):
+        if offset + 8 > len(data):
+            raise ValueError('Truncated PNG chunk at offset %d' % offset)
+        length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        if kind == b'eXIf':
+            # Replace any existing eXIf chunk
+            return data[:offset] + chunk + data[offset + length + 12:]
+        if kind == b'IDAT':
+            return data[:offset] + chunk + data[offset:]
+        offset += length + 12
+    raise ValueError('PNG data contains no IDAT chunk')
+
+
+def parse_exif(exif):
+    """
+    Parses an EXIF block (as returned by :func:`extract_exif`) into a dict.
+
+    The result maps IFD names (``'IFD0'``, ``'IFD1'``, ``'EXIF'``, ``'GPS'``,
+    and ``'Interop'``) to dicts of ``{tag: value}``. ASCII values are returned
+    as strings, rationals as ``(numerator, denominator)`` tuples, undefined
+    values as bytes, and all other values as integers (or tuples of integers
+    where the count is greater than one). Malformed entries are skipped.
+    """
+    if exif.startswith(EXIF_HEADER):
+        exif = exif[len(EXIF_HEADER):]
+    exif = bytes(exif)
+    if exif[:2] == b'II':
+        order = '<'
+    elif exif[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError('Invalid TIFF header in EXIF data')
+    magic, offset = struct.unpack(order + 'HL', exif[2:8])
+    if magic != 42:
+        raise ValueError('Invalid TIFF header in EXIF data')
+    result = {}
+    pending = [('IFD0', offset)]
+    seen = set()
+    while pending:
+        name, offset = pending.pop(0)
+        if offset in seen or not 8 <= offset < len(exif) - 2:
+            continue
+        seen.add(offset)
+        tags, next_offset = _parse_ifd(exif, order, offset)
+        result[name] = tags
+        for tag, ifd in IFD_POINTERS.items():
+            if tag in tags:
+                pending.append((ifd, tags.pop(tag)))
+        if name == 'IFD0' and next_offset:
+            pending.append(('IFD1', next_offset))
+    return result
+
+
+def _parse_ifd(data, order, offset):
+    count, = struct.unpack(order + 'H', data[offset:offset + 2])
+    tags = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        if entry + 12 > len(data):
+            break
+        tag, kind, num, value = struct.unpack(
+            order + 'HHL4s', data[entry:entry + 12])
+        try:
+            fmt, size = TIFF_TYPES[kind]
+        except KeyError:
+            continue
+        length = size * num
+        if length > 4:
+            start, = struct.unpack(order + 'L', value)
+            value = data[start:start + length]
+            if len(value) < length:
+                continue
+        else:
+            value = value[:length]
+        if kind == TIFF_ASCII:
+            value = value.split(b'\x00', 1)[0].decode('ascii', 'replace')
+        elif kind == TIFF_UNDEFINED:
+            value = bytes(value)
+        else:
+            values = struct.unpack(
+                order + fmt * (num * 2 if kind in TIFF_RATIONALS else num),
+                value)
+            if kind in TIFF_RATIONALS:
+                values = tuple(zip(values[::2], values[1::2]))
+            value = values[0] if num == 1 else values
+        tags[tag] = value
+    next_offset = offset + 2 + count * 12
+    if next_offset + 4 <= len(data):
+        next_offset, = struct.unpack(
+            order + 'L', data[next_offset:next_offset + 4])
+    else:
+        next_offset = 0
+    return tags, next_offset
+
+
+def exif_tiffinfo(exif):
+    """
+    Returns a dict suitable for PIL's ``tiffinfo`` save option containing the
+    textual IFD0 tags of the *exif* block.
+
+    TIFF files store their metadata in the IFD structure of the image itself,
+    so there is no block to splice in as with JPEG or PNG. Instead we carry
+    the descriptive tags (artist, copyright, software, etc.) across.
+    """
+    if not exif:
+        return {}
+    ifd0 = parse_exif(exif).get('IFD0', {})
+    return {
+        tag: value
+        for (tag, value) in ifd0.items()
+        if isinstance(value, str)
+        }
+
+
+def read_exif(f):
+    """
+    Returns the raw EXIF data from the JPEG, PNG, or TIFF file-like object *f*
+    suitable for passing to :func:`parse_exif`, or ``None`` if the file
+    contains no EXIF data.
+
+    For JPEG and PNG files only the segments (or chunks) preceding the image
+    data are read. TIFF files *are* an EXIF structure; their IFDs (and the
+    values they refer to) are copied into a new, compact TIFF structure so
+    that the image data itself is never read.
+    """
+    header = f.read(8)
+    if header[:2] == b'\xff\xd8':
+        return _read_jpeg_exif(f, header)
+    elif header == PNG_SIGNATURE:
+        return _read_png_exif(f)
+    elif header[:4] in (b'II*\x00', b'MM\x00*'):
+        return _read_tiff_exif(f, header)
+    return None
+
+
+def _read_jpeg_exif(f, header):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in JPEG_STANDALONE:
+            if marker[1] == JPEG_EOI:
+                return None
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length, = struct.unpack('>H', length)
+        if marker[1] == JPEG_SOS or length < 2:
+            return None
+        if marker[1] == JPEG_APP1:
+            data = f.read(length - 2)
+            if len(data) < length - 2:
+                return None
+            if data.startswith(EXIF_HEADER):
+                return data
+        else:
+            f.seek(length - 2, 1)
+
+
+def _read_png_exif(f):
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        length, kind = struct.unpack('>I4s', chunk)
+        if kind == b'eXIf':
+            data = f.read(length)
+            if len(data) < length:
+                return None
+            return data
+        elif kind in (b'IDAT', b'IEND'):
+            return None
+        f.seek(length + 4, 1)
+
+
+# The largest value copied from a TIFF IFD by read_exif; anything larger is
+# image data (or similar) rather than metadata. An EXIF block stored in a JPEG
+# is limited to this size in its entirety
+TIFF_MAX_VALUE = 0xFFFF
+
+
+def _read_tiff_exif(f, header):
+    order = '<' if header[:2] == b'II' else '>'
+    first, = struct.unpack(order + 'L', header[4:8])
+    ifds = OrderedDict()
+    pending = [(first, True)]
+    while pending:
+        offset, follow_next = pending.pop(0)
+        if offset in ifds or offset < 8:
+            continue
+        ifd = _read_tiff_ifd(f, order, offset)
+        if ifd is None:
+            continue
+        entries, next_offset = ifd
+        # As in parse_exif, only IFD0 is followed by another IFD (IFD1)
+        if not follow_next:
+            next_offset = 0
+        ifds[offset] = (entries, next_offset)
+        for tag, kind, num, value in entries:
+            if tag in IFD_POINTERS and kind == 4 and num == 1:
+                pending.append((struct.unpack(order + 'L', value)[0], False))
+        if next_offset:
+            pending.append((next_offset, False))
+    if not ifds:
+        return None
+    # Lay the IFDs out one after another, each followed by its values (padded
+    # to a word boundary), then write them out with their offsets rewritten
+    positions = {}
+    position = 8
+    for offset, (entries, next_offset) in ifds.items():
+        positions[offset] = position
+        position += 2 + len(entries) * 12 + 4 + sum(
+            len(value) + len(value) % 2
+            for tag, kind, num, value in entries
+            if len(value) > 4)
+    result = [header[:4], struct.pack(order + 'L', 8)]
+    for offset, (entries, next_offset) in ifds.items():
+        values_at = positions[offset] + 2 + len(entries) * 12 + 4
+        fields = []
+        values = []
+        for tag, kind, num, value in entries:
+            if tag in IFD_POINTERS and kind == 4 and num == 1:
+                child, = struct.unpack(order + 'L', value)
+                value = struct.pack(order + 'L', positions.get(child, 0))
+            if len(value) > 4:
+                fields.append(struct.pack(
+                    order + 'HHLL', tag, kind, num, values_at))
+                values.append(value + b'\x00' * (len(value) % 2))
+                values_at += len(values[-1])
+            else:
+                fields.append(struct.pack(
+                    order + 'HHL', tag, kind, num) + value.ljust(4, b'\x00'))
+        result.append(struct.pack(order + 'H', len(fields)))
+        result.extend(fields)
+        result.append(struct.pack(order + 'L', positions.get(next_offset, 0)))
+        result.extend(values)
+    return b''.join(result)
+
+
+def _read_tiff_ifd(f, order, offset):
+    # Returns the entries of the IFD at offset as (tag, type, count, value)
+    # tuples, where value is the raw bytes of the value (fetched from wherever
+    # the entry points if it's too large to be stored in the entry itself),
+    # along with the offset of the next IFD
+    f.seek(offset)
+    data = f.read(2)
+    if len(data) < 2:
+        return None
+    count, = struct.unpack(order + 'H', data)
+    data = f.read(count * 12 + 4)
+    if len(data) < count * 12 + 4:
+        return None
+    entries = []
+    for i in range(count):
+        tag, kind, num, value = struct.unpack(
+            order + 'HHL4s', data[i * 12:i * 12 + 12])
+        try:
+            fmt, size = TIFF_TYPES[kind]
+        except KeyError:
+            continue
+        length = size * num
+        if length > TIFF_MAX_VALUE:
+            continue
+        elif length > 4:
+            start, = struct.unpack(order + 'L', value)
+            f.seek(start)
+            value = f.read(length)
+            if len(value) < length:
+                continue
+        else:
+            value = value[:length]
+        entries.append((tag, kind, num, value))
+    next_offset, = struct.unpack(order + 'L', data[-4:])
+    return entries, next_offset
+
+
+def _number(v):
+    # Render a rational (or plain number) as exiftool does in its JSON output,
+    # i.e. as an integer where possible and a float rounded sensibly otherwise
+    if isinstance(v, tuple):
+        num, den = v
+        if not den:
+            return 'undef' if num else 0
+        v = num / den
+    if isinstance(v, float):
+        if v.is_integer():
+            return int(v)
+        return float('%.4g' % v)
+    return v
+
+def _exposure(v):
+    v = _number(v)
+    if not isinstance(v, (int, float)) or v <= 0:
+        return v
+    if v >= 0.25:
+        return v
+    return '1/%d' % int(0.5 + 1 / v)
+
+def _shutter_speed(v):
+    v = _number(v)
+    if not isinstance(v, (int, float)):
+        return v
+    return _exposure(math.pow(2, -v))
+
+def _aperture(v):
+    v = _number(v)
+    if not isinstance(v, (int, float)):
+        return v
+    return float('%.1f' % math.pow(2, v / 2))
+
+def _focal_length(v):
+    v = _number(v)
+    if not isinstance(v, (int, float)):
+        return v
+    return '%.1f mm' % v
+
+def _version(v):
+    if isinstance(v, bytes):
+        return v.decode('ascii', 'replace')
+    return v
+
+def _choice(choices):
+    return lambda v: choices.get(v, 'Unknown (%s)' % (v,))
+
+def _components(v):
+    names = {0: '-', 1: 'Y', 2: 'Cb', 3: 'Cr', 4: 'R', 5: 'G', 6: 'B'}
+    if isinstance(v, bytes):
+        return ', '.join(names.get(c, str(c)) for c in v)
+    return v
+
+def _text(v):
+    if isinstance(v, bytes):
+        v = v.decode('ascii', 'replace')
+    return v.rstrip('\x00').strip()
+
+def _user_comment(v):
+    # The first 8 bytes of a UserComment are the character code
+    if isinstance(v, bytes):
+        return _text(v[8:])
+    return v
+
+def _identity(v):
+    return v
+
+ORIENTATIONS = {
+    1: 'Horizontal (normal)',
+    2: 'Mirror horizontal',
+    3: 'Rotate 180',
+    4: 'Mirror vertical',
+    5: 'Mirror horizontal and rotate 270 CW',
+    6: 'Rotate 90 CW',
+    7: 'Mirror horizontal and rotate 90 CW',
+    8: 'Rotate 270 CW',
+    }
+
+RESOLUTION_UNITS = {
+    1: 'None',
+    2: 'inches',
+    3: 'cm',
+    }
+
+YCBCR_POSITIONS = {
+    1: 'Centered',
+    2: 'Co-sited',
+    }
+
+COMPRESSIONS = {
+    1: 'Uncompressed',
+    6: 'JPEG (old-style)',
+    7: 'JPEG',
+    }
+
+COLOR_SPACES = {
+    1:      'sRGB',
+    2:      'Adobe RGB',
+    0xFFFF: 'Uncalibrated',
+    }
+
+FLASHES = {
+    0x00: 'No Flash',
+    0x01: 'Fired',
+    0x08: 'On, Did not fire',
+    0x10: 'Off, Did not fire',
+    0x18: 'Auto, Did not fire',
+    0x19: 'Auto, Fired',
+    0x20: 'No flash function',
+    }
+
+SCENE_CAPTURE_TYPES = {
+    0: 'Standard',
+    1: 'Landscape',
+    2: 'Portrait',
+    3: 'Night',
+    }
+
+LIGHT_SOURCES = {
+    0:   'Unknown',
+    1:   'Daylight',
+    2:   'Fluorescent',
+    3:   'Tungsten (Incandescent)',
+    4:   'Flash',
+    9:   'Fine Weather',
+    10:  'Cloudy',
+    11:  'Shade',
+    255: 'Other',
+    }
+
+# Tag names and value formatters matching the output of ``exiftool -j``. Tags
+# are keyed by (IFD, tag); tags which are not listed here are omitted from the
+# output of exiftool_tags
+EXIFTOOL_TAGS = {
+    ('IFD0', 259):      ('Compression',              _choice(COMPRESSIONS)),
+    ('IFD0', 270):      ('ImageDescription',         _text),
+    ('IFD0', 271):      ('Make',                     _text),
+    ('IFD0', 272):      ('Model',                    _text),
+    ('IFD0', 274):      ('Orientation',              _choice(ORIENTATIONS)),
+    ('IFD0', 282):      ('XResolution',              _number),
+    ('IFD0', 283):      ('YResolution',              _number),
+    ('IFD0', 296):      ('ResolutionUnit',           _choice(RESOLUTION_UNITS)),
+    ('IFD0', 305):      ('Software',                 _text),
+    ('IFD0', 306):      ('ModifyDate',               _text),
+    ('IFD0', 315):      ('Artist',                   _text),
+    ('IFD0', 531):      ('YCbCrPositioning',         _choice(YCBCR_POSITIONS)),
+    ('IFD0', 33432):    ('Copyright',                _text),
+    ('IFD1', 259):      ('Compression',              _choice(COMPRESSIONS)),
+    ('IFD1', 513):      ('ThumbnailOffset',          _identity),
+    ('IFD1', 514):      ('ThumbnailLength',          _identity),
+    ('EXIF', 33434):    ('ExposureTime',             _exposure),
+    ('EXIF', 33437):    ('FNumber',                  _number),
+    ('EXIF', 34850):    ('ExposureProgram',          _choice(EXPOSURE_PROGRAMS)),
+    ('EXIF', 34855):    ('ISO',                      _identity),
+    ('EXIF', 36864):    ('ExifVersion',              _version),
+    ('EXIF', 36867):    ('DateTimeOriginal',         _text),
+    ('EXIF', 36868):    ('CreateDate',               _text),
+    ('EXIF', 37121):    ('ComponentsConfiguration',  _components),
+    ('EXIF', 37377):    ('ShutterSpeedValue',        _shutter_speed),
+    ('EXIF', 37378):    ('ApertureValue',            _aperture),
+    ('EXIF', 37379):    ('BrightnessValue',          _number),
+    ('EXIF', 37380):    ('ExposureCompensation',     _number),
+    ('EXIF', 37381):    ('MaxApertureValue',         _aperture),
+    ('EXIF', 37383):    ('MeteringMode',             _choice(METERING_MODES)),
+    ('EXIF', 37384):    ('LightSource',              _choice(LIGHT_SOURCES)),
+    ('EXIF', 37385):    ('Flash',                    _choice(FLASHES)),
+    ('EXIF', 37386):    ('FocalLength',              _focal_length),
+    ('EXIF', 37500):    ('MakerNote',                _text),
+    ('EXIF', 37510):    ('UserComment',              _user_comment),
+    ('EXIF', 37520):    ('SubSecTime',               _text),
+    ('EXIF', 37521):    ('SubSecTimeOriginal',       _text),
+    ('EXIF', 37522):    ('SubSecTimeDigitized',      _text),
+    ('EXIF', 40960):    ('FlashpixVersion',          _version),
+    ('EXIF', 40961):    ('ColorSpace',               _choice(COLOR_SPACES)),
+    ('EXIF', 40962):    ('ExifImageWidth',           _identity),
+    ('EXIF', 40963):    ('ExifImageHeight',          _identity),
+    ('EXIF', 41986):    ('ExposureMode',             _choice(EXPOSURE_MODES)),
+    ('EXIF', 41987):    ('WhiteBalance',             _choice(WHITE_BALANCES)),
+    ('EXIF', 41988):    ('DigitalZoomRatio',         _number),
+    ('EXIF', 41990):    ('SceneCaptureType',         _choice(SCENE_CAPTURE_TYPES)),
+    ('EXIF', 42016):    ('ImageUniqueID',            _text),
+    ('Interop', 1):     ('InteropIndex',             _text),
+    ('Interop', 2):     ('InteropVersion',           _version),
+    }
+
+def exiftool_size(size):
+    """
+    Formats a file *size* in bytes in the same manner as exiftool's FileSize
+    tag.
+    """
+    if size < 2048:
+        return '%d bytes' % size
+    elif size < 10240:
+        return '%.1f kB' % (size / 1024)
+    elif size < 2097152:
+        return '%.0f kB' % (size / 1024)
+    elif size < 10485760:
+        return '%.1f MB' % (size / 1048576)
+    else:
+        return '%.0f MB' % (size / 1048576)
+
+def exiftool_tags(ifds):
+    """
+    Converts the result of :func:`parse_exif` into a dict of tag names and
+    values in the same form as the output of ``exiftool -j``.
+    """
+    result = {}
+    for ifd, tags in ifds.items():
+        for tag, value in tags.items():
+            try:
+                name, formatter = EXIFTOOL_TAGS[(ifd, tag)]
+            except KeyError:
+                continue
+            try:
+                result[name] = formatter(value)
+            except (TypeError, ValueError, ZeroDivisionError):
+                pass
+    return result
@@ -0,0 +1,296 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines the index which backs the picture library. The
+:class:`PicroscopyIndex` class maintains an in-memory, ordered record of the
+images in a directory along with their size, modification time, dimensions,
+and the time they were added to the directory. This avoids listing and stat'ing the directory every time the
+library is queried.
+
+The index is built once (with :meth:`~PicroscopyIndex.rebuild`) and thereafter
+kept up to date by calls to :meth:`~PicroscopyIndex.add` and
+:meth:`~PicroscopyIndex.discard`. Optionally, it can be persisted to a small
+JSON file so that rebuilding the index on restart only needs to examine files
+that have changed. Rewriting that file for every change would be costly (the
+file is usually on an SD card, and a time-lapse changes the index
+repeatedly), so changes are saved at most once every *save_delay* seconds, and
+when the index is closed.
+"""
+
+import os
+import io
+import json
+import bisect
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+from operator import attrgetter
+
+from PIL import Image
+
+
+IndexEntry = namedtuple('IndexEntry', (
+    'filename',
+    'size',
+    'mtime',
+    'width',
+    'height',
+    'ctime',
+    ))
+
+
+class PicroscopyIndex(object):
+    """
+    An ordered index of the images in *path* with names ending in one of the
+    specified *extensions*. If *index_file* is specified, the index will be
+    persisted to that file as JSON within *save_delay* seconds of changing
+    (and by :meth:`close`).
+
+    The :attr:`generation` attribute is incremented whenever the index
+    changes, so anything derived from the index can be cached against it.
+    """
+
+    version = 2
+
+    def __init__(self, path, extensions, index_file=None, save_delay=1.0):
+        super().__init__()
+        self.path = path
+        self.extensions = tuple(extensions)
+        self.index_file = index_file
+        self.save_delay = save_delay
+        self._save_timer = None
+        self._save_lock = threading.Lock()
+        self._entries = {}
+        self._names = []
+        self.generation = 0
+        # The index may be updated by a watcher thread as well as by the
+        # library itself
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        # Iterate over a copy so that callers may modify the index while
+        # iterating (e.g. when clearing the library)
+        with self._lock:
+            return iter(list(self._names))
+
+    def __contains__(self, value):
+        return value in self._entries
+
+    def __getitem__(self, value):
+        return self._entries[value]
+
+    def entries(self, offset=0, limit=None, key='filename', reverse=False):
+        """
+        Returns a list of (at most *limit*) :class:`IndexEntry` tuples starting
+        at *offset* with the entries ordered by the field named *key*
+        (descending if *reverse* is True). Ordering by filename (the order the
+        index is kept in) only touches the entries returned; other orders
+        must sort the entire index, but still involve no I/O.
+        """
+        with self._lock:
+            count = len(self._names)
+            if limit is None:
+                limit = count
+            if key == 'filename':
+                if reverse:
+                    names = self._names[
+                        max(0, count - offset - limit):max(0, count - offset)]
+                    names.reverse()
+                else:
+                    names = self._names[offset:offset + limit]
+                return [self._entries[name] for name in names]
+            return sorted(
+                self._entries.values(), key=attrgetter(key, 'filename'),
+                reverse=reverse)[offset:offset + limit]
+
+    def digest(self, names=None):
+        """
+        Returns a digest of the current content of the index, which changes
+        whenever any image is added, modified, or removed (and remains stable
+        across restarts otherwise). If *names* is given, only the entries for
+        those filenames are included in the digest.
+        """
+        with self._lock:
+            if names is None:
+                names = self._names
+            entries = self.lookup(names)
+        h = hashlib.md5()
+        for entry in entries:
+            h.update(('%s\x00%d\x00%r\x00' % (
+                entry.filename, entry.size, entry.mtime)).encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, names):
+        """
+        Returns the :class:`IndexEntry` tuples for those of *names* which are
+        in the index.
+        """
+        with self._lock:
+            return [
+                self._entries[name] for name in names if name in self._entries]
+
+    def rebuild(self):
+        """
+        Rebuilds the index from the content of the directory. Where the index
+        has been persisted, entries whose size and modification time are
+        unchanged are re-used rather than re-read.
+        """
+        known = self._load()
+        entries = {}
+        for filename in os.listdir(self.path):
+            if not filename.endswith(self.extensions):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, filename))
+            except OSError:
+                continue
+            entry = known.get(filename)
+            if entry is None or (entry.size, entry.mtime, entry.ctime) != (
+                    st.st_size, st.st_mtime, st.st_ctime):
+                entry = self._read_entry(filename, st)
+            entries[filename] = entry
+        with self._lock:
+            self._entries = entries
+            self._names = sorted(entries)
+            self.generation += 1
+            self._schedule_save()
+        logging.info('Indexed %d image(s) in %s', len(entries), self.path)
+
+    def add(self, filename):
+        """
+        Adds (or refreshes) the entry for *filename* in the index, returning
+        the new :class:`IndexEntry`.
+        """
+        entry = self._read_entry(
+            filename, os.stat(os.path.join(self.path, filename)))
+        with self._lock:
+            if not filename in self._entries:
+                bisect.insort(self._names, filename)
+            self._entries[filename] = entry
+            self.generation += 1
+            self._schedule_save()
+        return entry
+
+    def discard(self, filename):
+        """
+        Removes *filename* from the index if it is present.
+        """
+        with self._lock:
+            if self._entries.pop(filename, None) is not None:
+                del self._names[bisect.bisect_left(self._names, filename)]
+                self.generation += 1
+                self._schedule_save()
+
+    def clear(self):
+        """
+        Removes all entries from the index.
+        """
+        with self._lock:
+            self._entries = {}
+            self._names = []
+            self.generation += 1
+            self._schedule_save()
+
+    def flush(self):
+        """
+        Saves any changes to the index file immediately.
+        """
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+        self._save()
+
+    def close(self):
+        """
+        Saves any outstanding changes to the index file.
+        """
+        self.flush()
+
+    def _schedule_save(self):
+        # Called with the lock held whenever the index changes; changes made
+        # before the timer fires are all written by a single save
+        if self.index_file and self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _read_entry(self, filename, st):
+        # Opening an image with PIL only reads its header, which is all we
+        # need to determine the dimensions. The ctime is recorded as the time
+        # the image was added (or last changed); unlike the mtime it isn't
+        # preserved when files are copied in from elsewhere (e.g. rsync -a)
+        try:
+            with io.open(os.path.join(self.path, filename), 'rb') as f:
+                width, height = Image.open(f).size
+        except (IOError, OSError, SyntaxError, ValueError):
+            width = height = None
+        return IndexEntry(
+            filename, st.st_size, st.st_mtime, width, height, st.st_ctime)
+
+    def _load(self):
+        if not self.index_file:
+            return {}
+        try:
+            with io.open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != self.version or data.get('path') != self.path:
+                logging.warning(
+                    'Ignoring index %s which was written for a different '
+                    'library', self.index_file)
+                return {}
+            return {
+                entry[0]: IndexEntry(*entry)
+                for entry in data['entries']
+                }
+        except (IOError, OSError) as e:
+            logging.info('Unable to read index %s: %s', self.index_file, e)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning('Ignoring corrupt index %s: %s', self.index_file, e)
+        return {}
+
+    def _save(self):
+        # The entries are copied under the lock but written outside it so
+        # that the index isn't blocked while the file is written; _save_lock
+        # ensures an older copy can't overwrite a newer one
+        with self._save_lock:
+            with self._lock:
+                entries = [self._entries[name] for name in self._names]
+            # Write to a temporary file and rename it into place so that a
+            # crash part way through never leaves a truncated index behind
+            fd, temp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.index_file)),
+                suffix='.tmp')
+            try:
+                with io.open(fd, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        'version': self.version,
+                        'path':    self.path,
+                        'entries': entries,
+                        }, f)
+                os.rename(temp, self.index_file)
+            except:
+                os.unlink(temp)
+                raise
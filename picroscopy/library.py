@@ -29,27 +29,59 @@ the filenames of the images that have been captured, while methods like
 :meth:`~PicroscopyLibrary.stat_image`, :meth:`~PicroscopyLibrary.open_image`,
 and :meth:`~PicroscopyLibrary.open_thumbnail` can be called with these
 filenames to obtain the metadata or data of the images.
+
+Reduced size renditions of images (the thumbnail, and a preview suitable for
+small screens) are generated on demand by
+:meth:`~PicroscopyLibrary.open_rendition` and cached under the thumbnails
+directory, which can be limited in size.
 """
 
 import os
 import io
+import re
 import errno
 import logging
 import datetime
+import shutil
 import tempfile
-import zipfile
-import smtplib
-import subprocess
-import json
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
+import time
+import threading
+import itertools
+import string
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 from PIL import Image
 
 from picroscopy import __version__
-from picroscopy.exif import format_exif
-from picroscopy.camera import PicroscopyCamera
+from picroscopy.exif import (
+    read_exif,
+    parse_exif,
+    exiftool_tags,
+    exiftool_size,
+    )
+from picroscopy.camera import PicroscopyCamera, CameraQueue
+from picroscopy.index import PicroscopyIndex
+from picroscopy.watcher import watch
+from picroscopy.mail import (
+    Attachment,
+    MailMessage,
+    MailQueue,
+    split_attachments,
+    )
+from picroscopy.zipstream import ZipStream
+from picroscopy.stream import MJPEGStream, CameraSource
+from picroscopy.metrics import Metrics
+from picroscopy.thumbs import (
+    ThumbnailQueue,
+    ThumbnailError,
+    RenditionCache,
+    save_thumbnail,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    PRIORITY_HIGH,
+    )
 
 
 HERE = os.path.abspath(os.path.dirname(__file__))
@@ -62,6 +94,110 @@ def ascii_property(value, name):
     return value
 
 
+QUEUED = 'queued'
+CAPTURING = 'capturing'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class CaptureJob(object):
+    """
+    Tracks the progress of a sequence of *count* images captured *interval*
+    seconds apart in *format* by :meth:`PicroscopyLibrary.capture_sequence`.
+    The :attr:`state` attribute is one of ``'queued'``, ``'capturing'``,
+    ``'processing'`` (all images have been captured but some are still being
+    written), ``'done'``, ``'failed'``, or ``'cancelled'``.
+    """
+
+    def __init__(self, id, count, interval, format, callback=None):
+        super().__init__()
+        self.id = id
+        self.count = count
+        self.interval = interval
+        self.format = format
+        self.callback = callback
+        self.state = QUEUED
+        self.captured = 0
+        self.processed = 0
+        self.failed = 0
+        self.images = []
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stop = threading.Event()
+        self.thread = None
+        self._lock = threading.Lock()
+        self._capturing = True
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'id':        self.id,
+                'count':     self.count,
+                'interval':  self.interval,
+                'state':     self.state,
+                'captured':  self.captured,
+                'processed': self.processed,
+                'failed':    self.failed,
+                'images':    list(self.images),
+                'error':     self.error,
+                'created':   self.created,
+                'started':   self.started,
+                'finished':  self.finished,
+                }
+
+    def capture_started(self):
+        with self._lock:
+            self.started = time.time()
+            self.state = CAPTURING
+
+    def frame_captured(self):
+        with self._lock:
+            self.captured += 1
+
+    def frame_processed(self, image):
+        with self._lock:
+            self.processed += 1
+            self.images.append(image)
+        self._check_finished()
+
+    def frame_failed(self, error):
+        with self._lock:
+            self.failed += 1
+            self.error = str(error)
+        self._check_finished()
+
+    def capture_finished(self, error=None):
+        with self._lock:
+            self._capturing = False
+            if error is not None:
+                self.error = str(error)
+                self.state = FAILED
+            elif self.stop.is_set() and self.captured < self.count:
+                self.state = CANCELLED
+            else:
+                self.state = PROCESSING
+        self._check_finished()
+
+    def _check_finished(self):
+        with self._lock:
+            if self._capturing or self.finished is not None:
+                return
+            if self.processed + self.failed < self.captured:
+                return
+            if self.state == PROCESSING:
+                self.state = DONE
+            self.finished = time.time()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                logging.exception('Error in callback for capture %d', self.id)
+
+
 class PicroscopyLibrary(object):
 
     format_extensions = {
@@ -72,9 +208,20 @@ class PicroscopyLibrary(object):
 
     extensions = tuple(format_extensions.values())
 
+    # Seconds to wait for a rendition to be generated on demand
+    rendition_timeout = 30.0
+
     def __init__(self, **kwargs):
         super().__init__()
-        self.camera = PicroscopyCamera(**kwargs)
+        # Where time goes is recorded in metrics, which the web application
+        # (if any) supplies so that it can report them along with its own
+        self.metrics = kwargs.get('metrics') or Metrics()
+        self.metrics.describe(
+            'picroscopy_capture_stage_seconds',
+            'Time taken by each stage of capturing an image')
+        self.camera = PicroscopyCamera(**dict(kwargs, metrics=self.metrics))
+        # All changes to the camera's state are made via its queue
+        self.camera_queue = CameraQueue(self.camera)
         self.images_tmp = tempfile.mkdtemp(dir=os.environ.get('TEMP', '/tmp'))
         self.thumbs_tmp = tempfile.mkdtemp(dir=os.environ.get('TEMP', '/tmp'))
         self.images_dir = os.path.abspath(os.path.normpath(kwargs.get(
@@ -93,8 +240,33 @@ class PicroscopyLibrary(object):
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
+        self.index = PicroscopyIndex(
+            self.images_dir, self.extensions, kwargs.get('index_file'))
+        if self.index.index_file:
+            logging.info('Library index: %s', self.index.index_file)
+        self.index.rebuild()
         self.thumbs_size = kwargs.get('thumbs_size', (320, 320))
         logging.info('Generating thumbnails at %d x %d', *self.thumbs_size)
+        self.preview_size = kwargs.get('preview_size', (1024, 1024))
+        logging.info('Generating previews at %d x %d', *self.preview_size)
+        self.renditions = {
+            'thumb':   self.thumbs_size,
+            'preview': self.preview_size,
+            }
+        for rendition in self.renditions:
+            try:
+                os.mkdir(os.path.join(self.thumbs_dir, rendition))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.thumbnailer = ThumbnailQueue(kwargs.get('thumbs_workers'))
+        logging.info(
+            'Generating thumbnails with %d worker(s)', self.thumbnailer.workers)
+        self.renditions_cache = RenditionCache(
+            self.thumbs_dir, kwargs.get('thumbs_limit', 0))
+        if self.renditions_cache.limit:
+            logging.info(
+                'Limiting thumbnails to %d bytes', self.renditions_cache.limit)
         self.email_from = kwargs.get('email_from', 'picroscopy')
         logging.info('Sending mail from: %s', self.email_from)
         self.sendmail = kwargs.get('sendmail', '/usr/sbin/sendmail')
@@ -103,45 +275,104 @@ class PicroscopyLibrary(object):
             logging.info('Sending mail via SMTP server: %s', self.smtp_server)
         else:
             logging.info('Sending mail via sendmail binary: %s', self.sendmail)
+        self.email_limit = kwargs.get('email_limit', 0)
+        if self.email_limit:
+            logging.info(
+                'Limiting e-mail attachments to %d bytes', self.email_limit)
+        # Images being sent are linked into the outbox so that the library
+        # can be cleared while they're still queued. Anything left over from
+        # a previous run can't be sent now, so throw it away
+        self.outbox_dir = os.path.join(self.images_dir, '.outbox')
+        shutil.rmtree(self.outbox_dir, ignore_errors=True)
+        os.mkdir(self.outbox_dir)
+        self.mailer = MailQueue(self.sendmail, self.smtp_server)
+        # The live view is fed from the camera unless another source (e.g. a
+        # SyntheticSource for testing) is given
+        self.stream_size = kwargs.get('stream_size', (640, 480))
+        logging.info('Streaming live view at %d x %d', *self.stream_size)
+        # Each viewer ties up one of the web server's threads, so by default
+        # only half of them may be used for the live view
+        threads = kwargs.get('threads', 4)
+        self.stream_clients = kwargs.get('stream_clients', max(1, threads // 2))
+        if self.stream_clients < 1:
+            raise ValueError('stream_clients must be at least 1')
+        logging.info(
+            'Allowing %d live view client(s)', self.stream_clients)
+        if self.stream_clients >= threads:
+            logging.warning(
+                'Live view clients can occupy all %d thread(s), locking out '
+                'other requests', threads)
+        self.stream = MJPEGStream(
+            kwargs.get('stream_source') or
+            CameraSource(self.camera_queue, self.stream_size),
+            max_clients=self.stream_clients)
+        self._exif_cache = {}
+        self._crc_cache = {}
+        self._lock = threading.RLock()
+        self._counter_lock = threading.Lock()
+        self.processor_workers = 2
+        self.processor = ThreadPoolExecutor(self.processor_workers)
+        self.capture_jobs = OrderedDict()
+        self._capture_counter = itertools.count(1)
         self.camera_reset()
         self.user_reset()
-        self.camera.start_preview()
+        self.camera_queue.call(lambda camera: camera.start_preview())
+        # Generate any thumbnails that are missing in the background (other
+        # renditions are only generated on demand), and start watching for
+        # changes made by other processes
+        for image in self:
+            if not self._rendition_current(image, 'thumb'):
+                self._queue_rendition(image, 'thumb', PRIORITY_LOW)
+        self.watcher = watch(self.images_dir, self.refresh, self.rebuild)
 
     def close(self):
-        self.camera.stop_preview()
-        self.camera.close()
+        for job in list(self.capture_jobs.values()):
+            job.stop.set()
+        for job in list(self.capture_jobs.values()):
+            if job.thread is not None:
+                job.thread.join()
+        self.watcher.close()
+        self.thumbnailer.close()
+        self.mailer.close()
+        shutil.rmtree(self.outbox_dir, ignore_errors=True)
+        self.stream.close()
+        self.camera_queue.call(lambda camera: camera.stop_preview())
+        self.camera_queue.call(lambda camera: camera.close())
+        self.camera_queue.close()
+        self.processor.shutdown(wait=True)
         if self.images_dir == self.images_tmp:
             self.clear()
+        # Nothing changes the index after this point, so write any changes
+        # still waiting to be saved
+        self.index.close()
         os.rmdir(self.images_tmp)
-        os.rmdir(self.thumbs_tmp)
+        shutil.rmtree(self.thumbs_tmp)
 
     def __len__(self):
-        return sum(1 for f in os.listdir(self.images_dir) if f.endswith(self.extensions))
+        return len(self.index)
 
     def __iter__(self):
-        for f in sorted(os.listdir(self.images_dir)):
-            if f.endswith(self.extensions):
-                yield f
+        return iter(self.index)
 
     def __contains__(self, value):
-        return (
-            value.endswith(self.extensions) and
-            os.path.exists(os.path.join(self.images_dir, value))
-            )
+        return value in self.index
 
     def camera_reset(self):
-        self.camera.sharpness = 0
-        self.camera.contrast = 0
-        self.camera.brightness = 50
-        self.camera.saturation = 0
-        # XXX Bug in the camera: ISO needs to be zero for exposure mode to work
-        self.camera.ISO = 0
-        self.camera.exposure_compensation = 0
-        self.camera.hflip = False
-        self.camera.vflip = False
-        self.camera.exposure_mode = 'auto'
-        self.camera.awb_mode = 'auto'
-        self.camera.meter_mode = 'average'
+        self.camera_queue.configure([
+            ('sharpness', 0),
+            ('contrast', 0),
+            ('brightness', 50),
+            ('saturation', 0),
+            # XXX Bug in the camera: ISO needs to be zero for exposure mode to
+            # work
+            ('ISO', 0),
+            ('exposure_compensation', 0),
+            ('hflip', False),
+            ('vflip', False),
+            ('exposure_mode', 'auto'),
+            ('awb_mode', 'auto'),
+            ('meter_mode', 'average'),
+            ])
         self.software = 'Picroscopy %s' % __version__
 
     def user_reset(self):
@@ -151,24 +382,30 @@ class PicroscopyLibrary(object):
         self.email = ''
         self.format = 'jpeg'
         self.filename_template = 'pic-{date:%Y%m%d}-{counter:05d}{ext}'
-        self.counter = 1
+        # The counter is seeded from the index by the next capture
+        with self._counter_lock:
+            self.counter = None
+
+    def _set_exif_tag(self, tag, value):
+        # The camera reads its EXIF tags while capturing so they can only be
+        # changed via the camera's queue
+        def apply(camera):
+            if value:
+                camera.exif_tags[tag] = value
+            else:
+                camera.exif_tags.pop(tag, '')
+        self.camera_queue.call(apply)
 
     def _get_description(self):
         return self.camera.exif_tags.get('IFD0.ImageDescription', '')
     def _set_description(self, value):
-        if value:
-            self.camera.exif_tags['IFD0.ImageDescription'] = ascii_property(value, 'Description')
-        else:
-            self.camera.exif_tags.pop('IFD0.ImageDescription', '')
+        self._set_exif_tag('IFD0.ImageDescription', ascii_property(value, 'Description'))
     description = property(_get_description, _set_description)
 
     def _get_artist(self):
         return self.camera.exif_tags.get('IFD0.Artist', '')
     def _set_artist(self, value):
-        if value:
-            self.camera.exif_tags['IFD0.Artist'] = ascii_property(value, 'Name')
-        else:
-            self.camera.exif_tags.pop('IFD0.Artist', '')
+        self._set_exif_tag('IFD0.Artist', ascii_property(value, 'Name'))
     artist = property(_get_artist, _set_artist)
 
     def _get_email(self):
@@ -180,19 +417,13 @@ class PicroscopyLibrary(object):
     def _get_copyright(self):
         return self.camera.exif_tags.get('IFD0.Copyright', '')
     def _set_copyright(self, value):
-        if value:
-            self.camera.exif_tags['IFD0.Copyright'] = ascii_property(value, 'Copyright')
-        else:
-            self.camera.exif_tags.pop('IFD0.Copyright', '')
+        self._set_exif_tag('IFD0.Copyright', ascii_property(value, 'Copyright'))
     copyright = property(_get_copyright, _set_copyright)
 
     def _get_software(self):
         return self.camera.exif_tags.get('IFD0.Software', '')
     def _set_software(self, value):
-        if value:
-            self.camera.exif_tags['IFD0.Software'] = ascii_property(value, 'Software')
-        else:
-            self.camera.exif_tags.pop('IFD0.Software', '')
+        self._set_exif_tag('IFD0.Software', ascii_property(value, 'Software'))
     software = property(_get_software, _set_software)
 
     def _get_filename_template(self):
@@ -202,81 +433,385 @@ class PicroscopyLibrary(object):
             value.format(counter=1, date=datetime.datetime.now(), ext='.jpg')
         except KeyError as e:
             raise ValueError('Unknown value %s in template' % e)
-        self._filename_template = value
+        with self._counter_lock:
+            if value != getattr(self, '_filename_template', None):
+                # Existing counters are only meaningful for the template that
+                # produced them, so re-seed the counter from the index
+                self.counter = None
+            self._filename_template = value
     filename_template = property(_get_filename_template, _set_filename_template)
 
     def capture(self):
-        # Safely allocate a new filename for the image
+        # Each stage of the capture (from allocating the filename to
+        # generating the thumbnail) is timed and logged
+        stopwatch = self.camera.stopwatch()
+        with stopwatch.stage('allocate'):
+            filename = self._allocate_filename(self.format)
+        try:
+            # Capture to memory and render the image outside the camera's
+            # queue; _store writes the result straight to the file. The lock
+            # must not be held while waiting for the camera as it may be busy
+            # with a sequence whose frames need the lock to be stored
+            with stopwatch.stage('sensor'):
+                data = self.camera_queue.call(
+                    lambda camera: camera.capture_frame())
+            data, img = self.camera.render(data, self.format, stopwatch)
+            self._store(filename, data, img, stopwatch)
+        except:
+            self._abandon(filename)
+            raise
+        logging.info(
+            'Captured %s in %.3fs (%s)', os.path.basename(filename),
+            stopwatch.elapsed, stopwatch)
+
+    def capture_sequence(self, count, interval=0, callback=None):
+        # Start capturing count images, interval seconds apart, returning a
+        # CaptureJob to track progress. The sequence runs in a thread of its
+        # own which queues a camera command for each image (so that other
+        # commands, like changing settings or starting the live view, aren't
+        # held up until the sequence ends), handing each image to a pool of
+        # threads which encode it, write it, and generate its thumbnail; hence
+        # the interval isn't bounded by the time taken to process each image.
+        # The optional callback is called with the job when it finishes
+        if count < 1:
+            raise ValueError('Invalid count: %d' % count)
+        if interval < 0:
+            raise ValueError('Invalid interval: %g' % interval)
+        job = CaptureJob(
+            next(self._capture_counter), count, interval, self.format, callback)
+        with self._lock:
+            self.capture_jobs[job.id] = job
+            while len(self.capture_jobs) > 50:
+                id, old = next(iter(self.capture_jobs.items()))
+                if old.finished is None:
+                    break
+                del self.capture_jobs[id]
+        job.thread = threading.Thread(target=self._capture_sequence, args=(job,))
+        job.thread.daemon = True
+        job.thread.start()
+        return job
+
+    def _capture_sequence(self, job):
+        # Bound the number of images waiting to be processed so a slow
+        # pipeline can't exhaust memory (the interval stretches instead)
+        job.capture_started()
+        pending = threading.Semaphore(self.processor_workers * 2)
+        try:
+            for index in range(job.count):
+                with self.metrics.timer(
+                        'picroscopy_capture_stage_seconds', stage='sensor'):
+                    data = self.camera_queue.call(
+                        lambda camera: camera.capture_frame())
+                with self.metrics.timer(
+                        'picroscopy_capture_stage_seconds', stage='allocate'):
+                    filename = self._allocate_filename(job.format)
+                pending.acquire()
+                job.frame_captured()
+                future = self.processor.submit(
+                    self._process_frame, job, data, filename)
+                future.add_done_callback(lambda f: pending.release())
+                if index + 1 >= job.count:
+                    break
+                # Schedule captures relative to the start of the sequence so
+                # that delays don't accumulate
+                delay = job.started + (index + 1) * job.interval - time.time()
+                if delay < 0 and job.interval:
+                    logging.warning(
+                        'Capture %d of %d is %.1fs late',
+                        index + 2, job.count, -delay)
+                if job.stop.wait(max(0, delay)):
+                    break
+        except Exception as e:
+            logging.exception('Error capturing sequence %d', job.id)
+            job.capture_finished(e)
+        else:
+            job.capture_finished()
+
+    def _process_frame(self, job, data, filename):
+        image = os.path.basename(filename)
+        try:
+            stopwatch = self.camera.stopwatch()
+            data, img = self.camera.render(data, job.format, stopwatch)
+            self._store(filename, data, img, stopwatch)
+            logging.debug(
+                'Processed %s in %.3fs (%s)', image, stopwatch.elapsed,
+                stopwatch)
+        except Exception as e:
+            logging.exception('Error processing %s', image)
+            self._abandon(filename)
+            job.frame_failed(e)
+        else:
+            job.frame_processed(image)
+
+    def _allocate_filename(self, format):
+        # Safely allocate a new filename for an image of the given format,
+        # creating an empty placeholder file to reserve it. The counter is
+        # seeded from the index (after a reset or a change of template) and
+        # then kept in memory, so normally the first name tried is free; the
+        # loop only handles files created behind the index's back. Captures,
+        # sequences, and requests all allocate names concurrently, hence the
+        # lock around the counter
         date = datetime.datetime.now()
-        ext = self.format_extensions[self.format]
-        while True:
-            filename = os.path.join(
-                self.images_dir,
-                self.filename_template.format(
-                    date=date, counter=self.counter, ext=ext)
-                )
+        ext = self.format_extensions[format]
+        with self._counter_lock:
+            if self.counter is None:
+                self.counter = self._last_counter(date) + 1
+            while True:
+                filename = os.path.join(
+                    self.images_dir,
+                    self.filename_template.format(
+                        date=date, counter=self.counter, ext=ext)
+                    )
+                try:
+                    # XXX mode 'x' is only available in Py3.3+
+                    fd = os.open(filename, os.O_CREAT | os.O_EXCL)
+                except OSError:
+                    self.counter += 1
+                else:
+                    os.close(fd)
+                    self.counter += 1
+                    return filename
+
+    def _last_counter(self, date):
+        # Return the largest counter of the images in the index whose names
+        # match the filename template on the specified date (with any of the
+        # library's extensions), or 0 if there are none. The template is
+        # converted to a regex in which the counter is a group of digits
+        pattern = []
+        for literal, field, spec, conversion in string.Formatter().parse(
+                self.filename_template):
+            pattern.append(re.escape(literal))
+            if field == 'counter':
+                pattern.append(r'(\d+)')
+            elif field == 'ext':
+                pattern.append('(?:%s)' % '|'.join(
+                    re.escape(ext) for ext in self.extensions))
+            elif field is not None:
+                pattern.append(re.escape(
+                    ('{%s:%s}' % (field, spec)).format(date=date)))
+        if not r'(\d+)' in pattern:
+            return 0
+        pattern = re.compile(''.join(pattern) + '$')
+        result = 0
+        for image in self.index:
+            match = pattern.match(image)
+            if match:
+                result = max(result, int(match.group(1)))
+        return result
+
+    def _store(self, filename, data, img, stopwatch=None):
+        # Write the image and add it to the index together, so that the
+        # watcher doesn't mistake the new file for an external addition and
+        # queue a redundant thumbnail for it
+        if stopwatch is None:
+            stopwatch = self.camera.stopwatch()
+        image = os.path.basename(filename)
+        with stopwatch.stage('store'):
+            with self._lock:
+                with io.open(filename, 'wb') as f:
+                    f.write(data)
+                self.index.add(image)
+        # The camera has already decoded the image, so generating the
+        # thumbnail from that is far cheaper than re-reading the file later
+        thumb = self._rendition_path(image, 'thumb')
+        # The image is stored by this point, so a failure here mustn't fail
+        # the capture; the thumbnail is simply generated later instead
+        try:
+            with stopwatch.stage('thumbnail'):
+                save_thumbnail(img, thumb, self.thumbs_size)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to save thumbnail of %s: %s', image, e)
+            self._queue_rendition(image, 'thumb', PRIORITY_NORMAL)
+        except Exception:
+            logging.exception('Unable to save thumbnail of %s', image)
+            self._queue_rendition(image, 'thumb', PRIORITY_NORMAL)
+        else:
+            self.renditions_cache.add(thumb)
+
+    def _abandon(self, filename):
+        # Remove an image whose capture failed (which may be no more than the
+        # empty placeholder reserving its name) along with any index entry,
+        # so the library never lists a file that doesn't exist
+        with self._lock:
             try:
-                # XXX mode 'x' is only available in Py3.3+
-                fd = os.open(filename, os.O_CREAT | os.O_EXCL)
+                os.unlink(filename)
             except OSError:
-                self.counter += 1
-            else:
-                os.close(fd)
-                break
-        self.camera.capture(filename, self.format)
+                pass
+            self.index.discard(os.path.basename(filename))
 
     def remove(self, image):
+        try:
+            self._remove_files(image)
+        finally:
+            self.index.discard(image)
+
+    def clear(self):
+        # Rather than updating (and persisting) the index once per image, just
+        # rescan the (hopefully now empty) directory at the end
+        try:
+            for f in self:
+                self._remove_files(f)
+        finally:
+            self.index.rebuild()
+
+    def _remove_files(self, image):
         try:
             os.unlink(os.path.join(self.images_dir, image))
         except OSError:
             raise KeyError(image)
+        self._invalidate(image)
+
+    def _invalidate(self, image):
+        # Throw away everything derived from the image
+        self._exif_cache.pop(image, None)
+        self._crc_cache.pop(os.path.join(self.images_dir, image), None)
+        for rendition in self.renditions:
+            self.renditions_cache.discard(self._rendition_path(image, rendition))
+
+    def refresh(self, image):
+        # Called (by the watcher) when image may have been added, modified or
+        # removed by something other than the library
+        if not image.endswith(self.extensions):
+            return
+        with self._lock:
+            self._refresh(image)
+
+    def _refresh(self, image):
         try:
-            os.unlink(os.path.join(self.thumbs_dir, image))
-        except OSError as e:
-            if e.errno != 2:
-                raise
-
-    def clear(self):
-        for f in self:
-            self.remove(f)
-
-    def archive(self):
-        data = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        # DEFLATE is basically ineffective with JPEGs, so use STORED
-        with zipfile.ZipFile(data, 'w', compression=zipfile.ZIP_STORED) as archive:
-            for f in self:
-                archive.write(os.path.join(self.images_dir, f), f)
-        data.seek(0)
-        return data
+            st = os.stat(os.path.join(self.images_dir, image))
+        except OSError:
+            st = None
+        # Empty files are treated as absent; capture() creates an empty
+        # placeholder while the camera is busy and external copies typically
+        # start out empty too
+        if st is None or not st.st_size:
+            if image in self.index:
+                self.index.discard(image)
+                self._invalidate(image)
+            return
+        try:
+            entry = self.index[image]
+        except KeyError:
+            pass
+        else:
+            if (entry.size, entry.mtime) == (st.st_size, st.st_mtime):
+                return
+        self._invalidate(image)
+        self.index.add(image)
+        self._queue_rendition(image, 'thumb', PRIORITY_LOW)
+
+    def rebuild(self):
+        # Called (by the watcher) when it has lost track of changes
+        self._exif_cache.clear()
+        self._crc_cache.clear()
+        self.index.rebuild()
+
+    def select(self, images=None, first=None, last=None, since=None, until=None):
+        # Return the filenames of the images matching all the criteria given:
+        # images is a collection of filenames, first and last bound the
+        # filenames (inclusively; with the default template this is a range
+        # of dates and counters), and since and until bound the times at which
+        # the images were added to the library or last changed (their ctimes,
+        # exclusively and inclusively respectively, so that the latest time of
+        # one selection can be used as since for the next). Modification times
+        # can't be used for this as files copied in from elsewhere keep their
+        # original ones. Only the index is consulted; no files are examined
+        result = []
+        for image in self:
+            if images is not None and image not in images:
+                continue
+            if first is not None and image < first:
+                continue
+            if last is not None and image > last:
+                continue
+            if since is not None or until is not None:
+                try:
+                    ctime = self.index[image].ctime
+                except KeyError:
+                    continue # removed since we started iterating
+                if since is not None and ctime <= since:
+                    continue
+                if until is not None and ctime > until:
+                    continue
+            result.append(image)
+        return result
+
+    def archive(self, images=None):
+        # Archive the specified images (or the whole library if images is
+        # None). DEFLATE is basically ineffective with JPEGs, so the archive
+        # is STORED which means its size is known up front from the index and
+        # it can be streamed straight from the images without a temporary
+        # file. CRCs are cached so that resuming a download part way through
+        # doesn't require re-reading every image before the resumption point
+        if images is None:
+            images = self
+        entries = []
+        for image in images:
+            try:
+                entries.append(self.index[image])
+            except KeyError:
+                pass # removed since we started iterating
+        return ZipStream((
+            (
+                entry.filename,
+                os.path.join(self.images_dir, entry.filename),
+                entry.size,
+                entry.mtime,
+                )
+            for entry in entries
+            ), crc_cache=self._crc_cache)
 
-    def send(self, address=None):
+    def send(self, address=None, callback=None):
+        # Queue the library for sending to address in the background,
+        # returning the SendJob. The optional callback is called with the job
+        # when it has been sent (or has failed)
         if address is None:
             address = self.email
         if not address:
             raise ValueError('No e-mail address specified')
-        # Construct the multi-part email message
-        msg = MIMEMultipart()
-        msg['From'] = self.email_from
-        msg['To'] = address
-        msg['Subject'] = 'Picroscopy: %d image(s)' % len(self)
-        body = [
-            'Please find attached %d image(s) from Picroscopy:' % len(self),
-            '',
-            ]
-        body.extend(image for image in self)
-        body = '\n'.join(body)
-        msg.attach(MIMEText(body))
-        for image in self:
-            f = self.open_image(image)
-            msg.attach(MIMEImage(f.read()))
-        if self.smtp_server:
-            s = smtplib.SMTP(*self.smtp_server)
-            s.send_message(msg)
-            s.quit()
-        else:
-            with subprocess.Popen(
-                    [self.sendmail, '-t', '-oi'], stdin=subprocess.PIPE) as proc:
-                proc.communicate(msg.as_string().encode('ascii'))
+        spool = tempfile.mkdtemp(dir=self.outbox_dir)
+        try:
+            attachments = []
+            for image in self:
+                try:
+                    entry = self.index[image]
+                except KeyError:
+                    continue # removed since we started iterating
+                path = os.path.join(spool, image)
+                self._spool_image(os.path.join(self.images_dir, image), path)
+                attachments.append(Attachment(image, path, entry.size))
+        except:
+            shutil.rmtree(spool, ignore_errors=True)
+            raise
+        # Messages are generated as they're sent, reading and encoding the
+        # images a chunk at a time, so neither the images nor the encoded
+        # message are ever held in memory in their entirety. Libraries larger
+        # than the limit are split into several messages, sized with the line
+        # endings they'll be sent with (SMTP requires CRLF)
+        newline = b'\r\n' if self.smtp_server else b'\n'
+        groups = split_attachments(attachments, self.email_limit, newline)
+        messages = []
+        for number, group in enumerate(groups, start=1):
+            subject = 'Picroscopy: %d image(s)' % len(group)
+            if len(groups) > 1:
+                subject += ' (part %d of %d)' % (number, len(groups))
+            body = [
+                'Please find attached %d image(s) from Picroscopy:' % len(group),
+                '',
+                ]
+            body.extend(attachment.filename for attachment in group)
+            messages.append(MailMessage(
+                self.email_from, address, subject, '\n'.join(body), group,
+                newline=newline))
+        return self.mailer.submit(address, messages, spool, callback)
+
+    def _spool_image(self, source, target):
+        # Hard links are free, but not every filesystem (e.g. FAT on a USB
+        # stick) supports them
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
 
     def stat_image(self, image):
         if not image in self:
@@ -291,35 +826,132 @@ class PicroscopyLibrary(object):
     def open_image_exif(self, image):
         if not image in self:
             raise KeyError(image)
-        image = os.path.join(self.images_dir, image)
-        p = subprocess.Popen(
-            ['exiftool', '-j', image],
-            stdin=None, stdout=subprocess.PIPE, stderr=None,
-            bufsize=-1)
-        out, err = p.communicate()
-        assert p.returncode == 0
-        return json.loads(out.decode('utf-8'))[0]
+        # Parsing is cheap compared to exiftool, but the image page is viewed
+        # far more often than images change, so cache the result against the
+        # stat of the file
+        path = os.path.join(self.images_dir, image)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        try:
+            cached_key, result = self._exif_cache[image]
+        except KeyError:
+            pass
+        else:
+            if cached_key == key:
+                return dict(result)
+        with self.metrics.timer(
+                'picroscopy_phase_duration_seconds', phase='exif'):
+            result = self._read_image_exif(path, st)
+        self._exif_cache[image] = (key, result)
+        return dict(result)
+
+    def _read_image_exif(self, path, st):
+        # A damaged or truncated file mustn't break the image page, so if the
+        # image (or its EXIF data) can't be read, the page just shows less
+        result = {
+            'SourceFile':     path,
+            'FileName':       os.path.basename(path),
+            'Directory':      os.path.dirname(path),
+            'FileSize':       exiftool_size(st.st_size),
+            'FileModifyDate': datetime.datetime.fromtimestamp(
+                st.st_mtime).strftime('%Y:%m:%d %H:%M:%S'),
+            }
+        with io.open(path, 'rb') as f:
+            try:
+                exif = read_exif(f)
+            except (ValueError, struct.error) as e:
+                logging.warning('Unable to read EXIF data in %s: %s', path, e)
+                exif = None
+            f.seek(0)
+            try:
+                img = Image.open(f)
+            except (IOError, OSError, ValueError, SyntaxError) as e:
+                logging.warning('Unable to read image %s: %s', path, e)
+            else:
+                result.update({
+                    'FileType':    img.format,
+                    'MIMEType':    Image.MIME.get(
+                        img.format, 'application/octet-stream'),
+                    'ImageWidth':  img.size[0],
+                    'ImageHeight': img.size[1],
+                    'ImageSize':   '%dx%d' % img.size,
+                    })
+        if exif:
+            try:
+                result.update(exiftool_tags(parse_exif(exif)))
+            except (ValueError, struct.error) as e:
+                logging.warning('Unable to parse EXIF data in %s: %s', path, e)
+        return result
 
     def stat_thumbnail(self, image):
-        if not image in self:
-            raise KeyError(image)
-        self._generate_thumbnail(image)
-        return os.stat(os.path.join(self.thumbs_dir, image))
+        return self.stat_rendition(image, 'thumb')
 
     def open_thumbnail(self, image):
+        return self.open_rendition(image, 'thumb')
+
+    def stat_rendition(self, image, rendition):
+        with self.open_rendition(image, rendition) as f:
+            return os.fstat(f.fileno())
+
+    def open_rendition(self, image, rendition):
+        # Another thread may evict the rendition from the cache at any moment,
+        # so callers wanting its size or mtime should fstat the file returned
+        # rather than stat its path. If it's evicted between being generated
+        # and opened here, it's simply generated again
         if not image in self:
             raise KeyError(image)
-        self._generate_thumbnail(image)
-        return io.open(os.path.join(self.thumbs_dir, image), 'rb')
-
-    def _generate_thumbnail(self, image):
-        thumb = os.path.join(self.thumbs_dir, image)
-        image = os.path.join(self.images_dir, image)
-        if (
-                not os.path.exists(thumb) or
-                os.stat(thumb).st_mtime < os.stat(image).st_mtime
-                ):
-            im = Image.open(image)
-            im.thumbnail(self.thumbs_size, Image.ANTIALIAS)
-            im.save(thumb, format='JPEG', optimize=True, progressive=True)
-
+        path = self._rendition_path(image, rendition)
+        for attempt in range(3):
+            self._generate_rendition(image, rendition)
+            try:
+                f = io.open(path, 'rb')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                self.renditions_cache.touch(path)
+                return f
+        raise ThumbnailError(
+            'The %s of %s was repeatedly evicted before it could be '
+            'opened' % (rendition, image))
+
+    def _rendition_path(self, image, rendition):
+        if not rendition in self.renditions:
+            raise KeyError(rendition)
+        return os.path.join(self.thumbs_dir, rendition, image)
+
+    def _generate_rendition(self, image, rendition):
+        # If the rendition isn't ready, bump it to the front of the queue and
+        # wait for it (but not forever; the request thread waiting is needed
+        # for other requests)
+        if not self._rendition_current(image, rendition):
+            with self.metrics.timer(
+                    'picroscopy_phase_duration_seconds', phase='thumbnail'):
+                future = self._queue_rendition(image, rendition, PRIORITY_HIGH)
+                try:
+                    future.result(self.rendition_timeout)
+                except TimeoutError:
+                    raise ThumbnailError(
+                        'The %s of %s was not generated within %g seconds' % (
+                            rendition, image, self.rendition_timeout))
+
+    def _rendition_current(self, image, rendition):
+        try:
+            return (
+                os.stat(self._rendition_path(image, rendition)).st_mtime >=
+                self.index[image].mtime)
+        except OSError:
+            return False
+
+    def _queue_rendition(self, image, rendition, priority):
+        # Jobs are keyed on the image's mtime so that a job for an image that
+        # has since been replaced isn't mistaken for a current one
+        path = self._rendition_path(image, rendition)
+        future = self.thumbnailer.submit(
+            (image, rendition, self.index[image].mtime),
+            os.path.join(self.images_dir, image), path,
+            self.renditions[rendition], priority)
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception() or
+            self.renditions_cache.add(path))
+        return future
@@ -0,0 +1,491 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines :class:`MailMessage`, a multi-part e-mail with file
+attachments which is generated a chunk at a time as it is sent, rather than
+being constructed in memory. The attachments are read and base64 encoded a
+block at a time, so the memory required to send a message is independent of
+the size of its attachments.
+
+The :func:`split_attachments` function divides a list of attachments into
+groups small enough to be sent as separate messages, while
+:func:`send_sendmail` and :func:`send_smtp` send a message via a sendmail
+binary or an SMTP connection respectively.
+
+Messages are normally sent by a :class:`MailQueue`, which sends them from a
+background thread (so that a web request need not wait for a potentially
+slow mail server), retrying with exponential backoff when sending fails.
+"""
+
+import io
+import time
+import uuid
+import heapq
+import base64
+import shutil
+import smtplib
+import logging
+import mimetypes
+import threading
+import itertools
+import subprocess
+from email.header import Header
+from email.utils import (
+    formatdate,
+    formataddr,
+    parseaddr,
+    make_msgid,
+    encode_rfc2231,
+    )
+from collections import namedtuple, OrderedDict
+
+
+# base64 encodes each 57 bytes of input as a 76 character line
+LINE_BYTES = 57
+CHUNK_SIZE = LINE_BYTES * 1024
+
+Attachment = namedtuple('Attachment', ('filename', 'path', 'size'))
+
+
+def encoded_size(size, newline=b'\n'):
+    """
+    Returns the number of bytes that *size* bytes occupy when base64 encoded
+    in lines terminated by *newline*.
+    """
+    lines = (size + LINE_BYTES - 1) // LINE_BYTES
+    return (size + 2) // 3 * 4 + lines * len(newline)
+
+
+def split_attachments(attachments, limit, newline=b'\n'):
+    """
+    Divides the sequence of *attachments* into lists whose total encoded size
+    (in lines terminated by *newline*, which should match the messages they
+    will be sent in) does not exceed *limit* bytes (or never, if *limit* is
+    0). An attachment which by itself exceeds *limit* is placed in a list on
+    its own.
+    """
+    result = []
+    group = []
+    group_size = 0
+    for attachment in attachments:
+        size = encoded_size(attachment.size, newline)
+        if group and limit and group_size + size > limit:
+            result.append(group)
+            group = []
+            group_size = 0
+        group.append(attachment)
+        group_size += size
+    if group:
+        result.append(group)
+    return result
+
+
+class MailMessage(object):
+    """
+    A ``multipart/mixed`` message from *sender* to *recipient* with the
+    specified *subject* and plain text *body*, followed by *attachments* (a
+    sequence of :class:`Attachment` tuples). Iterating over the message yields
+    its content as a series of byte strings, with lines terminated by
+    *newline*.
+    """
+
+    def __init__(self, sender, recipient, subject, body, attachments,
+            newline=b'\n'):
+        super().__init__()
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.attachments = attachments
+        self.newline = newline
+        # The boundary can't occur in base64 encoded content as it contains a
+        # run of "=" characters
+        self.boundary = '===============%s==' % uuid.uuid4().hex
+
+    def __iter__(self):
+        yield self._headers((
+            ('From', self._address(self.sender)),
+            ('To', self._address(self.recipient)),
+            ('Subject', self._text(self.subject)),
+            ('Date', formatdate(localtime=True)),
+            ('Message-ID', make_msgid()),
+            ('MIME-Version', '1.0'),
+            ('Content-Type', 'multipart/mixed; boundary="%s"' % self.boundary),
+            ))
+        yield self._part_headers((
+            ('Content-Type', 'text/plain; charset="utf-8"'),
+            ('Content-Transfer-Encoding', 'base64'),
+            ))
+        yield self._encode(self.body.encode('utf-8'))
+        for attachment in self.attachments:
+            content_type = (
+                mimetypes.guess_type(attachment.filename)[0] or
+                'application/octet-stream')
+            yield self._part_headers((
+                ('Content-Type', content_type),
+                ('Content-Transfer-Encoding', 'base64'),
+                ('Content-Disposition', 'attachment; %s' % self._filename_param(
+                    attachment.filename)),
+                ))
+            with io.open(attachment.path, 'rb') as f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield self._encode(data)
+        yield ('--%s--' % self.boundary).encode('ascii') + self.newline
+
+    def _headers(self, headers):
+        return b''.join(
+            ('%s: %s' % (name, value)).encode('ascii') + self.newline
+            for name, value in headers
+            ) + self.newline
+
+    def _text(self, value):
+        # Headers must be ASCII; anything else is sent as RFC2047 encoded
+        # words
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            return Header(value, 'utf-8').encode(
+                linesep=self.newline.decode('ascii'))
+        else:
+            return value
+
+    def _address(self, value):
+        # Only the display name of an address can be encoded; the address
+        # itself must be ASCII
+        name, address = parseaddr(value)
+        try:
+            address.encode('ascii')
+        except UnicodeEncodeError:
+            raise ValueError('Non-ASCII e-mail address %s' % address)
+        if not name:
+            return value
+        return formataddr((name, address))
+
+    def _part_headers(self, headers):
+        return (
+            ('--%s' % self.boundary).encode('ascii') + self.newline +
+            self._headers(headers))
+
+    def _filename_param(self, filename):
+        try:
+            filename.encode('ascii')
+        except UnicodeEncodeError:
+            return "filename*=%s" % encode_rfc2231(filename, 'utf-8')
+        else:
+            return 'filename="%s"' % filename.replace('\\', '\\\\').replace('"', '\\"')
+
+    def _encode(self, data):
+        # data is always a multiple of LINE_BYTES long (except at the end of
+        # a file) so each chunk produces only complete lines
+        result = base64.encodebytes(data)
+        if self.newline != b'\n':
+            result = result.replace(b'\n', self.newline)
+        return result
+
+
+def send_sendmail(sendmail, message):
+    """
+    Sends *message* by piping it to the *sendmail* binary, which determines
+    the recipients from the message's headers. Raises
+    :exc:`~subprocess.CalledProcessError` if sendmail fails.
+    """
+    cmd = [sendmail, '-t', '-oi']
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE) as proc:
+        try:
+            for chunk in message:
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def send_smtp(smtp, message):
+    """
+    Sends *message* over the connected :class:`smtplib.SMTP` instance *smtp*.
+    The message must have been constructed with CRLF line endings. Unlike
+    :meth:`smtplib.SMTP.sendmail`, the message is written to the connection a
+    chunk at a time rather than being passed in its entirety.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(message.sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, resp, message.sender)
+    code, resp = smtp.rcpt(message.recipient)
+    if code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({message.recipient: (code, resp)})
+    code, resp = smtp.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    # No line of the message can begin with "." (every line is a header, a
+    # boundary, or base64) so there's no need to escape them here
+    for chunk in message:
+        smtp.send(chunk)
+    smtp.send(b'.\r\n')
+    code, resp = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+
+
+QUEUED = 'queued'
+SENDING = 'sending'
+WAITING = 'waiting'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class SendJob(object):
+    """
+    Represents the sending of one or more *messages* to *address* by a
+    :class:`MailQueue`. The :attr:`state` attribute is one of ``'queued'``,
+    ``'sending'``, ``'waiting'`` (for a retry), ``'sent'``, or ``'failed'``;
+    in the latter case :attr:`error` describes the last failure.
+    """
+
+    def __init__(self, id, address, messages, spool=None, callback=None):
+        super().__init__()
+        self.id = id
+        self.address = address
+        self.messages = messages
+        self.spool = spool
+        self.callback = callback
+        self.images = sum(len(message.attachments) for message in messages)
+        self.state = QUEUED
+        self.attempts = 0
+        self.sent = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            'id':       self.id,
+            'address':  self.address,
+            'images':   self.images,
+            'messages': len(self.messages),
+            'sent':     self.sent,
+            'state':    self.state,
+            'attempts': self.attempts,
+            'error':    self.error,
+            'created':  self.created,
+            'finished': self.finished,
+            }
+
+
+class MailQueue(object):
+    """
+    Sends messages in the background, via the *smtp_server* (a ``(host,
+    port)`` tuple) if one is given, or the *sendmail* binary otherwise.
+
+    Jobs which fail with a temporary error are retried up to *retries* times,
+    waiting *backoff* seconds before the first retry and doubling the wait
+    each time. A single SMTP connection is kept open and re-used for
+    successive jobs until it has been idle for *idle* seconds. The most recent
+    *history* jobs remain available (by ID) after they finish so that their
+    status can be queried.
+    """
+
+    def __init__(self, sendmail='/usr/sbin/sendmail', smtp_server=None,
+            retries=5, backoff=30.0, idle=60.0, history=50):
+        super().__init__()
+        self.sendmail = sendmail
+        self.smtp_server = smtp_server
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = idle
+        self.history = history
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._counter = itertools.count(1)
+        self._heap = []
+        self._jobs = OrderedDict()
+        self._smtp = None
+        self._smtp_used = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getitem__(self, id):
+        with self._lock:
+            return self._jobs[id]
+
+    @property
+    def depth(self):
+        with self._lock:
+            return len(self._heap)
+
+    def submit(self, address, messages, spool=None, callback=None):
+        """
+        Queue *messages* (a sequence of :class:`MailMessage` instances) for
+        sending to *address*, returning a :class:`SendJob`. When the job
+        finishes, the directory *spool* (if given) will be removed, and
+        *callback* (if given) will be called with the job.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Mail queue is closed')
+            job = SendJob(next(self._counter), address, messages, spool, callback)
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (time.time(), job.id, job))
+            self._ready.notify()
+            return job
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+        for due, id, job in self._heap:
+            logging.warning(
+                'Abandoning e-mail to %s (job %d)', job.address, job.id)
+            self._cleanup(job)
+        self._heap = []
+        self._disconnect()
+
+    def _run(self):
+        while True:
+            job = None
+            with self._lock:
+                while not self._closed:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        due, id, job = heapq.heappop(self._heap)
+                        job.state = SENDING
+                        break
+                    timeouts = []
+                    if self._heap:
+                        timeouts.append(self._heap[0][0] - now)
+                    if self._smtp is not None:
+                        timeouts.append(self._smtp_used + self.idle - now)
+                        if timeouts[-1] <= 0:
+                            # The connection has been idle too long; it's
+                            # closed below, outside the lock, as QUIT is a
+                            # round trip to a server which may be slow or
+                            # unreachable
+                            break
+                    self._ready.wait(min(timeouts) if timeouts else None)
+                if self._closed:
+                    return
+            if job is None:
+                self._disconnect()
+            else:
+                self._send(job)
+
+    def _send(self, job):
+        job.attempts += 1
+        try:
+            # Only the messages which haven't been sent yet are sent; if a
+            # library was split into several messages, a retry doesn't repeat
+            # those which were successful
+            for message in job.messages[job.sent:]:
+                if self.smtp_server:
+                    send_smtp(self._connect(), message)
+                    self._smtp_used = time.time()
+                else:
+                    send_sendmail(self.sendmail, message)
+                job.sent += 1
+        except (smtplib.SMTPException, subprocess.CalledProcessError,
+                IOError, OSError) as e:
+            # Assume the connection is unusable after an error
+            self._disconnect()
+            job.error = str(e)
+            if self._permanent(e) or job.attempts > self.retries:
+                logging.error(
+                    'Failed to send e-mail to %s (job %d): %s',
+                    job.address, job.id, e)
+                self._finish(job, FAILED)
+            else:
+                delay = self.backoff * 2 ** (job.attempts - 1)
+                logging.warning(
+                    'Failed to send e-mail to %s (job %d): %s; retrying in '
+                    '%d seconds', job.address, job.id, e, delay)
+                with self._lock:
+                    job.state = WAITING
+                    heapq.heappush(self._heap, (time.time() + delay, job.id, job))
+        except Exception as e:
+            # Anything else is a bug (or e.g. an unencodable address) which
+            # retrying won't fix; fail the job rather than let the exception
+            # kill the thread and strand every job queued after it
+            logging.exception(
+                'Failed to send e-mail to %s (job %d)', job.address, job.id)
+            self._disconnect()
+            job.error = str(e)
+            self._finish(job, FAILED)
+        else:
+            logging.info(
+                'Sent %d image(s) to %s (job %d)',
+                job.images, job.address, job.id)
+            job.error = None
+            self._finish(job, SENT)
+
+    def _permanent(self, e):
+        # SMTP 5xx responses won't succeed no matter how many times they're
+        # retried (e.g. an unknown recipient, or a message that's too large)
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, resp in e.recipients.values())
+        if isinstance(e, smtplib.SMTPResponseException):
+            return e.smtp_code >= 500
+        return False
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished = time.time()
+        self._cleanup(job)
+        with self._lock:
+            while len(self._jobs) > self.history:
+                id, old = next(iter(self._jobs.items()))
+                if old.finished is None:
+                    break
+                del self._jobs[id]
+        if job.callback is not None:
+            try:
+                job.callback(job)
+            except Exception:
+                logging.exception('Error in callback for job %d', job.id)
+
+    def _cleanup(self, job):
+        if job.spool:
+            shutil.rmtree(job.spool, ignore_errors=True)
+            job.spool = None
+
+    def _connect(self):
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, IOError, OSError):
+                pass
+            self._disconnect()
+        self._smtp = smtplib.SMTP(*self.smtp_server)
+        return self._smtp
+
+    def _disconnect(self):
+        # The connection is only used by the background thread (or by close()
+        # once that thread has finished) so this never needs the lock; it
+        # mustn't be called with it held as QUIT may block
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, IOError, OSError):
+                pass
+            self._smtp = None
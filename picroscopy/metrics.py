@@ -0,0 +1,319 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides the instrumentation used to find out where Picroscopy
+spends its time. :class:`Metrics` is a registry of latency histograms (e.g.
+of requests, or of phases of handling them like rendering templates) and of
+gauges (e.g. the depth of the thumbnail queue), which can be rendered in the
+`Prometheus`_ text format. :class:`MetricsMiddleware` is WSGI middleware which
+records the latency of every request in such a registry, and can optionally
+profile individual requests.
+
+.. _Prometheus: http://prometheus.io/
+"""
+
+import io
+import time
+import bisect
+import cProfile
+import pstats
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Upper bounds (in seconds) of the buckets of latency histograms; the range is
+# wide as a Pi takes a while over some things (and long exposures take longer)
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    )
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with the upper bounds given by *buckets*
+    (plus an implicit final bucket for everything larger), and tracks their
+    count and sum.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        super().__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    A registry of histograms, each identified by a name and a set of labels,
+    and of gauges whose values are read from callables when the registry is
+    rendered by :meth:`render`.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        super().__init__()
+        self.buckets = buckets
+        self._help = {}
+        self._histograms = OrderedDict()
+        self._gauges = OrderedDict()
+        self._lock = threading.Lock()
+
+    def describe(self, name, help):
+        """
+        Set the help text for the histogram *name*.
+        """
+        self._help[name] = help
+
+    def observe(self, name, value, **labels):
+        """
+        Record *value* in the histogram *name* with the specified *labels*.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        A context manager which records the time spent within it in the
+        histogram *name* with the specified *labels*.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def summary(self, name):
+        """
+        Return a list of ``(labels, count, sum)`` tuples for each histogram
+        named *name*, where *labels* is a dict of the histogram's labels.
+        """
+        with self._lock:
+            return [
+                (dict(labels), h.count, h.sum)
+                for (h_name, labels), h in self._histograms.items()
+                if h_name == name
+                ]
+
+    def gauge(self, name, help, func, type='gauge'):
+        """
+        Register the gauge *name*, whose value is returned by *func*. The
+        *type* may be set to ``'counter'`` for values which only increase.
+        """
+        self._gauges[name] = (help, type, func)
+
+    def render(self):
+        """
+        Return the content of the registry in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            histograms = [
+                (name, labels, list(h.counts), h.count, h.sum)
+                for (name, labels), h in self._histograms.items()
+                ]
+        described = set()
+        for name, labels, counts, count, total in sorted(
+                histograms, key=lambda h: h[0]):
+            if not name in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, bucket_count in zip(
+                    self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    name, self._labels(labels + (('le', _float(bound)),)),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (name, self._labels(labels), _float(total)))
+            lines.append('%s_count%s %d' % (name, self._labels(labels), count))
+        for name, (help, type, func) in self._gauges.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            lines.append('%s %s' % (name, _float(func())))
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for key, value in labels)
+
+
+def _float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Stopwatch(object):
+    """
+    Times the stages of a single operation (e.g. capturing an image). The
+    duration of each stage is recorded in the histogram *name* of *metrics*,
+    labelled with the stage, and the total time spent in each stage of this
+    operation is kept in :attr:`stages` so the operation's breakdown can be
+    logged.
+    """
+
+    def __init__(self, metrics, name):
+        super().__init__()
+        self.metrics = metrics
+        self.name = name
+        self.stages = OrderedDict()
+        self.started = time.time()
+
+    def __str__(self):
+        return ', '.join(
+            '%s %.3fs' % (stage, elapsed)
+            for stage, elapsed in self.stages.items())
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        A context manager timing the stage named *stage*.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+            self.metrics.observe(self.name, elapsed, stage=stage)
+
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware which records the latency of each request to *app* in
+    *metrics*, from the request's arrival to the end of its body, along with
+    the time taken to stream the body (as the ``stream`` phase). Requests are
+    labelled with the value of the ``picroscopy.route`` key in the environment
+    (which *app* is expected to set), and the response's status.
+
+    If *profile* is True, requests with ``profile=1`` in their query string
+    are run under :mod:`cProfile`, and the response is replaced by a report of
+    the profile.
+    """
+
+    def __init__(self, app, metrics, profile=False):
+        super().__init__()
+        self.app = app
+        self.metrics = metrics
+        self.profile = profile
+        metrics.describe(
+            'picroscopy_request_duration_seconds',
+            'Time taken to respond to requests, including streaming the body')
+        metrics.describe(
+            'picroscopy_phase_duration_seconds',
+            'Time taken by phases of handling requests')
+
+    def __call__(self, environ, start_response):
+        if self.profile and 'profile=1' in environ.get('QUERY_STRING', '').split('&'):
+            return self.profile_request(environ, start_response)
+        start = time.time()
+        status = []
+        def _start_response(s, headers, exc_info=None):
+            status[:] = [s.split(' ', 1)[0]]
+            return start_response(s, headers, exc_info)
+        result = self.app(environ, _start_response)
+        return TimedIterable(result, lambda started, finished: (
+            self.metrics.observe(
+                'picroscopy_phase_duration_seconds', finished - started,
+                phase='stream'),
+            self.metrics.observe(
+                'picroscopy_request_duration_seconds', finished - start,
+                route=environ.get('picroscopy.route', 'unknown'),
+                status=status[0] if status else 'unknown'),
+            ))
+
+    def profile_request(self, environ, start_response):
+        """
+        Run the request (including streaming its body) under the profiler,
+        and respond with the profiler's report.
+        """
+        profiler = cProfile.Profile()
+        status = []
+        def _start_response(s, headers, exc_info=None):
+            status[:] = [s]
+            return lambda data: None
+        def run():
+            result = self.app(environ, _start_response)
+            try:
+                for chunk in result:
+                    pass
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        profiler.runcall(run)
+        report = io.StringIO()
+        report.write('%s %s: %s\n\n' % (
+            environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+            status[0] if status else 'no response'))
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats('cumulative').print_stats(50)
+        body = report.getvalue().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-cache'),
+            ])
+        return [body]
+
+
+class TimedIterable(object):
+    """
+    Wraps the WSGI response *iterable*, calling *callback* with the times at
+    which streaming the body started and finished when the server closes it.
+    """
+
+    def __init__(self, iterable, callback):
+        super().__init__()
+        self.iterable = iterable
+        self.started = None
+        self.callback = callback
+
+    def __iter__(self):
+        self.started = time.time()
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            finished = time.time()
+            self.callback(self.started or finished, finished)
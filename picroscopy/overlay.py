@@ -0,0 +1,213 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines :class:`ScaleBarRenderer` which draws scale bars on
+captured images. The geometry, label and appearance of a scale bar depend
+only on the image's size, the scale (pixels per micrometre), and the chosen
+position and style, so the complete overlay is rendered once as a small RGBA
+tile and cached. Applying the overlay to each captured image is then a single
+alpha-masked :meth:`~PIL.Image.Image.paste`.
+"""
+
+import bisect
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+
+STYLES = [
+    'white_bar',
+    'black_bar',
+    'checked_bar',
+    'white_axis',
+    'black_axis',
+    ]
+
+# The "nice" lengths (in micrometres) that a scale bar may represent
+SCALES = [
+    1, 2, 3, 4, 5,
+    10, 15, 20, 25,
+    30, 40, 50, 75,
+    100, 150, 200, 250,
+    300, 400, 500, 750,
+    ]
+
+WHITE = (255, 255, 255, 255)
+BLACK = (0, 0, 0, 255)
+
+Overlay = namedtuple('Overlay', ('tile', 'offset'))
+
+
+class ScaleBarRenderer(object):
+    """
+    Renders scale bars onto images, caching the rendered overlays of the
+    *cache_size* most recently used combinations of image size, scale,
+    position, and style. With a *cache_size* of 0, every overlay is rendered
+    from scratch.
+    """
+
+    def __init__(self, cache_size=8):
+        super().__init__()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def apply(self, image, scale, position=9, style='white_bar'):
+        """
+        Draws a scale bar on *image* (in place) for the given *scale* in
+        pixels per micrometre, at *position* (1-9, see :meth:`render`) in the
+        specified *style* (one of :data:`STYLES`).
+        """
+        overlay = self.overlay(image.size, scale, position, style)
+        image.paste(overlay.tile, overlay.offset, overlay.tile)
+
+    def overlay(self, size, scale, position=9, style='white_bar'):
+        """
+        Returns the (cached) :class:`Overlay` for an image of *size*.
+        """
+        key = (size, scale, position, style)
+        with self._lock:
+            try:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            except KeyError:
+                pass
+        overlay = self.render(size, scale, position, style)
+        if self.cache_size:
+            with self._lock:
+                self._cache[key] = overlay
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return overlay
+
+    def render(self, size, scale, position=9, style='white_bar'):
+        """
+        Renders the overlay for an image of *size*. The image is divided into
+        thirds like so, with the corresponding values of *position*::
+
+            +---------+---------+---------+
+            |   ###   |   ###   |   ###   |
+            |    1    |    2    |    3    |
+            |         |         |         |
+            +---------+---------+---------+
+            |         |         |         |
+            |   #4#   |   #5#   |   #6#   |
+            |         |         |         |
+            +---------+---------+---------+
+            |         |         |         |
+            |    7    |    8    |    9    |
+            |   ###   |   ###   |   ###   |
+            +---------+---------+---------+
+
+        The width of a cell is divided by 14 (hence the width of the image by
+        42 as 14*3=42) and this unit forms the basis of the scale bar. The
+        scale bar represents the largest "nice" length which is no more than
+        10 units wide, is 1 unit high, and is centred in its cell with its
+        label above it (or below it, for bars in the top row).
+        """
+        if not 1 <= position <= 9:
+            raise ValueError('Invalid scale position %d' % position)
+        if not style in STYLES:
+            raise ValueError('Invalid scale style %s' % style)
+        w, h = size
+        unit = w / 42
+        length = SCALES[max(0, bisect.bisect_right(SCALES, unit * 10 / scale) - 1)]
+        bar_w = max(2, int(round(length * scale)))
+        bar_h = max(2, int(round(unit)))
+        line = max(1, bar_h // 10)
+        # The default font lacks a glyph for mu, hence "um"
+        text = self._text('%d um' % length, bar_h // 2)
+        pad = line * 2
+        gap = bar_h // 4
+        tile_w = max(bar_w, text.size[0]) + pad * 2
+        tile_h = bar_h + gap + text.size[1] + pad * 2
+        xcell = (position - 1) % 3
+        ycell = (position - 1) // 3
+        label_above = ycell > 0
+        tile = Image.new('RGBA', (tile_w, tile_h), (0, 0, 0, 0))
+        bar_x = (tile_w - bar_w) // 2
+        bar_y = tile_h - pad - bar_h if label_above else pad
+        fg, bg = (BLACK, WHITE) if style.startswith('black') else (WHITE, BLACK)
+        getattr(self, '_draw_' + style.split('_')[1])(
+            ImageDraw.Draw(tile), (bar_x, bar_y, bar_x + bar_w - 1, bar_y + bar_h - 1),
+            fg, bg, line, style)
+        # The label is drawn in the bar's colour, with a contrasting outline
+        # so that it's legible against any background
+        text_x = (tile_w - text.size[0]) // 2
+        text_y = pad if label_above else bar_y + bar_h + gap
+        outline = text.filter(ImageFilter.MaxFilter(line * 2 + 1))
+        tile.paste(bg, (text_x, text_y), outline)
+        tile.paste(fg, (text_x, text_y), text)
+        # Position the tile so that the bar itself lies where described above
+        cell_w = unit * 14
+        x = int(xcell * cell_w + (cell_w - tile_w) / 2)
+        bar_bottom = (
+            unit * 2             if ycell == 0 else
+            (h + bar_h) / 2      if ycell == 1 else
+            h - unit * 2        #if ycell == 2
+            )
+        y = int(bar_bottom - bar_h - bar_y)
+        x = min(max(0, x), max(0, w - tile_w))
+        y = min(max(0, y), max(0, h - tile_h))
+        return Overlay(tile, (x, y))
+
+    def _draw_bar(self, draw, box, fg, bg, line, style):
+        # A solid bar with a contrasting outline
+        draw.rectangle(box, fill=bg)
+        left, top, right, bottom = box
+        draw.rectangle(
+            (left + line, top + line, right - line, bottom - line), fill=fg)
+        if style == 'checked_bar':
+            # Five alternating segments, like the scale on a map
+            inner = right - left - line * 2 + 1
+            for i in range(1, 5, 2):
+                draw.rectangle((
+                    left + line + inner * i // 5, top + line,
+                    left + line + inner * (i + 1) // 5 - 1, bottom - line,
+                    ), fill=bg)
+
+    def _draw_axis(self, draw, box, fg, bg, line, style):
+        # A ruler-like axis: a baseline with tall ticks at each end and in the
+        # middle, and short ticks at each tenth. Everything is drawn twice,
+        # thickened in the contrasting colour first to outline it
+        left, top, right, bottom = box
+        middle = (top + bottom) // 2
+        for colour, grow in ((bg, line), (fg, 0)):
+            draw.rectangle(
+                (left - grow, bottom - line - grow, right + grow, bottom + grow),
+                fill=colour)
+            for i in range(11):
+                x = left + (right - left - line + 1) * i // 10
+                tick_top = top if i in (0, 5, 10) else middle
+                draw.rectangle(
+                    (x - grow, tick_top - grow, x + line - 1 + grow, bottom + grow),
+                    fill=colour)
+
+    def _text(self, text, height):
+        # Render text as an "L" mask roughly height pixels tall. The default
+        # bitmap font only comes in one (small) size, so the text is rendered
+        # at that size and scaled up by a whole number of times (keeping it
+        # crisp); the result is cached with the rest of the overlay anyway
+        mask = ImageFont.load_default().getmask(text)
+        small = Image.new('L', mask.size)
+        small.putdata(list(mask))
+        factor = max(1, int(round(height / max(1, small.size[1]))))
+        return small.resize(
+            (small.size[0] * factor, small.size[1] * factor), Image.NEAREST)
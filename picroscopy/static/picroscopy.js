@@ -5,3 +5,31 @@ $('.confirmation').on('click', function() {
     return confirm('Are you sure?');
 });
 
+
+// Load further pages of the gallery (from the JSON listing) as the user
+// scrolls towards the bottom, in place of the page links
+$('ul.gallery[data-next]').each(function() {
+  var gallery = $(this);
+  var loading = false;
+  $('.library-pages').hide();
+  $(window).on('scroll resize', function() {
+    var next = gallery.attr('data-next');
+    if (loading || !next)
+      return;
+    if ($(window).scrollTop() + $(window).height() < $(document).height() - 400)
+      return;
+    loading = true;
+    $.getJSON(next, function(data) {
+      $.each(data.images, function(i, image) {
+        gallery.append($('<li>').append(
+          $('<a>').attr('href', image.view).append(
+            $('<img class="th">').attr('src', image.thumb),
+            $('<br>'),
+            document.createTextNode(image.filename))));
+      });
+      gallery.attr('data-next', data.next || '');
+      loading = false;
+      $(window).trigger('scroll');
+    });
+  }).trigger('scroll');
+});
@@ -0,0 +1,294 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the live view of the camera which is served to browsers
+as an MJPEG stream. The main class is :class:`MJPEGStream` which fans out the
+frames produced by a single source to any number of clients. A source is an
+object with ``start(publish)`` and ``stop()`` methods; once started, it calls
+``publish(frame)`` with each complete JPEG frame until stopped. Two sources are
+provided: :class:`CameraSource` which records MJPEG from the camera's video
+port, and :class:`SyntheticSource` which generates frames itself (for testing
+without a camera).
+
+The source is only running while at least one client is connected, and as
+each client is handed the latest frame whenever it's ready for another, a slow
+client simply skips frames rather than delaying the source or other clients.
+Each client occupies one of the web server's threads for as long as it's
+connected, so the number of clients may be limited to leave threads free for
+other requests.
+"""
+
+import io
+import time
+import logging
+import threading
+
+from PIL import Image, ImageDraw
+
+
+class StreamBusy(Exception):
+    """
+    Raised when a client tries to connect to a stream which already has as
+    many clients as it allows.
+    """
+
+
+class MJPEGStream(object):
+    """
+    Distributes frames from *source* to clients, each of which iterates over
+    :meth:`frames` (or :meth:`multipart` for a ready-made HTTP response body).
+    Clients give up if no frame arrives within *timeout* seconds. At most
+    *max_clients* clients may be connected at once (or any number, if it is
+    0).
+    """
+
+    boundary = 'frame'
+
+    def __init__(self, source, timeout=10.0, max_clients=0):
+        super().__init__()
+        self.source = source
+        self.timeout = timeout
+        self.max_clients = max_clients
+        self.clients = 0
+        self.published = 0
+        self.dropped = 0
+        self._frame = None
+        self._closed = False
+        self._changed = threading.Condition(threading.Lock())
+        # Serialises starting and stopping the source (which may be slow)
+        # without blocking publish()
+        self._source_lock = threading.Lock()
+        self._running = False
+
+    def publish(self, frame):
+        """
+        Make *frame* (a complete JPEG image) the latest frame, waking all
+        clients waiting for it.
+        """
+        with self._changed:
+            self._frame = frame
+            self.published += 1
+            self._changed.notify_all()
+
+    def frames(self):
+        """
+        Connects a client, returning an iterator which yields the latest frame
+        each time it is advanced (waiting for a new one if necessary). Frames
+        published while the client was busy are skipped. Closing the iterator
+        disconnects the client. Raises :exc:`StreamBusy` if :attr:`max_clients`
+        clients are already connected.
+        """
+        return MJPEGClient(self, self._frames)
+
+    def multipart(self):
+        """
+        As :meth:`frames`, but the iterator yields the parts of a
+        ``multipart/x-mixed-replace`` response body containing the frames.
+        """
+        return MJPEGClient(self, self._parts)
+
+    def _connect(self):
+        with self._changed:
+            if self.max_clients and self.clients >= self.max_clients:
+                raise StreamBusy(
+                    'The live view already has %d client(s)' % self.clients)
+            self.clients += 1
+        try:
+            self._update_source()
+        except:
+            self._disconnect()
+            raise
+
+    def _disconnect(self):
+        with self._changed:
+            self.clients -= 1
+        self._update_source()
+
+    def _frames(self):
+        seen = self.published
+        while True:
+            with self._changed:
+                if not self._changed.wait_for(
+                        lambda: self._closed or self.published != seen,
+                        self.timeout):
+                    logging.warning(
+                        'No live view frames for %g seconds', self.timeout)
+                    break
+                if self._closed:
+                    break
+                self.dropped += self.published - seen - 1
+                frame, seen = self._frame, self.published
+            yield frame
+
+    def _parts(self):
+        for frame in self._frames():
+            yield b''.join((
+                b'--', self.boundary.encode('ascii'), b'\r\n',
+                b'Content-Type: image/jpeg\r\n',
+                b'Content-Length: ', str(len(frame)).encode('ascii'), b'\r\n',
+                b'\r\n',
+                frame, b'\r\n',
+                ))
+
+    @property
+    def content_type(self):
+        return 'multipart/x-mixed-replace; boundary=%s' % self.boundary
+
+    def close(self):
+        """
+        Disconnect all clients and stop the source.
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._update_source()
+
+    def _update_source(self):
+        # Start the source when the first client connects and stop it when
+        # the last one disconnects
+        with self._source_lock:
+            with self._changed:
+                wanted = self.clients > 0 and not self._closed
+            if wanted and not self._running:
+                logging.info('Starting live view')
+                self.source.start(self.publish)
+                self._running = True
+            elif self._running and not wanted:
+                logging.info('Stopping live view')
+                self._running = False
+                self.source.stop()
+
+
+class MJPEGClient(object):
+    """
+    The iterator returned by :meth:`MJPEGStream.frames` and
+    :meth:`MJPEGStream.multipart`, wrapping the generator returned by calling
+    *frames*. The client is connected to *stream* from construction until
+    :meth:`close` is called (a generator alone can't guarantee that, as a
+    generator closed before it starts never runs its cleanup).
+    """
+
+    def __init__(self, stream, frames):
+        super().__init__()
+        stream._connect()
+        self.stream = stream
+        self._frames = frames()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._frames)
+
+    def close(self):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+            self.stream._disconnect()
+
+
+class FrameSplitter(object):
+    """
+    A file-like object which accepts the output of an MJPEG encoder and calls
+    *publish* with each complete frame. The encoder's writes don't necessarily
+    correspond to frames, so they're accumulated until the start of the next
+    frame is seen.
+    """
+
+    def __init__(self, publish):
+        super().__init__()
+        self.publish = publish
+        self._buffer = io.BytesIO()
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8') and self._buffer.tell():
+            self.publish(self._buffer.getvalue())
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        return self._buffer.write(buf)
+
+    def flush(self):
+        pass
+
+
+class CameraSource(object):
+    """
+    Records MJPEG at *resolution* from the video port of the camera owned by
+    *camera_queue*. The camera's encoder runs in its own thread, so still
+    captures continue to work while the stream is running.
+    """
+
+    def __init__(self, camera_queue, resolution=(640, 480), quality=50):
+        super().__init__()
+        self.camera_queue = camera_queue
+        self.resolution = resolution
+        self.quality = quality
+
+    def start(self, publish):
+        output = FrameSplitter(publish)
+        self.camera_queue.call(
+            lambda camera: camera.start_streaming(
+                output, self.resolution, self.quality))
+
+    def stop(self):
+        self.camera_queue.call(lambda camera: camera.stop_streaming())
+
+
+class SyntheticSource(object):
+    """
+    Generates frames at *resolution*, *framerate* times a second, showing a
+    frame counter and a bar sweeping across the image. Useful for testing the
+    live view without a camera.
+    """
+
+    def __init__(self, resolution=(640, 480), framerate=10):
+        super().__init__()
+        self.resolution = resolution
+        self.framerate = framerate
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, publish):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(publish,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, publish):
+        w, h = self.resolution
+        start = time.time()
+        frame = 0
+        while True:
+            img = Image.new('RGB', self.resolution, (32, 32, 32))
+            draw = ImageDraw.Draw(img)
+            x = (frame * 8) % w
+            draw.rectangle((x, 0, x + w // 20, h), fill=(255, 255, 255))
+            draw.text((8, 8), 'Frame %d' % frame, fill=(255, 255, 0))
+            data = io.BytesIO()
+            img.save(data, 'JPEG')
+            publish(data.getvalue())
+            frame += 1
+            if self._stop.wait(max(0,
+                    start + frame / self.framerate - time.time())):
+                break
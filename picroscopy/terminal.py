@@ -22,17 +22,18 @@ This module defines the command line interface for executing the picroscopy
 application. The main class, PicroscopyConsoleApp, handles parsing of command
 line parameters and configuration files, configuration of the logging system,
 and of course launching the application itself within the reference WSGI
-server included with Python.
+server included with Python (extended to handle requests with a pool of
+threads).
 """
 
 import os
 import sys
 import logging
 import argparse
-import subprocess
 import locale
 import configparser
-from wsgiref.simple_server import make_server
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server, WSGIServer
 
 # Try and use Python 3.3's ipaddress module if available. Fallback on the 3rd
 # party IPy library if not
@@ -44,6 +45,7 @@ except ImportError:
 
 from picroscopy import __version__
 from picroscopy.wsgi import PicroscopyWsgiApp
+from picroscopy.metrics import MetricsMiddleware
 
 # Use the user's default locale instead of C
 locale.setlocale(locale.LC_ALL, '')
@@ -60,6 +62,37 @@ logging.getLogger().addHandler(_CONSOLE)
 HERE = os.path.abspath(os.path.dirname(__file__))
 
 
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    A WSGI server which handles requests with a fixed size pool of threads so
+    that a slow request (e.g. a large download) doesn't stall every other
+    client. Unlike :class:`socketserver.ThreadingMixIn` the number of threads
+    is bounded (the Pi has little memory to spare); requests which arrive when
+    all threads are busy are queued.
+    """
+
+    threads = 4
+
+    def server_activate(self):
+        super().server_activate()
+        self._pool = ThreadPoolExecutor(self.threads)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
 def size(s):
     """
     Parses a string containing a Width[xHeight] image size specification.
@@ -73,6 +106,19 @@ def size(s):
             'size "%s" is invalid; width and/or height are not numbers' % s)
     return (int(w), int(h))
 
+def filesize(s):
+    """
+    Parses a string containing a size in bytes with an optional K, M, or G
+    suffix.
+    """
+    multiplier = 1
+    if s[-1:].upper() in ('K', 'M', 'G'):
+        multiplier = 1024 ** ('KMG'.index(s[-1].upper()) + 1)
+        s = s[:-1]
+    if not s.isdigit():
+        raise ValueError('size "%s" is invalid' % s)
+    return int(s) * multiplier
+
 def interface(s):
     """
     Parses a string containing a host[:port] specification.
@@ -139,6 +185,11 @@ class PicroscopyConsoleApp(object):
             metavar='HOST[:PORT]', type=interface,
             help='the address and port of the interface the web-server will '
             'listen on. Default: %(default)s')
+        self.parser.add_argument(
+            '-T', '--threads', dest='threads', action='store',
+            default='4', metavar='NUM', type=int,
+            help='the number of threads the web-server uses to handle '
+            'requests concurrently. Default: %(default)s')
         self.parser.add_argument(
             '-C', '--clients', dest='clients', action='store',
             default='0.0.0.0/0', metavar='NETWORK[/LEN]', type=network,
@@ -152,16 +203,66 @@ class PicroscopyConsoleApp(object):
             '--thumbs-dir', dest='thumbs_dir', action='store', metavar='DIR',
             help='the directory in which to store the thumbnail of images '
             'taken by the camera. Defaults to a temporary directory')
+        self.parser.add_argument(
+            '--index-file', dest='index_file', action='store', metavar='FILE',
+            help='the file in which to persist the index of the images '
+            'directory so that restarts are fast. By default the index is '
+            'rebuilt from scratch at startup')
+        self.parser.add_argument(
+            '--templates-cache', dest='templates_cache', action='store',
+            metavar='DIR',
+            help='the directory in which to keep compiled templates so that '
+            'restarts are fast. By default templates are compiled in memory '
+            'at startup')
+        self.parser.add_argument(
+            '--fragment-cache', dest='fragment_cache', action='store',
+            default='32', metavar='NUM', type=int,
+            help='the number of rendered page fragments (e.g. pages of the '
+            'library) to cache. 0 disables the cache. Default: %(default)s')
         self.parser.add_argument(
             '--thumbs-size', dest='thumbs_size', action='store',
             default='320x320', metavar='WIDTHxHEIGHT', type=size,
             help='the size that thumbnails should be generated at by the '
             'website. Default: %(default)s')
+        self.parser.add_argument(
+            '--preview-size', dest='preview_size', action='store',
+            default='1024x1024', metavar='WIDTHxHEIGHT', type=size,
+            help='the size that previews (shown on the image page) should be '
+            'generated at by the website. Default: %(default)s')
+        self.parser.add_argument(
+            '--stream-size', dest='stream_size', action='store',
+            default='640x480', metavar='WIDTHxHEIGHT', type=size,
+            help='the resolution of the live view streamed to browsers. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--stream-clients', dest='stream_clients', action='store',
+            metavar='NUM', type=int,
+            help='the number of browsers which may watch the live view at '
+            'once; each occupies one of the --threads while watching. '
+            'Defaults to half the number of threads')
+        self.parser.add_argument(
+            '--thumbs-limit', dest='thumbs_limit', action='store',
+            default='0', metavar='SIZE[K|M|G]', type=filesize,
+            help='the maximum space that thumbnails and previews may occupy '
+            'in the thumbnails directory; the least recently used are '
+            'deleted when this is exceeded. 0 means no limit. '
+            'Default: %(default)s')
+        self.parser.add_argument(
+            '--thumbs-workers', dest='thumbs_workers', action='store',
+            metavar='NUM', type=int,
+            help='the number of background processes used to generate '
+            'thumbnails. Defaults to the number of CPUs')
         self.parser.add_argument(
             '--email-from', dest='email_from', action='store',
             default='picroscopy', metavar='USER[@HOST]',
             help='the address from which email will appear to be sent. '
             'Default: %(default)s')
+        self.parser.add_argument(
+            '--email-limit', dest='email_limit', action='store',
+            default='0', metavar='SIZE[K|M|G]', type=filesize,
+            help='the maximum size of attachments in a single e-mail; larger '
+            'libraries are sent as several e-mails. 0 means no limit. '
+            'Default: %(default)s')
         email_group = self.parser.add_mutually_exclusive_group()
         email_group.add_argument(
             '--sendmail', dest='sendmail', action='store',
@@ -225,10 +326,21 @@ class PicroscopyConsoleApp(object):
                     'pdb',
                     'log_file',
                     'listen',
+                    'threads',
                     'clients',
                     'images_dir',
                     'thumbs_dir',
+                    'index_file',
+                    'templates_cache',
+                    'fragment_cache',
+                    'thumbs_size',
+                    'preview_size',
+                    'stream_size',
+                    'stream_clients',
+                    'thumbs_limit',
+                    'thumbs_workers',
                     'email_from',
+                    'email_limit',
                     'sendmail',
                     'smtp_server',
                     )
@@ -254,11 +366,26 @@ class PicroscopyConsoleApp(object):
         try:
             # XXX Print IP address in big font (display image? ascii art?)
             # XXX Or perhaps overlay IP address and client config on display?
-            httpd = make_server(args.listen[0], args.listen[1], app)
+            server_class = type(
+                'PicroscopyWSGIServer', (ThreadPoolWSGIServer,),
+                {'threads': args.threads})
+            # In debug mode, individual requests can be profiled by adding
+            # profile=1 to their query string
+            httpd = make_server(
+                args.listen[0], args.listen[1],
+                MetricsMiddleware(app, app.metrics, profile=args.debug),
+                server_class=server_class)
             logging.info('Listening on %s:%s' % (args.listen[0], args.listen[1]))
-            httpd.serve_forever()
+            logging.info('Serving requests with %d thread(s)', args.threads)
+            try:
+                httpd.serve_forever()
+            finally:
+                # Live view responses only end when the stream is closed, so
+                # it must be closed before waiting for the request threads
+                app.library.stream.close()
+                httpd.server_close()
         finally:
-            app.library.camera.close()
+            app.library.close()
         return 0
 
 
@@ -0,0 +1,346 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines the background thumbnail generation pipeline used by the
+library. Thumbnails (and other reduced size renditions of images) are
+generated by :func:`generate_thumbnail` in a bounded pool of worker processes
+managed by :class:`ThumbnailQueue`. The files generated are tracked by a
+:class:`RenditionCache` which limits the total space they occupy by evicting
+the least recently used.
+
+Jobs are queued with a priority; only as many jobs as there are workers are
+handed to the pool at any time so that a job which is suddenly needed (e.g.
+because a browser has requested that thumbnail) can be bumped ahead of the
+backlog by re-submitting it with a higher priority.
+"""
+
+import os
+import errno
+import heapq
+import logging
+import tempfile
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from PIL import Image
+
+
+PRIORITY_LOW    = 0 # e.g. images discovered in the library
+PRIORITY_NORMAL = 1 # e.g. images just captured
+PRIORITY_HIGH   = 2 # thumbnails which have actually been requested
+
+
+def generate_thumbnail(source, target, size):
+    """
+    Generates a JPEG thumbnail of the image *source* no larger than *size*,
+    writing it to *target*.
+    """
+    with Image.open(source) as im:
+        return save_thumbnail(im, target, size)
+
+
+def save_thumbnail(im, target, size):
+    """
+    Reduces the PIL image *im* (in place) to no larger than *size* and writes
+    it to *target* as a JPEG. The thumbnail is written to a temporary file
+    which is then renamed into place so that a partially written thumbnail is
+    never visible.
+    """
+    if im.format == 'JPEG':
+        # Ask the JPEG decoder to scale the image by 1/2, 1/4 or 1/8 in the
+        # DCT domain, picking the smallest scale which is still at least as
+        # large as the thumbnail. This is far quicker and uses far less memory
+        # than decoding at full resolution. Other formats have no equivalent
+        # so they are decoded in full below (as are images which have already
+        # been decoded, for which this does nothing)
+        im.draft('RGB', _fit(im.size, size))
+    im.thumbnail(size, Image.LANCZOS)
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, format='JPEG', optimize=True, progressive=True)
+        os.rename(temp, target)
+    except:
+        os.unlink(temp)
+        raise
+    return target
+
+
+def _fit(source_size, size):
+    # Calculate the size that an image of source_size will be reduced to when
+    # fitted (preserving aspect ratio) within size
+    (sw, sh), (w, h) = source_size, size
+    scale = min(1.0, w / sw, h / sh)
+    return (max(1, int(sw * scale)), max(1, int(sh * scale)))
+
+
+class ThumbnailError(Exception):
+    """
+    Raised when a thumbnail can't be generated because a worker process died
+    (e.g. killed for running out of memory), or isn't generated in time.
+    """
+
+
+class ThumbnailJob(object):
+    __slots__ = ('priority', 'future', 'args')
+
+    def __init__(self, priority, future, args):
+        self.priority = priority
+        self.future = future
+        self.args = args
+
+
+class ThumbnailQueue(object):
+    """
+    Generates thumbnails in the background with a pool of *workers* processes
+    (defaulting to the number of CPUs).
+
+    Jobs are identified by a *key* given to :meth:`submit`. Submitting a key
+    which is already queued or running returns the existing job's future
+    (bumping its priority if the new priority is higher) rather than queueing
+    a duplicate. The :attr:`depth` attribute gives the number of jobs queued or
+    running, and can be used to monitor the backlog.
+
+    If a worker process dies, the jobs running in the pool fail with
+    :exc:`ThumbnailError` and the pool is replaced so that later jobs still
+    run.
+    """
+
+    def __init__(self, workers=None):
+        super().__init__()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.completed = 0
+        self._executor = ProcessPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._counter = itertools.count()
+        self._heap = []
+        self._pending = {}
+        self._running = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        with self._lock:
+            return len(self._pending) + len(self._running)
+
+    def submit(self, key, source, target, size, priority=PRIORITY_NORMAL):
+        """
+        Queue generation of a thumbnail of *source* at *target*, returning a
+        :class:`~concurrent.futures.Future` which will be complete when the
+        thumbnail has been written.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Thumbnail queue is closed')
+            try:
+                return self._running[key]
+            except KeyError:
+                pass
+            try:
+                job = self._pending[key]
+            except KeyError:
+                job = ThumbnailJob(priority, Future(), (source, target, size))
+                self._pending[key] = job
+            else:
+                if priority <= job.priority:
+                    return job.future
+                # Leave the old heap entry in place; the dispatcher skips
+                # entries whose priority no longer matches their job
+                job.priority = priority
+            heapq.heappush(self._heap, (-priority, next(self._counter), key))
+            self._ready.notify()
+            return job.future
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+        for job in self._pending.values():
+            job.future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                while not self._closed and (
+                        not self._heap or len(self._running) >= self.workers):
+                    self._ready.wait()
+                if self._closed:
+                    return
+                priority, _, key = heapq.heappop(self._heap)
+                job = self._pending.get(key)
+                if job is None or job.priority != -priority:
+                    continue
+                del self._pending[key]
+                self._running[key] = job.future
+            if not job.future.set_running_or_notify_cancel():
+                self._finish(key)
+                continue
+            logging.debug('Generating thumbnail %s', job.args[1])
+            executor = self._executor
+            try:
+                result = executor.submit(generate_thumbnail, *job.args)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                self._finish(key)
+                job.future.set_exception(
+                    ThumbnailError('Thumbnail worker process died'))
+            except Exception as e:
+                # Anything else (e.g. the pool having been shut down) fails
+                # this job alone; the dispatcher must keep running or every
+                # later job would wait forever
+                self._finish(key)
+                job.future.set_exception(e)
+            else:
+                result.add_done_callback(
+                    partial(self._done, key, job.future, executor))
+
+    def _done(self, key, future, executor, result):
+        self._finish(key)
+        e = result.exception()
+        if isinstance(e, BrokenProcessPool):
+            # A worker died, taking the pool (and all jobs running in it)
+            # with it
+            self._replace_executor(executor)
+            future.set_exception(ThumbnailError('Thumbnail worker process died'))
+        elif e is not None:
+            future.set_exception(e)
+        else:
+            future.set_result(result.result())
+
+    def _replace_executor(self, broken):
+        # Several jobs fail when a pool breaks, so only the first to notice
+        # replaces it
+        with self._lock:
+            if self._executor is not broken or self._closed:
+                return
+            logging.error(
+                'Thumbnail worker process died; restarting the worker pool')
+            self._executor = ProcessPoolExecutor(self.workers)
+        broken.shutdown(wait=False)
+
+    def _finish(self, key):
+        with self._lock:
+            del self._running[key]
+            self.completed += 1
+            self._ready.notify()
+
+
+class RenditionCache(object):
+    """
+    Tracks the files generated under *path*, deleting the least recently used
+    when their total size exceeds *limit* bytes (or never, if *limit* is 0).
+
+    Files should be registered with :meth:`add` when they are written and
+    :meth:`touch`'d whenever they are used. Files already present under *path*
+    are registered on construction, oldest first, except for temporary files
+    left behind by an interrupted :func:`save_thumbnail`, which are removed.
+    """
+
+    def __init__(self, path, limit=0):
+        super().__init__()
+        self.path = path
+        self.limit = limit
+        self.size = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        found = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                if filename.endswith('.tmp'):
+                    try:
+                        os.unlink(filename)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, filename, st.st_size))
+        for mtime, filename, size in sorted(found):
+            self._files[filename] = size
+            self.size += size
+        self._evict()
+
+    def __len__(self):
+        return len(self._files)
+
+    def add(self, filename):
+        """
+        Registers (or re-registers) *filename* as the most recently used file,
+        evicting older files if the cache has grown too large.
+        """
+        try:
+            size = os.stat(filename).st_size
+        except OSError:
+            return
+        with self._lock:
+            self.size -= self._files.pop(filename, 0)
+            self._files[filename] = size
+            self.size += size
+            self._evict()
+
+    def touch(self, filename):
+        """
+        Marks *filename* as the most recently used file.
+        """
+        with self._lock:
+            try:
+                self._files.move_to_end(filename)
+            except KeyError:
+                pass
+
+    def discard(self, filename):
+        """
+        Deletes *filename* and removes it from the cache.
+        """
+        with self._lock:
+            self.size -= self._files.pop(filename, 0)
+            self._unlink(filename)
+
+    def _evict(self):
+        # Never evict the most recently used file, even if it alone exceeds
+        # the limit; it is presumably about to be served
+        while self.limit and self.size > self.limit and len(self._files) > 1:
+            filename, size = self._files.popitem(last=False)
+            self.size -= size
+            logging.debug('Evicting %s from cache', filename)
+            self._unlink(filename)
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,221 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines watchers which notice files being added to, changed in, or
+removed from a directory by other processes (e.g. rsync). The library uses
+these to keep its index up to date without rescanning the images directory.
+
+Two implementations are provided: :class:`InotifyWatcher` uses the Linux
+inotify API (via ctypes) and is notified of individual changes by the kernel,
+while :class:`PollingWatcher` is a fallback for other systems which checks the
+directory's modification time periodically. The :func:`watch` function selects
+the best available implementation.
+"""
+
+import os
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Watcher(object):
+    """
+    Base class for directory watchers. The *changed* callable will be called
+    from a background thread with the name of each file in *path* that may
+    have been added, modified, or removed. The *rescan* callable will be
+    called (with no arguments) if the watcher loses track of changes and the
+    whole directory needs re-examining.
+    """
+
+    def __init__(self, path, changed, rescan):
+        super().__init__()
+        self.path = path
+        self.changed = changed
+        self.rescan = rescan
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        raise NotImplementedError
+
+    def _notify(self, filename):
+        try:
+            self.changed(filename)
+        except Exception:
+            logging.exception('Error handling change to %s', filename)
+
+    def _notify_rescan(self):
+        try:
+            self.rescan()
+        except Exception:
+            logging.exception('Error rescanning %s', self.path)
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watches a directory with the Linux inotify API. Raises :exc:`OSError` on
+    construction if inotify is unavailable.
+    """
+
+    def __init__(self, path, changed, rescan):
+        super().__init__(path, changed, rescan)
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'Unable to locate the C library')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(e, os.strerror(e))
+        # A pipe is used to wake the background thread when closing
+        self._wake_r, self._wake_w = os.pipe()
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._stopping.set()
+        os.write(self._wake_w, b'\x00')
+        super().close()
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            os.close(fd)
+        self._fd = self._wake_r = self._wake_w = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            readable, _, _ = select.select([self._fd, self._wake_r], [], [])
+            if self._fd not in readable:
+                continue
+            data = os.read(self._fd, 65536)
+            # Several events for the same file frequently arrive together
+            # (e.g. ATTRIB followed by CLOSE_WRITE); only report each once
+            changed = []
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\x00')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning(
+                        'inotify queue overflowed; rescanning %s', self.path)
+                    self._notify_rescan()
+                    changed = []
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    logging.error(
+                        '%s was removed; no longer watching it', self.path)
+                    self._stopping.set()
+                elif name and not mask & IN_ISDIR:
+                    name = os.fsdecode(name)
+                    if name not in changed:
+                        changed.append(name)
+            for name in changed:
+                self._notify(name)
+
+
+class PollingWatcher(Watcher):
+    """
+    Watches a directory by checking its modification time every *interval*
+    seconds. When the directory changes, only the names which have appeared or
+    disappeared since the last check are reported. Note that this cannot
+    detect files which are modified in place (without being renamed).
+    """
+
+    def __init__(self, path, changed, rescan, interval=5.0):
+        super().__init__(path, changed, rescan)
+        self.interval = interval
+        self._mtime = os.stat(path).st_mtime
+        self._names = set(os.listdir(path))
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self._mtime:
+                    continue
+                self._mtime = mtime
+                names = set(os.listdir(self.path))
+            except OSError as e:
+                logging.error('Unable to check %s: %s', self.path, e)
+                continue
+            changed = names ^ self._names
+            self._names = names
+            for name in sorted(changed):
+                self._notify(name)
+
+
+def watch(path, changed, rescan, interval=5.0):
+    """
+    Starts and returns a watcher for *path*, using inotify if it is available
+    and falling back to polling every *interval* seconds otherwise. See
+    :class:`Watcher` for the meaning of *changed* and *rescan*.
+    """
+    try:
+        watcher = InotifyWatcher(path, changed, rescan)
+    except OSError as e:
+        logging.info(
+            'Unable to use inotify (%s); polling %s for changes', e, path)
+        watcher = PollingWatcher(path, changed, rescan, interval)
+    else:
+        logging.info('Watching %s for changes with inotify', path)
+    watcher.start()
+    return watcher
@@ -36,12 +36,17 @@ constructing HTML pages.
 import os
 import io
 import re
+import errno
 import math
+import json
+import hashlib
 import logging
 import mimetypes
 import datetime
-from wsgiref.util import FileWrapper
+import threading
+import time
 from operator import itemgetter
+from collections import namedtuple, OrderedDict
 
 # Try and use Python 3.3's ipaddress module if available. Fallback on the 3rd
 # party IPy library if not
@@ -52,66 +57,126 @@ except ImportError:
     IPv4Network = IPv4Address
 
 from webob import Request, Response, exc
+from webob.static import FileIter
 from chameleon import PageTemplateLoader
+from chameleon.loader import ModuleLoader
 from wheezy.routing import PathRouter, url
 from picamera import PiCameraError
 
-from picroscopy.library import PicroscopyLibrary
+from picroscopy.camera import CameraTimeout
+from picroscopy.thumbs import ThumbnailError
+from picroscopy.stream import StreamBusy
+from picroscopy.library import PicroscopyLibrary, DONE
+from picroscopy.mail import SENT
+from picroscopy.metrics import Metrics
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
+Page = namedtuple('Page', (
+    'entries', 'offset', 'limit', 'total', 'sort', 'generation'))
+
 
 class WebHelpers(object):
+    exif_excluded = frozenset((
+        'ApertureValue',
+        'CreateDate',
+        'ExifImageHeight',
+        'ExifImageWidth',
+        'ExifToolVersion',
+        'FileModifyDate',
+        'FileName',
+        'FilePermissions',
+        'Flash',
+        'FlashFired',
+        'FlashFunction',
+        'FlashMode',
+        'FlashRedEyeMode',
+        'FlashReturn',
+        'FocalLength35efl',
+        'ImageHeight',
+        'ImageWidth',
+        'MakerNote',
+        'MakerNoteUnknownText',
+        'ModifyDate',
+        'RowsPerStrip',
+        'ResolutionUnit',
+        'SourceFile',
+        'StripByteCounts',
+        'StripOffsets',
+        'ThumbnailImage',
+        'ThumbnailLength',
+        'ThumbnailOffset',
+        'XMPToolkit',
+        'XResolution',
+        'YResolution',
+        ))
+
+    # The orders in which the library can be listed, mapped to the index
+    # field that each sorts by. Prefixing the order with "-" reverses it
+    sort_orders = {
+        'name': 'filename',
+        'date': 'mtime',
+        'size': 'size',
+        }
+
+    page_size = 48
+    max_page_size = 1000
+
     def __init__(self, library):
         self.library = library
 
     def image_size(self, image):
-        return self.format_size(
-            self.library.stat_image(image).st_size, 'B', binary=True)
+        # The index already knows the size and modification time of every
+        # image (and *image* may be an IndexEntry from library_page), so
+        # neither of these touch the filesystem
+        if isinstance(image, str):
+            image = self.library.index[image]
+        return self.format_size(image.size, 'B', binary=True)
 
     def image_created(self, image):
+        if isinstance(image, str):
+            image = self.library.index[image]
         return datetime.datetime.fromtimestamp(
-            self.library.stat_image(image).st_mtime).strftime('%H:%M:%S on %a, %d %b %Y')
+            image.mtime).strftime('%H:%M:%S on %a, %d %b %Y')
+
+    def library_page(self, params, strict=False):
+        """
+        Returns the :class:`Page` of the library selected by the ``offset``,
+        ``limit``, and ``sort`` values in *params*. If any of these are
+        invalid, raises :exc:`ValueError` if *strict* is True, or falls back
+        to their defaults otherwise. The cost of this depends on the size of
+        the page rather than the size of the library.
+        """
+        try:
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', self.page_size))
+            sort = params.get('sort', 'name')
+            if offset < 0:
+                raise ValueError('Invalid offset: %d' % offset)
+            if not 0 < limit <= self.max_page_size:
+                raise ValueError('Invalid limit: %d' % limit)
+            if not sort.lstrip('-') in self.sort_orders:
+                raise ValueError('Invalid sort: %s' % sort)
+        except ValueError:
+            if strict:
+                raise
+            offset, limit, sort = 0, self.page_size, 'name'
+        # The generation is read first so that, if the library changes while
+        # the page is being built, the page is associated with the older
+        # generation (anything cached against it will be discarded)
+        generation = self.library.index.generation
+        return Page(
+            self.library.index.entries(
+                offset, limit, self.sort_orders[sort.lstrip('-')],
+                reverse=sort.startswith('-')),
+            offset, limit, len(self.library), sort, generation)
 
     def image_exif(self, image):
-        exif_data = self.library.open_image_exif(image)
         return sorted(
             (
                 (self.format_title(title), value)
                 for (title, value) in self.library.open_image_exif(image).items()
-                if title not in set((
-                    'ApertureValue',
-                    'CreateDate',
-                    'ExifImageHeight',
-                    'ExifImageWidth',
-                    'ExifToolVersion',
-                    'FileModifyDate',
-                    'FileName',
-                    'FilePermissions',
-                    'Flash',
-                    'FlashFired',
-                    'FlashFunction',
-                    'FlashMode',
-                    'FlashRedEyeMode',
-                    'FlashReturn',
-                    'FocalLength35efl',
-                    'ImageHeight',
-                    'ImageWidth',
-                    'MakerNote',
-                    'MakerNoteUnknownText',
-                    'ModifyDate',
-                    'RowsPerStrip',
-                    'ResolutionUnit',
-                    'SourceFile',
-                    'StripByteCounts',
-                    'StripOffsets',
-                    'ThumbnailImage',
-                    'ThumbnailLength',
-                    'ThumbnailOffset',
-                    'XMPToolkit',
-                    'XResolution',
-                    'YResolution',
-                    ))
+                if title not in self.exif_excluded
                 ),
             key=itemgetter(0)
             )
@@ -145,10 +210,51 @@ class WebHelpers(object):
                 unit=unit)
 
 
+class FragmentCache(object):
+    """
+    A thread-safe cache of the *size* most recently used fragments of
+    rendered markup. A *size* of 0 disables the cache.
+    """
+
+    def __init__(self, size=32):
+        super().__init__()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        """
+        Return the fragment cached under *key* (which should include anything
+        the fragment depends upon, like the library's generation), calling
+        *render* to produce it if it isn't cached.
+        """
+        if not self.size:
+            return render()
+        with self._lock:
+            try:
+                self._fragments.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return self._fragments[key]
+        # Rendering happens outside the lock; at worst two threads render the
+        # same fragment at once
+        result = render()
+        with self._lock:
+            self._fragments[key] = result
+            while len(self._fragments) > self.size:
+                self._fragments.popitem(last=False)
+        return result
+
+
 class PicroscopyWsgiApp(object):
     def __init__(self, **kwargs):
         super().__init__()
-        self.library = PicroscopyLibrary(**kwargs)
+        self.metrics = kwargs.get('metrics') or Metrics()
+        self.library = PicroscopyLibrary(**dict(kwargs, metrics=self.metrics))
         self.helpers = WebHelpers(self.library)
         self.clients = kwargs.get('clients', IPv4Network('0.0.0.0/0'))
         logging.info('Clients must be on network %s', self.clients)
@@ -156,15 +262,43 @@ class PicroscopyWsgiApp(object):
             'static_dir', os.path.join(HERE, 'static')
             )))
         logging.info('Static files: %s', self.static_dir)
+        self._static_fingerprints = {}
         self.templates_dir = os.path.abspath(os.path.normpath(kwargs.get(
             'templates_dir', os.path.join(HERE, 'templates')
             )))
         logging.info('Chameleon templates: %s', self.templates_dir)
+        # Compiled templates are normally kept in memory; if a cache
+        # directory is given they're written there, and re-used (provided the
+        # template hasn't changed) when the application restarts
+        config = {}
+        self.templates_cache = kwargs.get('templates_cache')
+        if self.templates_cache:
+            self.templates_cache = os.path.abspath(os.path.normpath(
+                self.templates_cache))
+            logging.info('Compiled templates cache: %s', self.templates_cache)
+            try:
+                os.makedirs(self.templates_cache)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            config['loader'] = ModuleLoader(self.templates_cache)
         self.templates = PageTemplateLoader(
-            self.templates_dir, default_extension='.pt')
+            self.templates_dir, default_extension='.pt', **config)
+        self.compile_templates()
         self.layout = self.templates['layout']
+        self.fragments = FragmentCache(kwargs.get('fragment_cache', 32))
+        if self.fragments.size:
+            logging.info(
+                'Caching up to %d rendered fragments', self.fragments.size)
         # No need to make flashes a per-session thing - it's a single user app!
+        # Flashes are added by concurrent requests (and by the mail queue) so
+        # access to them is serialised
         self.flashes = []
+        self._flashes_lock = threading.Lock()
+        # Requests which change the library's settings or use the camera are
+        # serialised with this lock; those which merely read the library
+        # (which protects its own index) don't need it
+        self._lock = threading.RLock()
         self.router = PathRouter()
         # XXX Add handler for exiting system
         # XXX Make exit code conditional? (upgrade/reboot/shutdown/etc.)
@@ -175,21 +309,35 @@ class PicroscopyWsgiApp(object):
             url('/static/{path:any}',  self.do_static,   name='static'),
             url('/images/{image}',     self.do_image,    name='image'),
             url('/thumbs/{image}',     self.do_thumb,    name='thumb'),
+            url('/renditions/{size}/{image}', self.do_rendition, name='rendition'),
+            url('/preview.mjpg',       self.do_stream,   name='stream'),
             url('/delete/{image}',     self.do_delete,   name='delete'),
             url('/config',             self.do_config,   name='config'),
             url('/reset',              self.do_reset,    name='reset'),
             url('/capture',            self.do_capture,  name='capture'),
+            url('/capture/{job:int}.json', self.do_capture_status, name='capture_status'),
             url('/download',           self.do_download, name='download'),
             url('/send',               self.do_send,     name='send'),
+            url('/send/{job:int}.json', self.do_send_status, name='send_status'),
+            url('/api/images',         self.do_api_images, name='api_images'),
             url('/logout',             self.do_logout,   name='logout'),
+            url('/metrics',            self.do_metrics,  name='metrics'),
             ])
+        self.register_metrics()
 
     def __call__(self, environ, start_response):
         req = Request(environ)
         try:
             if not IPv4Address(req.remote_addr) in self.clients:
+                environ['picroscopy.route'] = 'forbidden'
                 raise exc.HTTPForbidden()
-            handler, kwargs = self.router.match(req.path_info)
+            with self.metrics.timer(
+                    'picroscopy_phase_duration_seconds', phase='route'):
+                handler, kwargs = self.router.match(req.path_info)
+            # Requests are labelled by their handler (rather than their path)
+            # for MetricsMiddleware
+            environ['picroscopy.route'] = (
+                handler.__name__[3:] if handler else 'not_found')
             if handler:
                 # XXX Why does route_name only appear in kwargs sometimes?!
                 if 'route_name' in kwargs:
@@ -197,11 +345,96 @@ class PicroscopyWsgiApp(object):
                 resp = handler(req, **kwargs)
             else:
                 self.not_found(req)
+        except (CameraTimeout, ThumbnailError) as e:
+            resp = exc.HTTPServiceUnavailable(str(e))
         except exc.HTTPException as e:
             # The exception itself is a WSGI response
             resp = e
         return resp(environ, start_response)
 
+    def register_metrics(self):
+        """
+        Register gauges describing the state of the library with the metrics
+        registry
+        """
+        library = self.library
+        for name, help, func, type in (
+                ('picroscopy_images', 'Number of images in the library',
+                    lambda: len(library), 'gauge'),
+                ('picroscopy_thumbnail_queue_depth',
+                    'Number of thumbnails waiting to be generated',
+                    lambda: library.thumbnailer.depth, 'gauge'),
+                ('picroscopy_mail_queue_depth',
+                    'Number of e-mails waiting to be sent',
+                    lambda: library.mailer.depth, 'gauge'),
+                ('picroscopy_capture_jobs_active',
+                    'Number of capture sequences in progress',
+                    lambda: sum(
+                        1 for job in list(library.capture_jobs.values())
+                        if job.finished is None), 'gauge'),
+                ('picroscopy_stream_clients',
+                    'Number of clients watching the live view',
+                    lambda: library.stream.clients, 'gauge'),
+                ('picroscopy_stream_frames_dropped_total',
+                    'Number of live view frames skipped by slow clients',
+                    lambda: library.stream.dropped, 'counter'),
+                ('picroscopy_fragment_cache_hits_total',
+                    'Number of rendered fragments served from the cache',
+                    lambda: self.fragments.hits, 'counter'),
+                ('picroscopy_fragment_cache_misses_total',
+                    'Number of rendered fragments not found in the cache',
+                    lambda: self.fragments.misses, 'counter'),
+                ):
+            self.metrics.gauge(name, help, func, type)
+
+    def compile_templates(self):
+        """
+        Compile all templates in the templates directory, so that the first
+        request for each page doesn't pay the (considerable, on a Pi) cost
+        """
+        start = time.time()
+        names = [
+            os.path.relpath(
+                os.path.join(path, os.path.splitext(filename)[0]),
+                self.templates_dir)
+            for path, dirnames, filenames in os.walk(self.templates_dir)
+            for filename in sorted(filenames)
+            if filename.endswith('.pt')
+            ]
+        for name in names:
+            self.templates[name].cook_check()
+        logging.info(
+            'Compiled %d template(s) in %.2fs', len(names), time.time() - start)
+
+    def fragment(self, name, key, **kwargs):
+        """
+        Render the template *name* (from the fragments directory under the
+        templates directory) with *kwargs* as a fragment of a page, caching
+        the result under *key*
+        """
+        return self.fragments.get((name,) + tuple(key), lambda:
+            self.templates['fragments/' + name](
+                helpers=self.helpers,
+                router=self.router,
+                static_url=self.static_url,
+                **kwargs))
+
+    def flash(self, message):
+        """
+        Add *message* to the messages shown on the next page rendered
+        """
+        with self._flashes_lock:
+            self.flashes.append(message)
+
+    def pop_flashes(self):
+        """
+        Remove and return all pending flash messages
+        """
+        with self._flashes_lock:
+            result = self.flashes
+            self.flashes = []
+        return result
+
     def not_found(self, req):
         """
         Handler for unknown locations (404)
@@ -213,8 +446,9 @@ class PicroscopyWsgiApp(object):
         """
         Reset all settings to their defaults
         """
-        self.library.camera_reset()
-        self.flashes.append('Camera settings reset to defaults')
+        with self._lock:
+            self.library.camera_reset()
+        self.flash('Camera settings reset to defaults')
         raise exc.HTTPFound(
             location=self.router.path_for('template', page='library'))
 
@@ -222,6 +456,22 @@ class PicroscopyWsgiApp(object):
         """
         Configure the library and camera settings
         """
+        with self._lock:
+            errors = self.configure(req)
+        # If any settings failed, re-render the settings form
+        if errors:
+            for error in errors:
+                self.flash(error)
+            return self.do_template(req, 'settings')
+        raise exc.HTTPFound(
+            location=self.router.path_for('template', page='library'))
+
+    def configure(self, req):
+        """
+        Apply the settings in *req* to the library and camera, returning a list
+        of error messages for any that were invalid
+        """
+        errors = []
         # Resolution is handled specially as the camera needs to stop the
         # preview in order to change it
         try:
@@ -230,17 +480,13 @@ class PicroscopyWsgiApp(object):
             if len(new_resolution) != 2:
                 raise ValueError()
         except ValueError:
-            self.flashes.append(
+            errors.append(
                 'Invalid resolution: %s' % req.params['resolution'])
-        if self.library.camera.resolution != new_resolution:
+        else:
             try:
-                self.library.camera.stop_preview()
-                try:
-                    self.library.camera.resolution = new_resolution
-                finally:
-                    self.library.camera.start_preview()
+                self.library.camera_queue.set_resolution(new_resolution)
             except PiCameraError:
-                self.flashes.append(
+                errors.append(
                     'Unable to change camera resolution '
                     'to %s' % req.params['resolution'])
         # Everything else is handled generically...
@@ -248,30 +494,30 @@ class PicroscopyWsgiApp(object):
                 'sharpness', 'contrast', 'brightness', 'saturation', #'ISO',
                 'exposure-compensation'):
             try:
-                setattr(
-                    self.library.camera, setting.replace('-', '_'),
+                self.library.camera_queue.configure([(
+                    setting.replace('-', '_'),
                     int(req.params[setting])
-                    )
+                    )])
             except ValueError:
-                self.flashes.append(
+                errors.append(
                     'Invalid %s: %s' % (setting, req.params[setting]))
         for setting in ('hflip', 'vflip'):
             try:
-                setattr(
-                    self.library.camera, setting.replace('-', '_'),
+                self.library.camera_queue.configure([(
+                    setting.replace('-', '_'),
                     bool(req.params.get(setting, 0))
-                    )
+                    )])
             except ValueError:
-                self.flashes.append(
+                errors.append(
                     'Invalid %s: %s' % (setting, req.params[setting]))
         for setting in ('meter-mode', 'awb-mode', 'exposure-mode'):
             try:
-                setattr(
-                    self.library.camera, setting.replace('-', '_'),
+                self.library.camera_queue.configure([(
+                    setting.replace('-', '_'),
                     req.params[setting]
-                    )
+                    )])
             except ValueError:
-                self.flashes.append(
+                errors.append(
                     'Invalid %s: %s' % (setting, req.params[setting]))
         for setting in (
                 'artist', 'email', 'copyright', 'description',
@@ -282,45 +528,199 @@ class PicroscopyWsgiApp(object):
                     req.params[setting]
                     )
             except ValueError:
-                self.flashes.append(
+                errors.append(
                     'Invalid %s: %s' % (setting, req.params[setting]))
-        # If any settings failed, re-render the settings form
-        if self.flashes:
-            return self.do_template(req, 'settings')
-        raise exc.HTTPFound(
-            location=self.router.path_for('template', page='library'))
+        return errors
 
     def do_capture(self, req):
         """
-        Take a new image with the camera and add it to the library
+        Take a new image with the camera and add it to the library, or start
+        capturing a sequence of images if count (and interval) are given
         """
-        self.library.capture()
+        try:
+            count = int(req.params.get('count', 1))
+            interval = float(req.params.get('interval', 0))
+        except ValueError:
+            self.flash('Invalid count or interval')
+        else:
+            with self._lock:
+                if count == 1:
+                    self.library.capture()
+                else:
+                    try:
+                        job = self.library.capture_sequence(
+                            count, interval, callback=self.capture_finished)
+                    except ValueError as e:
+                        self.flash(str(e))
+                    else:
+                        self.flash(
+                            'Capturing %d images at %g second intervals' % (
+                                job.count, job.interval))
         raise exc.HTTPFound(
             location=self.router.path_for('template', page='library'))
 
+    def capture_finished(self, job):
+        """
+        Called by the library when a capture sequence finishes
+        """
+        if job.state == DONE and not job.failed:
+            self.flash('Captured %d images' % job.processed)
+        else:
+            self.flash('Captured %d of %d images (%s): %s' % (
+                job.processed, job.count, job.state, job.error))
+
+    def do_capture_status(self, req, job):
+        """
+        Return the progress of a capture sequence as JSON
+        """
+        try:
+            job = self.library.capture_jobs[int(job)]
+        except KeyError:
+            self.not_found(req)
+        return self.json_response(job.as_dict())
+
     def do_download(self, req):
         """
-        Send the library as a .zip archive
+        Send the library (or a selection of it) as a .zip archive
         """
-        archive = self.library.archive()
-        size = archive.seek(0, io.SEEK_END)
-        archive.seek(0)
-        resp = Response()
-        resp.content_type = 'application/zip'
-        resp.content_length = size
+        images = req.GET.getall('image') or None
+        if images is not None:
+            for image in images:
+                if not image in self.library:
+                    self.not_found(req)
+            images = set(images)
+        try:
+            since = self.parse_timestamp(req.GET.get('since'))
+            until = self.parse_timestamp(req.GET.get('until'), end=True)
+        except ValueError as e:
+            raise exc.HTTPBadRequest(str(e))
+        selection = self.library.select(
+            images, req.GET.get('first'), req.GET.get('last'), since, until)
+        # The validators must be derived before the archive is built; if the
+        # library changes in between, the ETag simply won't match next time
+        etag = self.library.index.digest(selection)
+        archive = self.library.archive(selection)
+        mtime = max([entry.mtime for entry in archive.entries] or [0])
+        resp = self.file_response(
+            archive, archive.size, mtime, etag=etag,
+            content_type='application/zip')
         resp.content_disposition = 'attachment; filename=images.zip'
-        resp.app_iter = FileWrapper(archive)
+        # The token can be passed back as "since" to download only the images
+        # which have been added or modified since this download
+        added = [entry.ctime for entry in self.library.index.lookup(selection)]
+        resp.headers['X-Picroscopy-Token'] = repr(max(added + [since or 0.0]))
         return resp
 
+    def parse_timestamp(self, value, end=False):
+        """
+        Convert *value*, which may be a token returned by a prior download, a
+        date, or a date and time, to a timestamp. If *end* is True, a date is
+        converted to the end of that day rather than its start
+        """
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+            try:
+                value = datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if end and fmt == '%Y-%m-%d':
+                value += datetime.timedelta(days=1)
+                return time.mktime(value.timetuple()) - 0.000001
+            return time.mktime(value.timetuple())
+        raise ValueError('Invalid date or token: %s' % value)
+
     def do_send(self, req):
         """
         Send the library as a set of attachments to an email
         """
-        self.library.send()
-        self.flashes.append('Email sent to %s' % library.email)
+        # Sending happens in the background; the outcome is flashed when the
+        # job finishes, and can be polled from do_send_status
+        try:
+            job = self.library.send(callback=self.send_finished)
+        except ValueError as e:
+            self.flash(str(e))
+        else:
+            self.flash(
+                'Sending %d image(s) to %s' % (job.images, job.address))
         raise exc.HTTPFound(
             location=self.router.path_for('template', page='library'))
 
+    def send_finished(self, job):
+        """
+        Called by the library's mail queue when a send job finishes
+        """
+        if job.state == SENT:
+            self.flash('Email sent to %s' % job.address)
+        else:
+            self.flash(
+                'Failed to send email to %s: %s' % (job.address, job.error))
+
+    def do_send_status(self, req, job):
+        """
+        Return the status of an email send job as JSON
+        """
+        try:
+            job = self.library.mailer[int(job)]
+        except KeyError:
+            self.not_found(req)
+        return self.json_response(job.as_dict())
+
+    def do_api_images(self, req):
+        """
+        Return a page of the library's images (with their metadata) as JSON
+        """
+        try:
+            page = self.helpers.library_page(req.GET, strict=True)
+        except ValueError as e:
+            raise exc.HTTPBadRequest(str(e))
+        next_offset = page.offset + page.limit
+        return self.json_response({
+            'offset': page.offset,
+            'limit':  page.limit,
+            'total':  page.total,
+            'sort':   page.sort,
+            'next':   '%s?offset=%d&limit=%d&sort=%s' % (
+                self.router.path_for('api_images'),
+                next_offset, page.limit, page.sort,
+                ) if next_offset < page.total else None,
+            'images': [
+                {
+                    'filename': entry.filename,
+                    'size':     entry.size,
+                    'mtime':    entry.mtime,
+                    'width':    entry.width,
+                    'height':   entry.height,
+                    'url':      self.router.path_for('image', image=entry.filename),
+                    'thumb':    self.router.path_for('thumb', image=entry.filename),
+                    'view':     self.router.path_for('view', image=entry.filename),
+                    }
+                for entry in page.entries
+                ],
+            })
+
+    def do_metrics(self, req):
+        """
+        Return the application's metrics in the Prometheus text format
+        """
+        resp = Response(content_type='text/plain', charset='utf-8')
+        resp.cache_control = 'no-cache'
+        resp.text = self.metrics.render()
+        return resp
+
+    def json_response(self, value):
+        """
+        Construct an uncacheable response containing *value* as JSON
+        """
+        resp = Response(content_type='application/json', charset='utf-8')
+        resp.cache_control = 'no-cache'
+        resp.text = json.dumps(value)
+        return resp
+
     def do_delete(self, req, image):
         """
         Delete the selected images from library
@@ -333,9 +733,10 @@ class PicroscopyWsgiApp(object):
         """
         Clear the library of all images, reset all settings
         """
-        self.library.clear()
-        self.library.user_reset()
-        self.library.camera_reset()
+        with self._lock:
+            self.library.clear()
+            self.library.user_reset()
+            self.library.camera_reset()
         raise exc.HTTPFound(
             location=self.router.path_for('template', page='settings'))
 
@@ -345,23 +746,62 @@ class PicroscopyWsgiApp(object):
         """
         if not image in self.library:
             self.not_found(req)
-        resp = Response()
-        resp.content_type, resp.content_encoding = mimetypes.guess_type(
+        content_type, content_encoding = mimetypes.guess_type(
                 image, strict=False)
-        resp.content_length = self.library.stat_image(image).st_size
-        resp.app_iter = FileWrapper(self.library.open_image(image))
+        # Images can be replaced or edited in place (e.g. after the library is
+        # cleared and the counter reset), so browsers must revalidate. The
+        # index may not have caught up with such changes (or the image may
+        # have been removed since the check above), so the validators are
+        # taken from the open file
+        try:
+            f = self.library.open_image(image)
+        except (KeyError, IOError, OSError):
+            self.not_found(req)
+        st = os.fstat(f.fileno())
+        resp = self.file_response(
+            f, st.st_size, st.st_mtime, content_type=content_type)
+        resp.content_encoding = content_encoding
         return resp
 
     def do_thumb(self, req, image):
         """
         Serve a thumbnail of an image from the library
         """
-        if not image in self.library:
+        return self.do_rendition(req, 'thumb', image)
+
+    def do_rendition(self, req, size, image):
+        """
+        Serve a rendition (thumb, preview, or full) of an image from the library
+        """
+        if size == 'full':
+            return self.do_image(req, image)
+        if not (image in self.library and size in self.library.renditions):
             self.not_found(req)
-        resp = Response()
-        resp.content_type = 'image/jpeg'
-        resp.content_length = self.library.stat_thumbnail(image).st_size
-        resp.app_iter = FileWrapper(self.library.open_thumbnail(image))
+        # The rendition may be evicted from the cache at any moment, so its
+        # size and mtime are taken from the open file rather than its path
+        f = self.library.open_rendition(image, size)
+        st = os.fstat(f.fileno())
+        return self.file_response(
+            f, st.st_size, st.st_mtime, content_type='image/jpeg')
+
+    def do_stream(self, req):
+        """
+        Serve the camera's live view as an MJPEG stream
+        """
+        # The response continues until the client disconnects (closing the
+        # iterator) or the library is closed
+        stream = self.library.stream
+        try:
+            app_iter = stream.multipart()
+        except StreamBusy as e:
+            # Every viewer ties up a server thread; refuse more than the
+            # configured number so that other requests can still be served
+            resp = exc.HTTPServiceUnavailable(str(e))
+            resp.retry_after = 10
+            return resp
+        resp = Response(content_type=stream.content_type)
+        resp.cache_control = 'no-cache, no-store'
+        resp.app_iter = app_iter
         return resp
 
     def do_static(self, req, path):
@@ -369,17 +809,65 @@ class PicroscopyWsgiApp(object):
         Serve static files from disk
         """
         path = os.path.normpath(os.path.join(self.static_dir, path))
-        if not path.startswith(self.static_dir):
+        if not (path.startswith(self.static_dir) and os.path.isfile(path)):
             self.not_found(req)
-        resp = Response()
-        resp.content_type, resp.content_encoding = mimetypes.guess_type(
+        content_type, content_encoding = mimetypes.guess_type(
                 path, strict=False)
-        if resp.content_type is None:
-            resp.content_type = 'application/octet-stream'
-        resp.content_length = os.stat(path).st_size
-        resp.app_iter = FileWrapper(io.open(path, 'rb'))
+        st = os.stat(path)
+        fingerprint = self.static_fingerprint(path)
+        resp = self.file_response(
+            io.open(path, 'rb'), st.st_size, st.st_mtime, etag=fingerprint,
+            content_type=content_type or 'application/octet-stream')
+        resp.content_encoding = content_encoding
+        # Static files never change while we're running, so URLs generated by
+        # static_url (which include the fingerprint) can be cached forever
+        if req.GET.get('v') == fingerprint:
+            resp.cache_control = 'public, max-age=31536000, immutable'
+        return resp
+
+    def file_response(self, f, size, mtime, etag=None, content_type=None):
+        """
+        Construct a response serving the file-like object *f* of *size* bytes
+        last modified at *mtime*. The response includes cache validators
+        (derived from *size* and *mtime* unless *etag* is given) so that WebOb
+        will answer with a 304 if the request's conditions are satisfied, and
+        advertises byte range support so that WebOb will answer Range requests
+        with 206 (or 416 for unsatisfiable ranges). *f* must be seekable, or
+        an iterable which provides its own ``app_iter_range`` method.
+        """
+        resp = Response(content_type=content_type, conditional_response=True)
+        if hasattr(f, 'app_iter_range'):
+            resp.app_iter = f
+        else:
+            # FileIter (unlike FileWrapper) can seek to serve byte ranges
+            # directly
+            resp.app_iter = FileIter(f)
+        # Content-Length must be set after app_iter as WebOb resets it
+        resp.content_length = size
+        resp.accept_ranges = 'bytes'
+        resp.last_modified = mtime
+        resp.etag = etag or '%x-%x' % (int(mtime * 1000000), size)
+        resp.cache_control = 'no-cache'
         return resp
 
+    def static_url(self, path):
+        """
+        Return the URL of the static file *path* including a fingerprint of
+        its content, allowing browsers to cache it indefinitely
+        """
+        return '%s?v=%s' % (
+            self.router.path_for('static', path=path),
+            self.static_fingerprint(os.path.join(self.static_dir, path)))
+
+    def static_fingerprint(self, path):
+        try:
+            return self._static_fingerprints[path]
+        except KeyError:
+            with io.open(path, 'rb') as f:
+                fingerprint = hashlib.md5(f.read()).hexdigest()[:16]
+            self._static_fingerprints[path] = fingerprint
+            return fingerprint
+
     def do_template(self, req, page, image=None):
         """
         Serve a Chameleon template-based page
@@ -391,16 +879,19 @@ class PicroscopyWsgiApp(object):
             template = self.templates[page]
         except ValueError:
             self.not_found(req)
-        resp.text = template(
-            req=req,
-            page=page,
-            image=image,
-            helpers=self.helpers,
-            layout=self.layout,
-            flashes=self.flashes,
-            library=self.library,
-            camera=self.library.camera,
-            router=self.router)
-        del self.flashes[:]
+        with self.metrics.timer(
+                'picroscopy_phase_duration_seconds', phase='render'):
+            resp.text = template(
+                req=req,
+                page=page,
+                image=image,
+                helpers=self.helpers,
+                layout=self.layout,
+                flashes=self.pop_flashes(),
+                library=self.library,
+                camera=self.library.camera,
+                router=self.router,
+                static_url=self.static_url,
+                fragment=self.fragment)
         return resp
 
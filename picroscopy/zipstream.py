@@ -0,0 +1,253 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module defines :class:`ZipStream`, which generates an uncompressed
+(``ZIP_STORED``) zip archive on the fly as it is iterated over. Nothing is
+written to disk and only one chunk of one file is held in memory at a time.
+
+Because the entries are stored, the size of the archive can be calculated
+exactly from the sizes of the files before a single byte has been read. The
+CRC of each file is calculated as it is streamed and written in a data
+descriptor following the file's data (and again in the central directory at
+the end of the archive). The stream also supports generating arbitrary byte
+ranges of the archive, allowing interrupted downloads to be resumed.
+"""
+
+import io
+import time
+import zlib
+import struct
+import logging
+from collections import namedtuple
+
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIG = 0x04034b50
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR_SIG = 0x08074b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIG = 0x02014b50
+ZIP64_OFFSET_EXTRA = struct.Struct('<HHQ')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_SIG = 0x06054b50
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_RECORD_SIG = 0x06064b50
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+ZIP64_END_LOCATOR_SIG = 0x07064b50
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_MAX = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+ZipEntry = namedtuple('ZipEntry', (
+    'arcname',
+    'path',
+    'size',
+    'mtime',
+    'offset',
+    'header',
+    ))
+
+
+class ZipStream(object):
+    """
+    An iterable zip archive of *files*, which is a sequence of ``(arcname,
+    path, size, mtime)`` tuples. The sizes given *must* match the content of
+    the files when they are read. The total size of the archive is available
+    from the :attr:`size` attribute before iteration begins.
+
+    If *crc_cache* is given, it must be a dict-like object which will be used
+    to look up and store the CRC of each file. It maps each file's path to a
+    ``(size, mtime, crc)`` tuple; entries whose size or modification time
+    don't match are ignored. This is only consulted when the CRC of a file is needed without
+    streaming the file (e.g. when generating a byte range starting after it).
+    """
+
+    def __init__(self, files, chunk_size=65536, crc_cache=None):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.crc_cache = {} if crc_cache is None else crc_cache
+        self.entries = []
+        offset = 0
+        for arcname, path, size, mtime in files:
+            if size >= ZIP_MAX:
+                raise ValueError('%s is too large to archive' % path)
+            header = self._local_header(arcname, size, mtime)
+            self.entries.append(
+                ZipEntry(arcname, path, size, mtime, offset, header))
+            offset += len(header) + size + DATA_DESCRIPTOR.size
+        self._directory_offset = offset
+        self._directory_size = sum(
+            CENTRAL_HEADER.size + len(self._name(entry.arcname)[0]) +
+            (ZIP64_OFFSET_EXTRA.size if entry.offset >= ZIP_MAX else 0)
+            for entry in self.entries)
+        self._zip64 = (
+            len(self.entries) >= ZIP_MAX_ENTRIES or
+            self._directory_offset >= ZIP_MAX or
+            self._directory_size >= ZIP_MAX)
+        self.size = (
+            self._directory_offset + self._directory_size + END_RECORD.size +
+            (ZIP64_END_RECORD.size + ZIP64_END_LOCATOR.size if self._zip64 else 0))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.app_iter_range(0, self.size)
+
+    def app_iter_range(self, start, stop):
+        """
+        Generates the bytes of the archive from offset *start* up to (but not
+        including) *stop*.
+        """
+        if stop is None or stop > self.size:
+            stop = self.size
+        if start is None:
+            start = 0
+        for offset, length, chunks in self._parts():
+            if offset >= stop:
+                break
+            if offset + length <= start:
+                continue
+            skip = max(0, start - offset)
+            limit = min(length, stop - offset)
+            for chunk in chunks(skip, limit):
+                yield chunk
+
+    def _parts(self):
+        # Yields (offset, length, chunks) for each contiguous part of the
+        # archive, where chunks(skip, limit) generates the part's bytes from
+        # skip up to limit
+        for entry in self.entries:
+            data_offset = entry.offset + len(entry.header)
+            yield entry.offset, len(entry.header), self._bytes_chunks(entry.header)
+            yield data_offset, entry.size, self._file_chunks(entry)
+            yield (
+                data_offset + entry.size, DATA_DESCRIPTOR.size,
+                lambda skip, limit, entry=entry:
+                    self._bytes_chunks(self._data_descriptor(entry))(skip, limit))
+        yield (
+            self._directory_offset, self.size - self._directory_offset,
+            lambda skip, limit:
+                self._bytes_chunks(self._directory())(skip, limit))
+
+    def _bytes_chunks(self, data):
+        def chunks(skip, limit):
+            if skip < limit:
+                yield data[skip:limit]
+        return chunks
+
+    def _file_chunks(self, entry):
+        def chunks(skip, limit):
+            crc = 0 if skip == 0 else None
+            with io.open(entry.path, 'rb') as f:
+                if skip:
+                    f.seek(skip)
+                remaining = limit - skip
+                while remaining:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        raise IOError(
+                            '%s is shorter than expected; was it modified '
+                            'during the download?' % entry.path)
+                    if crc is not None:
+                        crc = zlib.crc32(data, crc)
+                    remaining -= len(data)
+                    yield data
+            if crc is not None and limit == entry.size:
+                self.crc_cache[entry.path] = (
+                    entry.size, entry.mtime, crc & 0xFFFFFFFF)
+        return chunks
+
+    def _crc(self, entry):
+        size, mtime, crc = self.crc_cache.get(entry.path, (None, None, None))
+        if (size, mtime) != (entry.size, entry.mtime):
+            logging.debug('Calculating CRC of %s', entry.path)
+            for chunk in self._file_chunks(entry)(0, entry.size):
+                pass
+            size, mtime, crc = self.crc_cache[entry.path]
+        return crc
+
+    def _name(self, arcname):
+        try:
+            return arcname.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return arcname.encode('utf-8'), FLAG_UTF8
+
+    def _dos_time(self, mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        return (
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            )
+
+    def _local_header(self, arcname, size, mtime):
+        # The CRC isn't known until the file has been read, so it is left as
+        # zero here and given in the data descriptor which follows the data.
+        # The sizes are known, so they are included to help streaming readers
+        name, flags = self._name(arcname)
+        dos_time, dos_date = self._dos_time(mtime)
+        return LOCAL_HEADER.pack(
+            LOCAL_HEADER_SIG, ZIP_VERSION, flags | FLAG_DATA_DESCRIPTOR, 0,
+            dos_time, dos_date, 0, size, size, len(name), 0) + name
+
+    def _data_descriptor(self, entry):
+        return DATA_DESCRIPTOR.pack(
+            DATA_DESCRIPTOR_SIG, self._crc(entry), entry.size, entry.size)
+
+    def _directory(self):
+        result = []
+        for entry in self.entries:
+            name, flags = self._name(entry.arcname)
+            dos_time, dos_date = self._dos_time(entry.mtime)
+            if entry.offset >= ZIP_MAX:
+                extra = ZIP64_OFFSET_EXTRA.pack(
+                    1, ZIP64_OFFSET_EXTRA.size - 4, entry.offset)
+                offset, version = ZIP_MAX, ZIP64_VERSION
+            else:
+                extra = b''
+                offset, version = entry.offset, ZIP_VERSION
+            result.append(CENTRAL_HEADER.pack(
+                CENTRAL_HEADER_SIG, (3 << 8) | version, version,
+                flags | FLAG_DATA_DESCRIPTOR, 0, dos_time, dos_date,
+                self._crc(entry), entry.size, entry.size, len(name),
+                len(extra), 0, 0, 0, 0o100644 << 16, offset))
+            result.append(name)
+            result.append(extra)
+        count = len(self.entries)
+        if self._zip64:
+            end64 = self._directory_offset + self._directory_size
+            result.append(ZIP64_END_RECORD.pack(
+                ZIP64_END_RECORD_SIG, ZIP64_END_RECORD.size - 12,
+                (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count,
+                self._directory_size, self._directory_offset))
+            result.append(ZIP64_END_LOCATOR.pack(
+                ZIP64_END_LOCATOR_SIG, 0, end64, 1))
+        result.append(END_RECORD.pack(
+            END_RECORD_SIG, 0, 0,
+            min(count, ZIP_MAX_ENTRIES), min(count, ZIP_MAX_ENTRIES),
+            min(self._directory_size, ZIP_MAX),
+            min(self._directory_offset, ZIP_MAX), 0))
+        return b''.join(result)
@@ -0,0 +1,106 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import io
+import time
+import threading
+import importlib.util
+
+import pytest
+
+# The camera module needs picamera, which is only available on the Pi; the
+# capture benchmark's fake camera stands in for it everywhere else
+spec = importlib.util.spec_from_file_location(
+    'bench_capture',
+    os.path.join(os.path.dirname(__file__), os.pardir, 'bench', 'capture.py'))
+bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench)
+if importlib.util.find_spec('picamera') is None:
+    bench.install_fake_picamera()
+
+from picroscopy.camera import CameraQueue, CameraTimeout
+
+
+@pytest.fixture()
+def camera():
+    camera = bench.FakePiCamera()
+    camera.jpeg = bench.make_jpeg((64, 48))
+    return camera
+
+
+def test_queue_order(camera):
+    queue = CameraQueue(camera)
+    try:
+        calls = []
+        futures = [
+            queue.submit(lambda camera, i: calls.append(i) or i, i)
+            for i in range(20)
+            ]
+        assert [future.result(5) for future in futures] == list(range(20))
+        assert calls == list(range(20))
+        output = io.BytesIO()
+        queue.capture(output)
+        assert output.getvalue() == camera.jpeg
+    finally:
+        queue.close()
+
+
+def test_queue_nested(camera):
+    # A command which submits another is executed immediately rather than
+    # deadlocking the queue
+    queue = CameraQueue(camera, timeout=5)
+    try:
+        assert queue.call(lambda camera: queue.call(lambda c: c is camera))
+    finally:
+        queue.close()
+
+
+def test_queue_timeout(camera):
+    queue = CameraQueue(camera, timeout=0.1)
+    release = threading.Event()
+    calls = []
+    try:
+        busy = queue.submit(lambda camera: release.wait(5))
+        with pytest.raises(CameraTimeout):
+            queue.call(lambda camera: calls.append('late'))
+        release.set()
+        assert busy.result(5)
+        # The command which timed out hadn't started, so it was cancelled
+        # rather than executed once the camera was free
+        queue.call(lambda camera: calls.append('next'))
+        assert calls == ['next']
+    finally:
+        release.set()
+        queue.close()
+
+
+def test_queue_close(camera):
+    queue = CameraQueue(camera)
+    calls = []
+    def slow(camera, i):
+        time.sleep(0.01)
+        calls.append(i)
+        return i
+    futures = [queue.submit(slow, i) for i in range(10)]
+    queue.close()
+    # Every command queued before close is executed before it returns
+    assert calls == list(range(10))
+    assert [future.result(0) for future in futures] == list(range(10))
+    with pytest.raises(RuntimeError):
+        queue.submit(slow, 10)
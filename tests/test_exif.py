@@ -0,0 +1,266 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import struct
+
+import pytest
+from PIL import Image
+
+from picroscopy.exif import (
+    EXIF_HEADER,
+    jpeg_segments,
+    extract_exif,
+    insert_exif,
+    insert_png_exif,
+    parse_exif,
+    read_exif,
+    )
+
+
+def make_exif(tags, start=8):
+    # A little-endian TIFF structure holding a single IFD of ASCII tags at
+    # offset start (anything between the header and the IFD is zero-filled)
+    offset = start + 2 + len(tags) * 12 + 4
+    entries = []
+    values = []
+    for tag, value in tags:
+        entries.append(struct.pack('<HHLL', tag, 2, len(value), offset))
+        values.append(value)
+        offset += len(value)
+    return b''.join(
+        [b'II*\x00', struct.pack('<L', start), b'\x00' * (start - 8),
+         struct.pack('<H', len(tags))] + entries +
+        [struct.pack('<L', 0)] + values)
+
+
+EXIF = EXIF_HEADER + make_exif([
+    (0x010f, b'RaspberryPi\x00'),
+    (0x0110, b'RP_OV5647\x00'),
+    ])
+OTHER_EXIF = EXIF_HEADER + make_exif([(0x013b, b'Someone\x00')])
+
+
+class Reader(io.BytesIO):
+    # Counts the bytes read from it
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def make_image(format):
+    data = io.BytesIO()
+    Image.new('RGB', (32, 24), (255, 0, 0)).save(data, format)
+    return data.getvalue()
+
+
+@pytest.fixture()
+def jpeg():
+    return make_image('JPEG')
+
+
+@pytest.fixture()
+def png():
+    return make_image('PNG')
+
+
+def test_jpeg_round_trip(jpeg):
+    assert extract_exif(jpeg) is None
+    data = insert_exif(jpeg, EXIF)
+    assert extract_exif(data) == EXIF
+    assert parse_exif(extract_exif(data))['IFD0'] == {
+        0x010f: 'RaspberryPi',
+        0x0110: 'RP_OV5647',
+        }
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    assert img.size == (32, 24)
+
+
+def test_jpeg_insert_without_header(jpeg):
+    data = insert_exif(jpeg, EXIF[len(EXIF_HEADER):])
+    assert extract_exif(data) == EXIF
+
+
+def test_jpeg_replace(jpeg):
+    data = insert_exif(insert_exif(jpeg, EXIF), OTHER_EXIF)
+    assert extract_exif(data) == OTHER_EXIF
+    assert sum(1 for marker, start, end in jpeg_segments(data) if marker == 0xE1) == 1
+
+
+def test_jpeg_remove(jpeg):
+    data = insert_exif(insert_exif(jpeg, EXIF), None)
+    assert extract_exif(data) is None
+    assert data == jpeg
+
+
+def test_jpeg_after_jfif(jpeg):
+    # The EXIF segment goes after SOI and the JFIF APP0 segment
+    markers = [marker for marker, start, end in jpeg_segments(insert_exif(jpeg, EXIF))]
+    assert markers[:3] == [0xD8, 0xE0, 0xE1]
+
+
+def test_jpeg_too_large(jpeg):
+    with pytest.raises(ValueError):
+        insert_exif(jpeg, EXIF_HEADER + b'\x00' * 0xFFFF)
+
+
+def test_png_round_trip(png):
+    data = insert_png_exif(png, EXIF)
+    assert data.count(b'eXIf') == 1
+    data = insert_png_exif(data, OTHER_EXIF)
+    assert data.count(b'eXIf') == 1
+    assert data.count(OTHER_EXIF[len(EXIF_HEADER):]) == 1
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    assert img.size == (32, 24)
+    assert insert_png_exif(png, None) == png
+
+
+def test_parse_truncated():
+    for length in range(len(EXIF)):
+        try:
+            parse_exif(EXIF[:length])
+        except (ValueError, struct.error):
+            pass
+
+
+def test_read_exif_jpeg(jpeg):
+    assert read_exif(io.BytesIO(insert_exif(jpeg, EXIF))) == EXIF
+    assert read_exif(io.BytesIO(jpeg)) is None
+
+
+def test_read_exif_png(png):
+    data = insert_png_exif(png, EXIF)
+    assert read_exif(io.BytesIO(data)) == EXIF[len(EXIF_HEADER):]
+    assert read_exif(io.BytesIO(png)) is None
+
+
+def test_read_exif_tiff():
+    tiff = make_exif([(0x010f, b'RaspberryPi\x00')])
+    assert read_exif(io.BytesIO(tiff)) == tiff
+
+
+def test_read_exif_unknown():
+    assert read_exif(io.BytesIO(b'GIF89a')) is None
+
+
+TRUNCATED_JPEGS = [
+    b'',
+    b'\xff',
+    b'\xff\xd8\xff',
+    b'\xff\xd8\xff\xe1',
+    b'\xff\xd8\xff\xe1\x00',
+    b'\xff\xd8\xff\xe1\x00\x10Exif',
+    b'\xff\xd8\x00\x00',
+    b'not a JPEG at all',
+    ]
+
+
+@pytest.mark.parametrize('data', TRUNCATED_JPEGS)
+def test_extract_truncated(data):
+    with pytest.raises(ValueError):
+        extract_exif(data)
+
+
+@pytest.mark.parametrize('data', TRUNCATED_JPEGS)
+def test_insert_truncated(data):
+    with pytest.raises(ValueError):
+        insert_exif(data, EXIF)
+
+
+@pytest.mark.parametrize('data', TRUNCATED_JPEGS)
+def test_read_truncated(data):
+    assert read_exif(io.BytesIO(data)) is None
+
+
+def test_png_truncated(png):
+    with pytest.raises(ValueError):
+        insert_png_exif(b'not a PNG', EXIF)
+    with pytest.raises(ValueError):
+        insert_png_exif(png[:12], EXIF)
+    with pytest.raises(ValueError):
+        insert_png_exif(png[:33], EXIF)
+
+
+def test_truncated_real_jpeg(jpeg):
+    # Every prefix of a real JPEG which ends before its EXIF segment is
+    # complete is rejected; longer prefixes (still ending within the headers)
+    # yield the EXIF block, as the rest isn't read
+    data = insert_exif(jpeg, EXIF)
+    segments = list(jpeg_segments(data))
+    exif_end = [end for marker, start, end in segments if marker == 0xE1][0]
+    sos = [start for marker, start, end in segments if marker == 0xDA][0]
+    for length in range(2, sos):
+        if length < exif_end:
+            with pytest.raises(ValueError):
+                extract_exif(data[:length])
+            assert read_exif(io.BytesIO(data[:length])) is None
+        else:
+            assert extract_exif(data[:length]) == EXIF
+            assert read_exif(io.BytesIO(data[:length])) == EXIF
+
+
+def test_read_exif_png_truncated(png):
+    data = insert_png_exif(png, EXIF)
+    end = data.index(b'eXIf') + 4 + len(EXIF) - len(EXIF_HEADER)
+    for length in range(data.index(b'eXIf') + 4, end):
+        assert read_exif(io.BytesIO(data[:length])) is None
+    assert read_exif(io.BytesIO(data[:end])) == EXIF[len(EXIF_HEADER):]
+
+
+def test_read_exif_tiff_image():
+    # Only the IFD is read from a TIFF image, not its image data
+    data = io.BytesIO()
+    Image.new('RGB', (640, 480), (255, 0, 0)).save(
+        data, 'TIFF', tiffinfo={0x013b: 'Someone', 0x0131: 'picroscopy'})
+    data = data.getvalue()
+    f = Reader(data)
+    exif = read_exif(f)
+    assert f.bytes_read < 1000
+    assert parse_exif(exif) == parse_exif(data)
+    assert parse_exif(exif)['IFD0'][0x013b] == 'Someone'
+
+
+def test_read_exif_tiff_ifd_last():
+    tags = [(0x010f, b'RaspberryPi\x00'), (0x0110, b'RP_OV5647\x00')]
+    f = Reader(make_exif(tags, start=1000000))
+    assert read_exif(f) == make_exif(tags)
+    assert f.bytes_read < 200
+
+
+def test_read_exif_tiff_sub_ifds():
+    exif = Image.Exif()
+    exif[0x0110] = 'RP_OV5647'
+    exif.get_ifd(0x8769)[0x829a] = (1, 100)
+    tiff = exif.tobytes()[len(EXIF_HEADER):]
+    assert parse_exif(read_exif(io.BytesIO(tiff))) == {
+        'IFD0': {0x0110: 'RP_OV5647'},
+        'EXIF': {0x829a: (1, 100)},
+        }
+
+
+def test_read_exif_tiff_truncated():
+    tiff = make_exif([(0x010f, b'RaspberryPi\x00')])
+    for length in range(8, len(tiff) - 12):
+        assert read_exif(io.BytesIO(tiff[:length])) is None
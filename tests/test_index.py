@@ -0,0 +1,83 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+import pytest
+from PIL import Image
+
+from picroscopy.index import PicroscopyIndex
+
+
+@pytest.fixture()
+def images(tmpdir):
+    path = tmpdir.mkdir('images')
+    for name in ('a.jpg', 'b.jpg'):
+        Image.new('RGB', (32, 24)).save(str(path.join(name)), 'JPEG')
+    return str(path)
+
+
+def test_entries(images):
+    index = PicroscopyIndex(images, ['.jpg'])
+    index.rebuild()
+    assert list(index) == ['a.jpg', 'b.jpg']
+    entry = index['a.jpg']
+    st = os.stat(os.path.join(images, 'a.jpg'))
+    assert (entry.size, entry.mtime, entry.ctime) == (
+        st.st_size, st.st_mtime, st.st_ctime)
+    assert (entry.width, entry.height) == (32, 24)
+    assert index.lookup(['b.jpg', 'c.jpg']) == [index['b.jpg']]
+
+
+def test_copied_file(images):
+    # A file copied in with its original mtime preserved is still recorded
+    # with the time it was added
+    index = PicroscopyIndex(images, ['.jpg'])
+    index.rebuild()
+    path = os.path.join(images, 'c.jpg')
+    Image.new('RGB', (32, 24)).save(path, 'JPEG')
+    os.utime(path, (946684800, 946684800))
+    entry = index.add('c.jpg')
+    assert entry.mtime == 946684800
+    assert entry.ctime >= index['a.jpg'].ctime
+
+
+def test_persisted(images, tmpdir):
+    index_file = str(tmpdir.join('index.json'))
+    index = PicroscopyIndex(images, ['.jpg'], index_file=index_file)
+    index.rebuild()
+    index.close()
+    with open(index_file) as f:
+        assert json.load(f)['version'] == PicroscopyIndex.version
+    restored = PicroscopyIndex(images, ['.jpg'], index_file=index_file)
+    restored.rebuild()
+    assert restored.lookup(restored) == index.lookup(index)
+
+
+def test_old_version_ignored(images, tmpdir):
+    index_file = str(tmpdir.join('index.json'))
+    with open(index_file, 'w') as f:
+        json.dump({
+            'version': 1,
+            'path':    images,
+            'entries': [['a.jpg', 1, 2.0, 3, 4]],
+            }, f)
+    index = PicroscopyIndex(images, ['.jpg'], index_file=index_file)
+    index.rebuild()
+    assert index['a.jpg'].width == 32
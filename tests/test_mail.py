@@ -0,0 +1,301 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import time
+import base64
+import email
+import threading
+import socketserver
+from email.header import decode_header, make_header
+
+import pytest
+
+from picroscopy.mail import (
+    Attachment,
+    MailMessage,
+    MailQueue,
+    encoded_size,
+    split_attachments,
+    CHUNK_SIZE,
+    SENT,
+    FAILED,
+    )
+
+
+def header(message, name):
+    return str(make_header(decode_header(message[name])))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough of SMTP for smtplib and send_smtp; the server's replies
+    # attribute holds replies to use (in order) in place of accepting MAIL
+    # commands, to simulate failures
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('ascii').strip().split(' ', 1)[0].upper()
+            if command in ('HELO', 'EHLO', 'NOOP', 'RSET', 'RCPT'):
+                self.reply('250 OK')
+            elif command == 'MAIL':
+                self.reply(server.replies.pop(0) if server.replies else '250 OK')
+            elif command == 'DATA':
+                self.reply('354 Go ahead')
+                data = []
+                for line in iter(self.rfile.readline, b'.\r\n'):
+                    data.append(line)
+                server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                time.sleep(server.quit_delay)
+                server.quits += 1
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Unknown command')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.quits = 0
+        self.quit_delay = 0
+        self.replies = []
+        self.messages = []
+
+
+@pytest.fixture()
+def smtp_server():
+    server = SMTPServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(job, timeout=5):
+    start = time.time()
+    while job.finished is None and time.time() - start < timeout:
+        time.sleep(0.01)
+    return job.state
+
+
+@pytest.fixture()
+def attachments(tmpdir):
+    result = []
+    for name, data in (
+            ('small.jpg', b'picroscopy'),
+            # Larger than a chunk, and not a multiple of the base64 line size
+            ('large.png', bytes(range(256)) * (CHUNK_SIZE // 256 + 7)),
+            ('caf\xe9 "quoted".tiff', b''),
+            ):
+        path = str(tmpdir.join('%d.bin' % len(result)))
+        with io.open(path, 'wb') as f:
+            f.write(data)
+        result.append(Attachment(name, path, len(data)))
+    return result
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 56, 57, 58, 1000, CHUNK_SIZE + 1])
+def test_encoded_size(size):
+    data = b'\x00' * size
+    assert encoded_size(size) == len(base64.encodebytes(data))
+    assert encoded_size(size, b'\r\n') == len(
+        base64.encodebytes(data).replace(b'\n', b'\r\n'))
+
+
+def test_split_unlimited():
+    files = [Attachment('%d.jpg' % i, '', 1000) for i in range(10)]
+    assert split_attachments(files, 0) == [files]
+
+
+def test_split_limited():
+    files = [Attachment('%d.jpg' % i, '', 570) for i in range(10)]
+    # Each file encodes to 770 bytes, so three fit in a group
+    groups = split_attachments(files, 770 * 3)
+    assert groups == [files[0:3], files[3:6], files[6:9], files[9:10]]
+    for group in groups:
+        assert sum(encoded_size(f.size) for f in group) <= 770 * 3
+
+
+def test_split_crlf():
+    files = [Attachment('%d.jpg' % i, '', 570) for i in range(10)]
+    # With CRLF line endings each file encodes to 780 bytes, so three no
+    # longer fit in a group of 770 * 3 bytes
+    groups = split_attachments(files, 770 * 3, b'\r\n')
+    assert [len(group) for group in groups] == [2, 2, 2, 2, 2]
+    for group in groups:
+        assert sum(encoded_size(f.size, b'\r\n') for f in group) <= 770 * 3
+
+
+def test_split_oversized():
+    small = Attachment('small.jpg', '', 10)
+    large = Attachment('large.jpg', '', 10000)
+    assert split_attachments([small, large, small], 1000) == [
+        [small], [large], [small]]
+
+
+def test_split_empty():
+    assert split_attachments([], 1000) == []
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n'])
+def test_message(attachments, newline):
+    message = MailMessage(
+        'picroscopy@example.com', 'user@example.com', 'Images',
+        'Here are your images', attachments, newline=newline)
+    data = b''.join(message)
+    if newline == b'\r\n':
+        assert b'\n' not in data.replace(b'\r\n', b'')
+    parsed = email.message_from_bytes(data)
+    assert parsed['From'] == 'picroscopy@example.com'
+    assert parsed['To'] == 'user@example.com'
+    assert parsed['Subject'] == 'Images'
+    assert parsed.is_multipart()
+    parts = parsed.get_payload()
+    assert len(parts) == len(attachments) + 1
+    assert parts[0].get_payload(decode=True) == b'Here are your images'
+    for part, attachment in zip(parts[1:], attachments):
+        assert part.get_filename() == attachment.filename
+        with io.open(attachment.path, 'rb') as f:
+            assert part.get_payload(decode=True) == f.read()
+    assert parts[1].get_content_type() == 'image/jpeg'
+    assert parts[2].get_content_type() == 'image/png'
+
+
+def test_message_size_matches_encoding(attachments):
+    # The encoded size of each attachment (used to split libraries between
+    # messages) must match what the message actually contains; the parser
+    # treats the final newline as part of the following boundary
+    message = MailMessage('a@example.com', 'b@example.com', '', '', attachments)
+    parts = email.message_from_bytes(b''.join(message)).get_payload()
+    for part, attachment in zip(parts[1:], attachments):
+        payload = part.get_payload().encode('ascii')
+        if payload:
+            payload += b'\n'
+        assert len(payload) == encoded_size(attachment.size)
+
+
+def test_message_non_ascii_headers():
+    message = MailMessage(
+        'D\xe9sir\xe9 <picroscopy@example.com>', 'user@example.com',
+        'Caf\xe9 cells ' * 10, 'B\xf6dy', [], newline=b'\r\n')
+    data = b''.join(message)
+    data.decode('ascii')
+    parsed = email.message_from_bytes(data)
+    assert header(parsed, 'From') == 'D\xe9sir\xe9 <picroscopy@example.com>'
+    assert header(parsed, 'Subject') == 'Caf\xe9 cells ' * 10
+    assert parsed.get_payload()[0].get_payload(decode=True).decode('utf-8') == 'B\xf6dy'
+
+
+def test_message_non_ascii_address():
+    message = MailMessage(
+        'picroscopy@example.com', '\xfcser@example.com', 'Images', '', [])
+    with pytest.raises(ValueError):
+        b''.join(message)
+
+
+def test_queue_send(smtp_server):
+    done = []
+    queue = MailQueue(smtp_server=smtp_server.server_address)
+    try:
+        jobs = [
+            queue.submit('user@example.com', [
+                MailMessage(
+                    'picroscopy@example.com', 'user@example.com',
+                    'Images %d' % i, 'Body', [], newline=b'\r\n')
+                ], callback=done.append)
+            for i in range(2)
+            ]
+        assert [wait_for(job) for job in jobs] == [SENT, SENT]
+        assert done == jobs
+        assert queue[jobs[0].id] is jobs[0]
+        assert [job.attempts for job in jobs] == [1, 1]
+    finally:
+        queue.close()
+    # Both messages were sent over the one pooled connection, which was
+    # closed with the queue
+    assert smtp_server.connections == 1
+    assert smtp_server.quits == 1
+    assert [
+        email.message_from_bytes(data)['Subject']
+        for data in smtp_server.messages
+        ] == ['Images 0', 'Images 1']
+
+
+def test_queue_retry(smtp_server):
+    smtp_server.replies = ['451 Try again later']
+    queue = MailQueue(smtp_server=smtp_server.server_address, backoff=0.05)
+    try:
+        job = queue.submit('user@example.com', [
+            MailMessage('a@example.com', 'b@example.com', '', '', [],
+                newline=b'\r\n')])
+        assert wait_for(job) == SENT
+        assert job.attempts == 2
+        assert len(smtp_server.messages) == 1
+    finally:
+        queue.close()
+
+
+def test_queue_permanent_failure(smtp_server):
+    smtp_server.replies = ['550 No such user']
+    queue = MailQueue(smtp_server=smtp_server.server_address, backoff=0.05)
+    try:
+        job = queue.submit('user@example.com', [
+            MailMessage('a@example.com', 'b@example.com', '', '', [],
+                newline=b'\r\n')])
+        assert wait_for(job) == FAILED
+        assert job.attempts == 1
+        assert '550' in job.error
+        assert smtp_server.messages == []
+    finally:
+        queue.close()
+
+
+def test_queue_idle_quit_unlocked(smtp_server):
+    # Closing an idle connection mustn't block submissions while the server
+    # takes its time acknowledging the QUIT
+    smtp_server.quit_delay = 1
+    queue = MailQueue(smtp_server=smtp_server.server_address, idle=0.1)
+    try:
+        job = queue.submit('user@example.com', [
+            MailMessage('a@example.com', 'b@example.com', '', '', [],
+                newline=b'\r\n')])
+        assert wait_for(job) == SENT
+        time.sleep(0.3)
+        start = time.time()
+        queue[job.id]
+        assert queue.depth == 0
+        assert time.time() - start < 0.5
+    finally:
+        queue.close()
+    assert smtp_server.quits == 1
@@ -0,0 +1,135 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from picroscopy.stream import (
+    MJPEGStream,
+    FrameSplitter,
+    StreamBusy,
+    SyntheticSource,
+    )
+
+
+class ManualSource(object):
+    # A source which publishes only when the test tells it to
+    def __init__(self):
+        self.publish = None
+        self.starts = 0
+        self.stops = 0
+
+    def start(self, publish):
+        self.publish = publish
+        self.starts += 1
+
+    def stop(self):
+        self.publish = None
+        self.stops += 1
+
+
+def frame(n, size=100):
+    return b'\xff\xd8' + bytes([n]) * size + b'\xff\xd9'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_splitter(chunk_size):
+    # Each frame starts a new write, but the encoder may split a frame
+    # across any number of writes
+    published = []
+    splitter = FrameSplitter(published.append)
+    frames = [frame(n, 100 + n * 50) for n in range(4)]
+    for data in frames:
+        splitter.write(data[:2 + chunk_size])
+        for i in range(2 + chunk_size, len(data), chunk_size):
+            splitter.write(data[i:i + chunk_size])
+    # The last frame isn't known to be complete until the next one starts
+    assert published == frames[:-1]
+    splitter.write(frame(4))
+    assert published == frames
+
+
+def test_slow_client():
+    source = ManualSource()
+    stream = MJPEGStream(source, timeout=5)
+    client = stream.frames()
+    try:
+        assert source.starts == 1
+        threading.Timer(0.1, source.publish, (frame(1),)).start()
+        assert next(client) == frame(1)
+        # Frames published while the client was busy are skipped in favour
+        # of the latest
+        for n in (2, 3, 4):
+            source.publish(frame(n))
+        assert next(client) == frame(4)
+        assert stream.published == 4
+        assert stream.dropped == 2
+    finally:
+        client.close()
+    assert source.stops == 1
+    assert stream.clients == 0
+
+
+def test_timeout():
+    stream = MJPEGStream(ManualSource(), timeout=0.1)
+    client = stream.frames()
+    try:
+        assert list(client) == []
+    finally:
+        client.close()
+
+
+def test_max_clients():
+    source = ManualSource()
+    stream = MJPEGStream(source, max_clients=1)
+    client = stream.frames()
+    try:
+        with pytest.raises(StreamBusy):
+            stream.multipart()
+        assert stream.clients == 1
+    finally:
+        client.close()
+    # The refused client didn't start the source or leave itself connected
+    assert (source.starts, source.stops) == (1, 1)
+    client = stream.frames()
+    client.close()
+    assert stream.clients == 0
+
+
+def test_synthetic_multipart():
+    source = SyntheticSource(resolution=(64, 48), framerate=50)
+    stream = MJPEGStream(source, timeout=5)
+    client = stream.multipart()
+    try:
+        part = next(client)
+    finally:
+        client.close()
+    assert source._thread is None
+    headers, data = part.split(b'\r\n\r\n', 1)
+    assert headers.split(b'\r\n') == [
+        b'--frame',
+        b'Content-Type: image/jpeg',
+        ('Content-Length: %d' % (len(data) - 2)).encode('ascii'),
+        ]
+    assert data.endswith(b'\r\n')
+    with Image.open(io.BytesIO(data[:-2])) as im:
+        assert im.format == 'JPEG'
+        assert im.size == (64, 48)
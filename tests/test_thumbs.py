@@ -0,0 +1,63 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+from PIL import Image
+
+from picroscopy.thumbs import RenditionCache, generate_thumbnail
+
+
+def write(path, size, mtime):
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * size)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.parametrize('format', ['JPEG', 'PNG'])
+def test_generate_thumbnail(tmpdir, format):
+    source = str(tmpdir.join('source'))
+    target = str(tmpdir.join('thumb.jpg'))
+    Image.new('RGB', (800, 600), (255, 0, 0)).save(source, format)
+    assert generate_thumbnail(source, target, (100, 100)) == target
+    with Image.open(target) as im:
+        assert im.format == 'JPEG'
+        assert im.size == (100, 75)
+    assert sorted(os.listdir(str(tmpdir))) == ['source', 'thumb.jpg']
+
+
+def test_cache_existing(tmpdir):
+    write(str(tmpdir.join('old.jpg')), 100, 1000)
+    write(str(tmpdir.join('new.jpg')), 100, 2000)
+    cache = RenditionCache(str(tmpdir), limit=150)
+    # The oldest file is evicted to bring the cache within its limit
+    assert len(cache) == 1
+    assert cache.size == 100
+    assert sorted(os.listdir(str(tmpdir))) == ['new.jpg']
+
+
+def test_cache_removes_temporary_files(tmpdir):
+    # Temporary files left by an interrupted save_thumbnail are removed
+    # rather than counted against the limit
+    write(str(tmpdir.join('thumb.jpg')), 100, 1000)
+    write(str(tmpdir.join('tmpabc123.tmp')), 100, 2000)
+    cache = RenditionCache(str(tmpdir), limit=150)
+    assert len(cache) == 1
+    assert cache.size == 100
+    assert sorted(os.listdir(str(tmpdir))) == ['thumb.jpg']
@@ -0,0 +1,140 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2013 Dave Hughes.
+#
+# This file is part of picroscopy.
+#
+# picroscopy is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# picroscopy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# picroscopy.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import time
+import zipfile
+
+import pytest
+
+from picroscopy.zipstream import ZipStream, ZIP_MAX, ZIP_MAX_ENTRIES
+
+
+CONTENT = {
+    'empty.jpg': b'',
+    'small.jpg': b'picroscopy',
+    'large.png': bytes(range(256)) * 1000,
+    'caf\xe9.tiff': b'non-ASCII name',
+    }
+
+
+@pytest.fixture()
+def files(tmpdir):
+    result = []
+    mtime = time.mktime((2013, 10, 1, 12, 0, 0, 0, 0, -1))
+    for name, data in sorted(CONTENT.items()):
+        path = str(tmpdir.join(name.encode('ascii', 'replace').decode('ascii')))
+        with io.open(path, 'wb') as f:
+            f.write(data)
+        result.append((name, path, len(data), mtime))
+    return result
+
+
+def test_archive(files):
+    stream = ZipStream(files, chunk_size=1000)
+    data = b''.join(stream)
+    assert len(data) == len(stream) == stream.size
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [name for name, path, size, mtime in files]
+        for name, content in CONTENT.items():
+            info = archive.getinfo(name)
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert info.date_time == (2013, 10, 1, 12, 0, 0)
+            assert archive.read(name) == content
+
+
+def test_empty_archive():
+    stream = ZipStream([])
+    data = b''.join(stream)
+    assert len(data) == stream.size
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.namelist() == []
+
+
+@pytest.mark.parametrize('crc_cache', [False, True])
+def test_ranges(files, crc_cache):
+    whole = b''.join(ZipStream(files))
+    cache = {}
+    if crc_cache:
+        # Streaming the whole archive fills the cache with each file's CRC
+        b''.join(ZipStream(files, crc_cache=cache))
+        assert len(cache) == len(files)
+    stream = ZipStream(files, chunk_size=1000, crc_cache=cache)
+    boundaries = sorted(set(
+        offset
+        for entry in stream.entries
+        for offset in (
+            entry.offset, entry.offset + len(entry.header),
+            entry.offset + len(entry.header) + entry.size)
+        ))
+    points = sorted(set(
+        [0, 1, stream.size - 1, stream.size] +
+        [b + d for b in boundaries for d in (-1, 0, 1)
+            if 0 <= b + d <= stream.size]
+        ))
+    for start in points:
+        for stop in points:
+            if start <= stop:
+                assert b''.join(stream.app_iter_range(start, stop)) == whole[start:stop]
+
+
+def test_open_ranges(files):
+    stream = ZipStream(files)
+    whole = b''.join(stream)
+    assert b''.join(stream.app_iter_range(None, None)) == whole
+    assert b''.join(stream.app_iter_range(100, None)) == whole[100:]
+    assert b''.join(stream.app_iter_range(100, stream.size * 2)) == whole[100:]
+
+
+def test_stale_crc_cache(files):
+    # A cached CRC for a different size or mtime must be ignored
+    whole = b''.join(ZipStream(files))
+    cache = {path: (size + 1, mtime, 0) for name, path, size, mtime in files}
+    stream = ZipStream(files, crc_cache=cache)
+    start = stream.entries[-1].offset
+    assert b''.join(stream.app_iter_range(start, None)) == whole[start:]
+
+
+def test_shrunk_file(files):
+    name, path, size, mtime = files[1]
+    stream = ZipStream([(name, path, size + 10, mtime)])
+    with pytest.raises(IOError):
+        b''.join(stream)
+
+
+def test_too_large(files):
+    name, path, size, mtime = files[0]
+    with pytest.raises(ValueError):
+        ZipStream([(name, path, ZIP_MAX, mtime)])
+
+
+def test_zip64_entries(files):
+    # More entries than a plain zip can count requires the ZIP64 end records
+    name, path, size, mtime = files[0]
+    entries = [
+        ('%05d.jpg' % i, path, size, mtime)
+        for i in range(ZIP_MAX_ENTRIES + 1)
+        ]
+    stream = ZipStream(entries)
+    data = b''.join(stream)
+    assert len(data) == stream.size
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = archive.namelist()
+        assert len(names) == ZIP_MAX_ENTRIES + 1
+        assert names[-1] == '%05d.jpg' % ZIP_MAX_ENTRIES